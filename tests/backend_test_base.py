@@ -20,6 +20,7 @@ import onnx
 from common import get_test_config
 from tfjs_runner import run_tfjs
 from tf2onnx import utils
+from tf2onnx.conversion_context import get_default_context
 from tf2onnx.tfonnx import process_tf_graph
 from tf2onnx import optimizer
 from tf2onnx.tf_loader import tf_reset_default_graph, tf_session, tf_placeholder, from_function, freeze_session
@@ -44,7 +45,7 @@ class Tf2OnnxBackendTestBase(unittest.TestCase):
         self.config = get_test_config()
         tf_reset_default_graph()
         # reset name generation on every test
-        utils.INTERNAL_NAME = 1
+        get_default_context().name_counter = 1
         np.random.seed(1)  # Make it reproducible.
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -244,7 +245,7 @@ class Tf2OnnxBackendTestBase(unittest.TestCase):
             tensor_cnt = model.Subgraphs(0).TensorsLength()
             interpreter = tf.lite.Interpreter(tflite_path)
             for i in range(tensor_cnt):
-                dtype = interpreter._get_tensor_details(i)['dtype']   # pylint: disable=protected-access
+                dtype = interpreter._get_tensor_details(i, 0)['dtype']   # pylint: disable=protected-access
                 if np.dtype(dtype).kind == 'O':
                     return False
             return True
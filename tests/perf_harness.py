@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""Latency and throughput measurements of models run by tensorflow, tflite and onnxruntime, used by
+run_pretrained_models.py --perf."""
+
+import collections
+import csv
+import json
+import platform
+import time
+
+import numpy as np
+
+from tf2onnx import logging, utils
+
+logger = logging.getLogger("run_pretrained")
+
+# duration: seconds each configuration is timed for, at least min_runs calls
+# warmup: calls before the timed ones, they aren't counted
+# batch_sizes: the first dim of the inputs is resized to each of these, None keeps the inputs as they are
+# threads: intra_op_num_threads settings onnxruntime is run with, 0 is its default
+PerfConfig = collections.namedtuple("PerfConfig", ["duration", "warmup", "min_runs", "batch_sizes", "threads"])
+
+FIELDS = ["test", "backend", "batch_size", "threads", "iterations", "mean_ms", "p50_ms", "p90_ms", "p99_ms",
+          "min_ms", "max_ms", "throughput", "peak_rss_mb", "speedup_tensorflow", "speedup_tflite"]
+
+# the backends the onnxruntime rows are compared to, a tflite model is also run by tensorflow
+REFERENCE_BACKENDS = ["tensorflow", "tflite"]
+
+
+def measure(run, config):
+    """Call run config.warmup times and then for at least config.duration seconds and config.min_runs times.
+    Returns the statistics of the latencies of the timed calls in ms and the peak RSS in MB while they ran."""
+    for _ in range(config.warmup):
+        run()
+    utils.reset_peak_rss()
+    latencies = []
+    stop = time.perf_counter() + config.duration
+    while len(latencies) < config.min_runs or time.perf_counter() < stop:
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+    ms = np.array(latencies) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return collections.OrderedDict([
+        ("iterations", len(ms)),
+        ("mean_ms", float(np.mean(ms))),
+        ("p50_ms", float(p50)),
+        ("p90_ms", float(p90)),
+        ("p99_ms", float(p99)),
+        ("min_ms", float(np.min(ms))),
+        ("max_ms", float(np.max(ms))),
+        ("peak_rss_mb", utils.get_peak_rss() / 2**20),
+    ])
+
+
+def batch_inputs(inputs, batch_size):
+    """inputs with their first dim cut or repeated to batch_size. Scalars and batch_size None keep the inputs."""
+    if batch_size is None:
+        return inputs
+    return {k: np.take(v, np.arange(batch_size) % v.shape[0], axis=0) if np.ndim(v) and v.shape[0] else v
+            for k, v in inputs.items()}
+
+
+def _batch_size(inputs):
+    for v in inputs.values():
+        if np.ndim(v):
+            return np.shape(v)[0]
+    return 1
+
+
+def run_batches(backend, make_run, inputs, config, threads=None):
+    """Measure backend for each of the batch sizes of config. make_run takes the inputs of a batch and returns a
+    function running the model on them. Returns a row of results for each batch size the model can run."""
+    rows = []
+    for batch_size in config.batch_sizes or [None]:
+        batch = batch_inputs(inputs, batch_size)
+        try:
+            run = make_run(batch)
+            run()
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.warning("%s can't run batch size %s: %s", backend, batch_size, ex)
+            continue
+        row = collections.OrderedDict([("backend", backend), ("batch_size", _batch_size(batch)),
+                                       ("threads", threads)])
+        row.update(measure(run, config))
+        row["throughput"] = row["batch_size"] * 1000 / row["mean_ms"]
+        logger.info("%s perf batch_size=%d threads=%s: p50 %.2fms, p90 %.2fms, p99 %.2fms, %.1f inferences/s, "
+                    "n=%d", backend, row["batch_size"], threads, row["p50_ms"], row["p90_ms"], row["p99_ms"],
+                    row["throughput"], row["iterations"])
+        rows.append(row)
+    return rows
+
+
+def add_speedups(rows):
+    """Set speedup_<backend> of the onnxruntime rows for each reference backend, the p50 latency of the backend for
+    the batch size divided by theirs."""
+    reference = {(row["backend"], row["batch_size"]): row["p50_ms"] for row in rows
+                 if row["backend"] in REFERENCE_BACKENDS}
+    for row in rows:
+        if row["backend"] != "onnxruntime":
+            continue
+        for backend in REFERENCE_BACKENDS:
+            if (backend, row["batch_size"]) in reference:
+                row["speedup_" + backend] = reference[(backend, row["batch_size"])] / row["p50_ms"]
+    return rows
+
+
+def environment():
+    import onnxruntime as ort  # pylint: disable=import-outside-toplevel
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+    import tf2onnx  # pylint: disable=import-outside-toplevel
+    return collections.OrderedDict([
+        ("tf2onnx", tf2onnx.__version__),
+        ("tensorflow", tf.__version__),
+        ("onnxruntime", ort.__version__),
+        ("python", platform.python_version()),
+        ("machine", platform.machine()),
+        ("processor", platform.processor()),
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+    ])
+
+
+def write_results(path, results):
+    """Write results, a dict mapping tests to their rows, to path as json if it ends with .json, else as csv with
+    a line per test, backend, batch size and threads setting."""
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(collections.OrderedDict([("environment", environment()), ("models", results)]), f, indent=2)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for test, rows in results.items():
+            for row in rows:
+                writer.writerow(dict(row, test=test))
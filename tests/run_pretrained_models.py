@@ -13,7 +13,6 @@ import shutil
 import sys
 import tarfile
 import tempfile
-import time
 import zipfile
 import random
 from collections import namedtuple
@@ -45,10 +44,12 @@ from tf2onnx import tf_loader, logging, optimizer, utils, tf_utils, constants
 from tf2onnx.tfonnx import process_tf_graph
 from tf2onnx.tf_loader import tf_session, tf_reset_default_graph
 from tf2onnx.graph import ExternalTensorStorage
+import perf_harness
 
 logger = logging.getLogger("run_pretrained")
 
 TEMP_DIR = os.path.join(utils.get_temp_directory(), "run_pretrained")
+# defaults of the warm-up calls and the seconds each configuration is timed for with --perf
 PERF_STEP = 10
 PERF_TIME = 10
 
@@ -205,8 +206,7 @@ class Test(object):
         self.dequantize = dequantize
         self.check_only_shape = check_only_shape
         self.perf = None
-        self.tf_runtime = 0
-        self.onnx_runtime = 0
+        self.perf_results = []
         self.model_type = model_type
         self.tag = tag
         self.force_input_shape = force_input_shape
@@ -291,15 +291,12 @@ class Test(object):
         result = sess.run(self.output_names, feed_dict=feed_dict)
         if self.perf:
             logger.info("Running TF perf")
-            n = 0
-            start = time.time()
-            stop = start + PERF_TIME
-            while time.time() < stop:
-                for _ in range(PERF_STEP):
-                    _ = sess.run(self.output_names, feed_dict=feed_dict)
-                n += PERF_STEP
-            self.tf_runtime = 1000 * (time.time() - start) / n
-            logger.info("TF perf {:.2f}ms/inference, n={}".format(self.tf_runtime, n))
+
+            def make_run(batch):
+                feed_dict = {sess.graph.get_tensor_by_name(k): v for k, v in batch.items()}
+                return lambda: sess.run(self.output_names, feed_dict=feed_dict)
+
+            self.perf_results += perf_harness.run_batches("tensorflow", make_run, inputs, self.perf)
         return result
 
     def to_onnx(self, tf_graph, opset=None, extra_opset=None, shape_override=None, input_names=None,
@@ -333,15 +330,13 @@ class Test(object):
         m = rt.InferenceSession(model_path, opt)
         results = m.run(outputs, inputs)
         if self.perf:
-            n = 0
-            start = time.time()
-            stop = start + PERF_TIME
-            while time.time() < stop:
-                for _ in range(PERF_STEP):
-                    _ = m.run(outputs, inputs)
-                n += PERF_STEP
-            self.onnx_runtime = 1000 * (time.time() - start) / n
-            logger.info("ORT perf {:.2f}ms/inference, n={}".format(self.onnx_runtime, n))
+            logger.info("Running ORT perf")
+            for threads in self.perf.threads:
+                opt.intra_op_num_threads = threads
+                session = m if threads == 0 else rt.InferenceSession(model_path, opt)
+                self.perf_results += perf_harness.run_batches(
+                    "onnxruntime", lambda batch, session=session: lambda: session.run(outputs, batch), inputs,
+                    self.perf, threads)
         if self.ort_profile is not None:
             tmp_path = m.end_profiling()
             shutil.move(tmp_path, self.ort_profile)
@@ -413,7 +408,7 @@ class Test(object):
             for k, v in inputs.items():
                 interpreter.resize_tensor_input(input_name_to_index[k], v.shape)
             interpreter.allocate_tensors()
-            def run_tflite():
+            def run_tflite(inputs=inputs):
                 for k, v in inputs.items():
                     interpreter.set_tensor(input_name_to_index[k], v)
                 interpreter.invoke()
@@ -423,22 +418,19 @@ class Test(object):
                 tf_results = run_tflite()
                 if self.perf:
                     logger.info("Running TFLite perf")
-                    n = 0
-                    start = time.time()
-                    stop = start + PERF_TIME
-                    while time.time() < stop:
-                        for _ in range(PERF_STEP):
-                            _ = run_tflite()
-                        n += PERF_STEP
-                    self.tf_runtime = 1000 * (time.time() - start) / n
-                    logger.info("TFLite perf {:.2f}ms/inference, n={}".format(self.tf_runtime, n))
+
+                    def make_run(batch):
+                        for k, v in batch.items():
+                            interpreter.resize_tensor_input(input_name_to_index[k], v.shape)
+                        interpreter.allocate_tensors()
+                        return lambda: run_tflite(batch)
+
+                    self.perf_results += perf_harness.run_batches("tflite", make_run, inputs, self.perf)
                 logger.info("TFLite OK")
 
         if not self.run_tf_frozen:
-            inputs = {}
-            for k in input_names:
-                v = self.input_names[k]
-                inputs[to_rename.get(k, k)] = tf.constant(self.make_input(v))
+            np_inputs = {to_rename.get(k, k): self.make_input(self.input_names[k]) for k in input_names}
+            inputs = {k: tf.constant(v) for k, v in np_inputs.items()}
             tf_func = tf.function(concrete_func)
             logger.info("Running TF")
             tf_results_d = tf_func(**inputs)
@@ -450,19 +442,16 @@ class Test(object):
             tf_results = [tf_res.numpy() for tf_res in tf_results]
             if self.perf:
                 logger.info("Running TF perf")
-                n = 0
-                start = time.time()
-                stop = start + PERF_TIME
                 if self.tf_profile is not None:
                     tf.profiler.experimental.start(self.tf_profile)
-                while time.time() < stop:
-                    for _ in range(PERF_STEP):
-                        _ = concrete_func(**inputs)
-                    n += PERF_STEP
+
+                def make_run(batch):
+                    tensors = {k: tf.constant(v) for k, v in batch.items()}
+                    return lambda: concrete_func(**tensors)
+
+                self.perf_results += perf_harness.run_batches("tensorflow", make_run, np_inputs, self.perf)
                 if self.tf_profile is not None:
                     tf.profiler.experimental.stop()
-                self.tf_runtime = 1000 * (time.time() - start) / n
-                logger.info("TF perf {:.2f}ms/inference, n={}".format(self.tf_runtime, n))
             logger.info("TensorFlow OK")
 
         shape_override = {}
@@ -640,11 +629,25 @@ def get_args():
     parser.add_argument("--debug", help="debug mode", action="store_true")
     parser.add_argument("--list", help="list tests", action="store_true")
     parser.add_argument("--onnx-file", help="create onnx file in directory")
-    parser.add_argument("--perf", help="capture performance numbers")
+    parser.add_argument("--perf", help="capture performance numbers and write them to this csv or json file")
+    parser.add_argument("--perf-time", type=float, default=PERF_TIME,
+                        help="seconds each backend, batch size and threads setting is timed for")
+    parser.add_argument("--perf-warmup", type=int, default=PERF_STEP,
+                        help="inferences before the timed ones, they are left out of the numbers")
+    parser.add_argument("--perf-min-runs", type=int, default=PERF_STEP, help="minimal number of timed inferences")
+    parser.add_argument("--perf-batch-sizes",
+                        help="comma-separated batch sizes the first dim of the inputs is resized to")
+    parser.add_argument("--perf-threads", default="0",
+                        help="comma-separated intra_op_num_threads settings for onnxruntime, 0 is its default")
     parser.add_argument("--include-disabled", help="include disabled tests", action="store_true")
     args = parser.parse_args()
 
     args.target = args.target.split(",")
+    args.perf_config = None
+    if args.perf:
+        batch_sizes = [int(b) for b in args.perf_batch_sizes.split(",")] if args.perf_batch_sizes else None
+        args.perf_config = perf_harness.PerfConfig(args.perf_time, args.perf_warmup, args.perf_min_runs,
+                                                   batch_sizes, [int(t) for t in args.perf_threads.split(",")])
     args.skip_tf_tests = args.skip_tf_tests.upper() == "TRUE"
     args.skip_tflite_tests = args.skip_tflite_tests.upper() == "TRUE"
     if args.extra_opset:
@@ -760,7 +763,7 @@ def main():
         try:
             logger.info("Running %s", test)
             ret = t.run_test(test, backend=args.backend, onnx_file=args.onnx_file,
-                             opset=args.opset, extra_opset=args.extra_opset, perf=args.perf)
+                             opset=args.opset, extra_opset=args.extra_opset, perf=args.perf_config)
         except Exception:
             logger.error("Failed to run %s", test, exc_info=1)
             ret = None
@@ -774,13 +777,9 @@ def main():
     logger.info("RESULT: %s failed of %s, backend=%s", failed, count, args.backend)
 
     if args.perf:
-        with open(args.perf, "w") as f:
-            f.write("test,tensorflow,onnx\n")
-            for test in test_keys:
-                t = tests[test]
-                if t.perf:
-                    # Report perf in ms per inference
-                    f.write("{},{},{}\n".format(test, t.tf_runtime, t.onnx_runtime))
+        results = {test: perf_harness.add_speedups(tests[test].perf_results) for test in test_keys
+                   if tests[test].perf_results}
+        perf_harness.write_results(args.perf, results)
     return failed
 
 
@@ -7,6 +7,7 @@
 
 import os
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
@@ -39,7 +40,7 @@ class ApiTests(Tf2OnnxBackendTestBase):
         model.compile(optimizer=optimizer, loss="mean_squared_error")
         return model
 
-    def _test_keras_api(self, large_model=False):
+    def _test_keras_api(self, large_model=False, external_data=False):
         model = self.create_model()
         shape = [1, 224, 224, 3]
         x = np.arange(np.prod(shape)).reshape(shape).astype(np.float32)
@@ -47,7 +48,7 @@ class ApiTests(Tf2OnnxBackendTestBase):
         ky = model.predict([x, n])
         spec = (tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),
                 tf.TensorSpec((), tf.float32, name="n"))
-        if large_model:
+        if large_model and not external_data:
             output_path = os.path.join(self.test_data_directory, "model.zip")
         else:
             output_path = os.path.join(self.test_data_directory, "model.onnx")
@@ -56,7 +57,7 @@ class ApiTests(Tf2OnnxBackendTestBase):
             model, input_signature=spec, opset=self.config.opset, large_model=large_model, output_path=output_path)
         # input_names = [n.name for n in model_proto.graph.input]
         output_names = [n.name for n in model_proto.graph.output]
-        if large_model:
+        if large_model and not external_data:
             # need to unpack the zip for run_onnxruntime()
             with zipfile.ZipFile(output_path, 'r') as z:
                 z.extractall(os.path.dirname(output_path))
@@ -77,6 +78,12 @@ class ApiTests(Tf2OnnxBackendTestBase):
     def test_keras_api_large(self):
         self._test_keras_api(large_model=True)
 
+    @check_tf_min_version("1.15")
+    @skip_tf_versions(["2.0", "2.1"], "TF 2 requires 2.2 for large model freezing")
+    def test_keras_api_large_external_data(self):
+        self._test_keras_api(large_model=True, external_data=True)
+        self.assertTrue(os.path.exists(os.path.join(self.test_data_directory, "model.data")))
+
     @requires_custom_ops()
     @check_tf_min_version("1.15")
     @check_opset_min_version(11, "SparseToDense")
@@ -198,6 +205,78 @@ class ApiTests(Tf2OnnxBackendTestBase):
         self.assertAllClose(ky, oy[0], rtol=0.3, atol=0.1)
 
 
+    @check_tf_min_version("2.0")
+    def test_function_shape_variants(self):
+        @tf.function
+        def func(x):
+            y = tf.reshape(x, tf.concat([tf.shape(x)[:1], [-1, 2]], 0))
+            return y * tf.cast(tf.shape(y)[1], tf.float32)
+
+        spec = (tf.TensorSpec((None, None, 6), tf.float32, name="x"),)
+        output_path = os.path.join(self.test_data_directory, "model.onnx")
+        dynamic_proto, _ = tf2onnx.convert.from_function(func, input_signature=spec, opset=self.config.opset)
+        variants = [{"x": [1, 4, 6]}, {"x": [8, 2, 6]}]
+        model_protos, _ = tf2onnx.convert.from_function(func, input_signature=spec, opset=self.config.opset,
+                                                        shape_variants=variants, output_path=output_path)
+        self.assertEqual(len(model_protos), 2)
+
+        def count_shapes(model_proto):
+            return sum(n.op_type == "Shape" for n in model_proto.graph.node)
+
+        for i, (variant, model_proto) in enumerate(zip(variants, model_protos)):
+            shape = variant["x"]
+            self.assertEqual([d.dim_value for d in model_proto.graph.input[0].type.tensor_type.shape.dim], shape)
+            self.assertGreater(count_shapes(dynamic_proto), 0)
+            self.assertEqual(count_shapes(model_proto), 0)
+            self.assertEqual([d.dim_value for d in model_proto.graph.output[0].type.tensor_type.shape.dim],
+                             [shape[0], shape[1] * 3, 2])
+            x = np.random.random_sample(shape).astype(np.float32)
+            output_names = [n.name for n in model_proto.graph.output]
+            oy = self.run_onnxruntime(tf2onnx.convert.variant_output_path(output_path, i), {"x": x}, output_names)
+            self.assertAllClose(func(x).numpy(), oy[0])
+
+    @check_tf_min_version("2.0")
+    def test_function_ort_optimize(self):
+        @tf.function
+        def func(x):
+            return tf.nn.relu(tf.matmul(x, tf.ones([8, 4])) + 1.0) * 2.0
+
+        spec = (tf.TensorSpec((None, 8), tf.float32, name="x"),)
+        x = np.random.random_sample([3, 8]).astype(np.float32)
+        for ort_format, ext in [(False, ".optimized.onnx"), (True, ".ort")]:
+            output_path = os.path.join(self.test_data_directory, "model.onnx")
+            with self.assertLogs("tf2onnx", "INFO") as logs:
+                model_proto, _ = tf2onnx.convert.from_function(func, input_signature=spec, opset=self.config.opset,
+                                                               output_path=output_path, ort_optimize="all",
+                                                               ort_format=ort_format)
+            optimized_path = os.path.join(self.test_data_directory, "model" + ext)
+            self.assertEqual(tf2onnx.ort_optimization.ort_optimized_path(output_path, ort_format), optimized_path)
+            self.assertTrue(any("Optimized model is saved at " + optimized_path in line for line in logs.output))
+            output_names = [n.name for n in model_proto.graph.output]
+            oy = self.run_onnxruntime(optimized_path, {"x": x}, output_names)
+            self.assertAllClose(func(x).numpy(), oy[0])
+
+    @check_tf_min_version("2.0")
+    def test_function_dim_params(self):
+        @tf.function
+        def func(x, y):
+            flat = tf.reshape(x, [tf.shape(x)[0], -1])
+            return tf.nn.relu(flat), tf.transpose(y, [1, 0, 2])
+
+        spec = (tf.TensorSpec((None, None, 6), tf.float32, name="x"),
+                tf.TensorSpec((None, 5, None), tf.float32, name="y"))
+        model_proto, _ = tf2onnx.convert.from_function(func, input_signature=spec, opset=self.config.opset)
+
+        def dims(value_info):
+            return [d.dim_param or d.dim_value for d in value_info.type.tensor_type.shape.dim]
+
+        x_dims, y_dims = [dims(v) for v in model_proto.graph.input]
+        flat_dims, transposed_dims = [dims(v) for v in model_proto.graph.output]
+        # the unknown dims of the outputs that are dims of the inputs share their names
+        self.assertEqual(flat_dims[0], x_dims[0])
+        self.assertNotIn(flat_dims[1], x_dims + y_dims)
+        self.assertEqual(transposed_dims, [5, y_dims[0], y_dims[2]])
+
     @check_tf_min_version("1.15")
     def test_graphdef(self):
         output_path = os.path.join(self.test_data_directory, "model.onnx")
@@ -214,6 +293,140 @@ class ApiTests(Tf2OnnxBackendTestBase):
         self.assertTrue(output_names[0] == "pred")
         self.assertAllClose([2.1193342], oy[0], rtol=0.1, atol=0.1)
 
+    @check_tf_min_version("1.15")
+    def test_graphdef_concurrent(self):
+        graph_def, _, _ = tf2onnx.tf_loader.from_graphdef(
+            "tests/models/regression/graphdef/frozen.pb", ["X:0"], ["pred:0"])
+
+        def convert(_):
+            model_proto, _ = tf2onnx.convert.from_graph_def(graph_def, input_names=["X:0"], output_names=["pred:0"],
+                                                            opset=self.config.opset)
+            return model_proto.SerializeToString()
+
+        expected = convert(0)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(convert, range(8)))
+        # every conversion has its own name counter so the models don't depend on what else is running
+        self.assertEqual(convert(0), expected)
+        for result in results:
+            self.assertEqual(result, expected)
+
+    @check_tf_min_version("1.15")
+    def test_graphdef_low_memory(self):
+        graph_def, _, _ = tf2onnx.tf_loader.from_graphdef(
+            "tests/models/regression/graphdef/frozen.pb", ["X:0"], ["pred:0"])
+        expected, _ = tf2onnx.convert.from_graph_def(graph_def, input_names=["X:0"], output_names=["pred:0"],
+                                                     opset=self.config.opset)
+        output_path = os.path.join(self.test_data_directory, "model.onnx")
+        with self.assertLogs("tf2onnx", "INFO") as logs:
+            model_proto, _ = tf2onnx.convert._convert_common(  # pylint: disable=protected-access
+                graph_def, input_names=["X:0"], output_names=["pred:0"], opset=self.config.opset,
+                output_path=output_path, low_memory=True)
+        # the graph is released once it is imported
+        self.assertEqual(len(graph_def.node), 0)
+        for stage in ["import", "process", "optimize", "make_model", "save"]:
+            self.assertTrue(any("Stage {}: peak RSS".format(stage) in line for line in logs.output), stage)
+        self.assertEqual(model_proto.graph, expected.graph)
+        oy = self.run_onnxruntime(output_path, {"X:0": np.array([5.], dtype=np.float32)}, ["pred:0"])
+        self.assertAllClose([2.1193342], oy[0], rtol=0.1, atol=0.1)
+
+    @check_tf_min_version("2.8")
+    def test_saved_model_stream_variables(self):
+        class Model(tf.Module):
+            def __init__(self):
+                super().__init__()
+                self.w = tf.Variable(np.random.random_sample([40, 30]).astype(np.float32))
+                self.b = {"b": tf.Variable(np.arange(30, dtype=np.float32))}
+
+            @tf.function(input_signature=[tf.TensorSpec([None, 40], tf.float32)])
+            def __call__(self, x):
+                return tf.matmul(x, self.w) + self.b["b"]
+
+        model = Model()
+        model_path = os.path.join(self.test_data_directory, "saved_model")
+        tf.saved_model.save(model, model_path, signatures=model.__call__)
+        graph_def, _, _, checkpoint_variables = tf2onnx.tf_loader.from_saved_model(
+            model_path, ["x:0"], ["Identity:0"], large_model=True, stream_variables=True)
+        # only the large variable is left in the checkpoint
+        self.assertEqual(list(checkpoint_variables.node_to_key.values()), ["w/.ATTRIBUTES/VARIABLE_VALUE"])
+        name = list(checkpoint_variables.node_to_key)[0]
+        const = [n for n in graph_def.node if n.name == name][0]
+        self.assertEqual(const.attr["value"].tensor.tensor_content, b"")
+
+        output_path = os.path.join(self.test_data_directory, "model.zip")
+        model_proto, external_tensor_storage = tf2onnx.convert._convert_common(  # pylint: disable=protected-access
+            graph_def, input_names=["x:0"], output_names=["Identity:0"], opset=self.config.opset,
+            large_model=True, checkpoint_variables=checkpoint_variables, output_path=output_path)
+        self.assertEqual(len(external_tensor_storage.name_to_tensor_data), 1)
+        with zipfile.ZipFile(output_path, 'r') as z:
+            z.extractall(os.path.dirname(output_path))
+        output_path = os.path.join(os.path.dirname(output_path), "__MODEL_PROTO.onnx")
+        x = np.random.random_sample([2, 40]).astype(np.float32)
+        oy = self.run_onnxruntime(output_path, {"x:0": x}, [n.name for n in model_proto.graph.output])
+        self.assertAllClose(model(x).numpy(), oy[0], rtol=1e-5, atol=1e-5)
+
+    @check_tf_min_version("2.8")
+    def test_saved_model_signatures(self):
+        class Model(tf.Module):
+            def __init__(self):
+                super().__init__()
+                self.w = tf.Variable(np.random.random_sample([40, 30]).astype(np.float32))
+
+            @tf.function(input_signature=[tf.TensorSpec([None, 40], tf.float32)])
+            def encode(self, x):
+                return {"y": tf.matmul(x, self.w)}
+
+            @tf.function(input_signature=[tf.TensorSpec([None, 40], tf.float32)])
+            def score(self, x):
+                return {"score": tf.reduce_sum(tf.matmul(x, self.w), axis=1)}
+
+        model = Model()
+        model_path = os.path.join(self.test_data_directory, "saved_model")
+        tf.saved_model.save(model, model_path, signatures={"encode": model.encode, "score": model.score})
+        output_path = os.path.join(self.test_data_directory, "signatures", "model.onnx")
+        model_protos = tf2onnx.convert.from_saved_model_signatures(model_path, output_path=output_path,
+                                                                   opset=self.config.opset)
+        self.assertEqual(sorted(model_protos), ["encode", "score"])
+        # the weight both signatures use is written once
+        self.assertEqual(sorted(os.listdir(os.path.dirname(output_path))),
+                         ["model.data", "model_encode.onnx", "model_score.onnx"])
+        self.assertEqual(os.path.getsize(os.path.join(os.path.dirname(output_path), "model.data")),
+                         model.w.numpy().nbytes)
+        x = np.random.random_sample([2, 40]).astype(np.float32)
+        for signature, output in [("encode", "y"), ("score", "score")]:
+            oy = self.run_onnxruntime(tf2onnx.convert.signature_output_path(output_path, signature), {"x": x},
+                                      [output])
+            self.assertAllClose(getattr(model, signature)(x)[output].numpy(), oy[0], rtol=1e-5, atol=1e-5)
+
+    @check_tf_min_version("2.8")
+    def test_saved_model_signatures_custom_op_handlers(self):
+        class Model(tf.Module):
+            @tf.function(input_signature=[tf.TensorSpec([None, 40], tf.float32)])
+            def square(self, x):
+                return {"y": tf.square(x)}
+
+            @tf.function(input_signature=[tf.TensorSpec([None, 40], tf.float32)])
+            def sqrt(self, x):
+                return {"y": tf.sqrt(x)}
+
+        def custom_handler(ctx, node, name, args):  # pylint: disable=unused-argument
+            node.type = "My" + node.type
+            node.domain = "my.domain"
+
+        model = Model()
+        model_path = os.path.join(self.test_data_directory, "saved_model")
+        tf.saved_model.save(model, model_path, signatures={"square": model.square, "sqrt": model.sqrt})
+        output_path = os.path.join(self.test_data_directory, "signatures", "model.onnx")
+        # the signatures are converted at the same time with the handlers of their own conversion
+        model_protos = tf2onnx.convert._convert_signatures(  # pylint: disable=protected-access
+            model_path, None, output_path, max_workers=2, opset=self.config.opset,
+            custom_op_handlers={"Square": (custom_handler, []), "Sqrt": (custom_handler, [])},
+            extra_opset=[helper.make_opsetid("my.domain", 1)])
+        self.assertEqual(sorted(model_protos), ["sqrt", "square"])
+        for signature, op_type in [("square", "MySquare"), ("sqrt", "MySqrt")]:
+            self.assertIn(op_type, [n.op_type for n in model_protos[signature].graph.node
+                                    if n.domain == "my.domain"])
+
 
 if __name__ == '__main__':
     unittest_main()
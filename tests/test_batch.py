@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+""" Test batch.py """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import yaml
+
+from tf2onnx import batch
+
+
+_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "regression")
+
+_MANIFEST = {
+    "regression-graphdef": {
+        "model": os.path.join(_MODEL_DIR, "graphdef", "frozen.pb"),
+        "input_get": "get_ramp",
+        "inputs": {"X:0": [1]},
+        "outputs": ["pred:0"],
+    },
+    "regression-checkpoint": {
+        "model": os.path.join(_MODEL_DIR, "checkpoint", "model.meta"),
+        "model_type": "checkpoint",
+        "inputs": {"X:0": [1]},
+        "outputs": ["pred:0"],
+    },
+    "missing-model": {
+        "model": "does_not_exist.pb",
+        "inputs": {"X:0": [1]},
+        "outputs": ["pred:0"],
+    },
+    "disabled-model": {
+        "disabled": True,
+        "model": os.path.join(_MODEL_DIR, "graphdef", "frozen.pb"),
+        "inputs": {"X:0": [1]},
+        "outputs": ["pred:0"],
+    },
+}
+
+
+class Tf2OnnxBatchTest(unittest.TestCase):
+    """ test cases for batch.py """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmp_dir, "manifest.yaml")
+        with open(self.manifest, "w") as f:
+            yaml.safe_dump(_MANIFEST, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_load_manifest(self):
+        jobs = batch.load_manifest(self.manifest, output_dir=self.tmp_dir)
+        self.assertEqual(list(jobs.keys()), ["missing-model", "regression-checkpoint", "regression-graphdef"])
+        job = jobs["regression-graphdef"]
+        self.assertTrue(os.path.isabs(job["model"]))
+        # relative model paths are relative to the manifest
+        self.assertEqual(jobs["missing-model"]["model"], os.path.join(self.tmp_dir, "does_not_exist.pb"))
+        self.assertEqual(job["output"], os.path.join(self.tmp_dir, "regression-graphdef.onnx"))
+        self.assertNotIn("input_get", job)
+        jobs = batch.load_manifest(self.manifest, names=["disabled-model"], opset=13)
+        self.assertEqual(jobs["disabled-model"]["opset"], 13)
+        with open(self.manifest, "w") as f:
+            yaml.safe_dump({"typo": dict(_MANIFEST["regression-graphdef"], shape_overide={"X:0": [1]})}, f)
+        with self.assertRaisesRegex(ValueError, "unknown manifest keys"):
+            batch.load_manifest(self.manifest)
+
+    def test_run_jobs_with_recycling(self):
+        jobs = batch.load_manifest(self.manifest, output_dir=self.tmp_dir)
+        # a 1 MB threshold recycles the workers after every model
+        results = batch.run_jobs(jobs, num_workers=2, max_worker_memory_mb=1)
+        self.assertEqual([r["name"] for r in results], list(jobs.keys()))
+        status = {r["name"]: r["status"] for r in results}
+        self.assertEqual(status, {"missing-model": "failed", "regression-checkpoint": "ok",
+                                  "regression-graphdef": "ok"})
+        for r in results:
+            if r["status"] == "ok":
+                self.assertTrue(os.path.exists(jobs[r["name"]]["output"]))
+                self.assertGreater(r["onnx_nodes"], 0)
+                self.assertEqual(r["output_size"], os.path.getsize(jobs[r["name"]]["output"]))
+        summary_path = os.path.join(self.tmp_dir, "summary.csv")
+        batch.save_summary(summary_path, results)
+        with open(summary_path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def test_worker_dies_with_job(self):
+        job = batch.load_manifest(self.manifest, names=["regression-graphdef"])["regression-graphdef"]
+        with batch.WorkerPool(1) as pool:
+            pool.submit(job)
+            # the job is handed to the worker once it is ready, kill it before it can finish
+            deadline = time.time() + 60
+            while not pool._running and time.time() < deadline:  # pylint: disable=protected-access
+                pool.poll(timeout=0.1)
+            worker_id = list(pool._running)[0]  # pylint: disable=protected-access
+            pool._workers[worker_id][0].kill()  # pylint: disable=protected-access
+            results = list(pool.results(1))
+        self.assertEqual(results[0]["name"], "regression-graphdef")
+        self.assertEqual(results[0]["status"], "failed")
+        self.assertIn("worker exited", results[0]["error"])
+
+    def test_worker_death_noticed_between_messages(self):
+        job = batch.load_manifest(self.manifest, names=["regression-graphdef"])["regression-graphdef"]
+        with batch.WorkerPool(1) as pool:
+            pool.submit(job)
+            deadline = time.time() + 60
+            while not pool._running and time.time() < deadline:  # pylint: disable=protected-access
+                pool.poll(timeout=0.1)
+            worker_id = list(pool._running)[0]  # pylint: disable=protected-access
+            proc = pool._workers[worker_id][0]  # pylint: disable=protected-access
+            proc.kill()
+            proc.join()
+            # the dead worker is noticed by a poll that also gets a message
+            with mock.patch.object(pool._result_queue, "get",  # pylint: disable=protected-access
+                                   return_value=("started", -1, "other-job")):
+                events = pool.poll()
+        self.assertEqual([(e, r["name"], r["status"]) for e, r in events], [("done", "regression-graphdef", "failed")])
+
+
+if __name__ == '__main__':
+    unittest.main()
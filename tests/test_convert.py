@@ -76,6 +76,56 @@ class Tf2OnnxConvertTest(unittest.TestCase):
                                        '--output',
                                        'converted_graphdef.onnx']))
 
+    def test_convert_shape_variants(self):
+        """ convert graphdef to a model per input shape """
+        self.assertTrue(run_test_case(['',
+                                       '--input',
+                                       'tests/models/fc-layers/frozen.pb',
+                                       '--inputs',
+                                       'X:0',
+                                       '--outputs',
+                                       'output:0',
+                                       '--shape-variant',
+                                       'X:0[1,784]',
+                                       '--shape-variant',
+                                       'X:0[16,784]',
+                                       '--output',
+                                       'converted_graphdef.onnx'],
+                                      paths_to_check=['converted_graphdef_0.onnx', 'converted_graphdef_1.onnx']))
+
+    def test_convert_shape_variants_signature_def(self):
+        """ convert one signature of a saved model to a model per input shape """
+        self.assertTrue(run_test_case(['',
+                                       '--saved-model',
+                                       'tests/models/saved_model_with_redundant_inputs',
+                                       '--tag',
+                                       'serve',
+                                       '--signature_def',
+                                       'serving_default',
+                                       '--shape-variant',
+                                       'x[1,10]',
+                                       '--shape-variant',
+                                       'x[1,10],y[1,10]',
+                                       '--output',
+                                       'converted_saved_model.onnx'],
+                                      paths_to_check=['converted_saved_model_0.onnx',
+                                                      'converted_saved_model_1.onnx']))
+
+    def test_convert_ort_optimize(self):
+        """ convert graphdef and optimize it with onnxruntime """
+        self.assertTrue(run_test_case(['',
+                                       '--input',
+                                       'tests/models/fc-layers/frozen.pb',
+                                       '--inputs',
+                                       'X:0',
+                                       '--outputs',
+                                       'output:0',
+                                       '--ort-optimize',
+                                       '--ort-format',
+                                       '--output',
+                                       'converted_graphdef.onnx'],
+                                      paths_to_check=['converted_graphdef.onnx', 'converted_graphdef.ort']))
+
     def test_convert_checkpoint(self):
         """ convert checkpoint """
         self.assertTrue(run_test_case(['',
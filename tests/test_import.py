@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+""" Guard against regressions of the tf2onnx import time. """
+
+import os
+import subprocess
+import sys
+import unittest
+
+# generous limit, importing tensorflow alone takes several seconds
+_MAX_IMPORT_TIME = float(os.environ.get("TF2ONNX_MAX_IMPORT_TIME", "3.0"))
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+{}
+elapsed = time.time() - start
+heavy = [m for m in ("tensorflow", "tf2onnx.tfonnx", "tf2onnx.onnx_opset", "tf2onnx.tf_loader") if m in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def import_in_subprocess(statement):
+    """ Run statement in a fresh interpreter, return the time it took and the heavy modules it loaded. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root, env.get("PYTHONPATH", "")])
+    out = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT.format(statement)], env=env)
+    elapsed, _, heavy = out.decode().strip().split("\n")[-1].partition(" ")
+    return float(elapsed), [m for m in heavy.split(",") if m]
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_onnx_only_import(self):
+        elapsed, heavy = import_in_subprocess(
+            "import tf2onnx\n"
+            "from tf2onnx.graph import GraphUtil\n"
+            "from tf2onnx import optimizer, logging\n"
+            "from tf2onnx.late_rewriters import rewrite_channels_last")
+        self.assertEqual(heavy, [])
+        self.assertLess(elapsed, _MAX_IMPORT_TIME)
+
+    def test_lazy_submodule_access(self):
+        _, heavy = import_in_subprocess("import tf2onnx\nassert callable(tf2onnx.tfonnx.process_tf_graph)")
+        self.assertIn("tensorflow", heavy)
+        self.assertIn("tf2onnx.onnx_opset", heavy)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,18 +3,29 @@
 
 """Unit Tests for internal methods."""
 
+import json
+import os
+import tempfile
 from collections import namedtuple
+from unittest import mock
 
 import graphviz as gv
 import numpy as np
+import onnx
 from onnx import TensorProto
 from onnx import helper, numpy_helper
 
 import tensorflow as tf
-from tf2onnx import utils, tf_utils
+from tf2onnx import constants, handler, schemas, utils, tf_utils
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
 from tf2onnx.graph import GraphUtil
+from tf2onnx.conversion_context import ConversionContext
+from tf2onnx.external_data import save_model_with_external_data
+from tf2onnx.graph import Graph
+from tf2onnx.symbolic_executor import SymbolicShapeInference
+from tf2onnx.tensor_store import TensorStore, is_stored
 from tf2onnx.tf_loader import tf_reset_default_graph, tf_session
+from tf2onnx.tfonnx import process_tf_graph
 
 from backend_test_base import Tf2OnnxBackendTestBase
 from common import unittest_main
@@ -254,6 +265,92 @@ class Tf2OnnxInternalTests(Tf2OnnxBackendTestBase):
         self.assertTrue("my_attr" in n1.attr)
         self.assertTrue("my_attr" in n1.get_onnx_attrs())
 
+    def test_schema_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {constants.ENV_TF2ONNX_CACHE_DIR: cache_dir}):
+            path = schemas._schema_cache_path()  # pylint: disable=protected-access
+            self.assertTrue(path.startswith(cache_dir))
+            fresh = schemas._register_all_schemas_with_history()  # pylint: disable=protected-access
+            self.assertTrue(os.path.exists(path))
+            cached = schemas._register_all_schemas_with_history()  # pylint: disable=protected-access
+        self.assertEqual(sorted(fresh.keys()), sorted(cached.keys()))
+        conv = cached["Conv"][constants.ONNX_DOMAIN]
+        self.assertEqual(list(conv.keys()), sorted(conv.keys(), reverse=True))
+        self.assertTrue(conv[1].has_attribute("kernel_shape"))
+        self.assertFalse(conv[1].has_attribute("my_attr"))
+
+        self.assertEqual(schemas.get_schema("Conv", 10).since_version, 1)
+        self.assertEqual(schemas.get_schema("Resize", 12).since_version, 11)
+        self.assertIsNone(schemas.get_schema("Resize", 9))
+        self.assertIsNone(schemas.get_schema("NotAnOp", 13))
+        self.assertIs(schemas.get_schema("Conv", 10), schemas.get_schema("Conv", 10))
+
+    def test_atomic_write_json(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache", "data.json")
+            utils.atomic_write_json(path, {"a": [1, 2]})
+            with open(path, "r") as f:
+                self.assertEqual(json.load(f), {"a": [1, 2]})
+            # a failed write leaves no temporary file behind
+            os.makedirs(os.path.join(tmp_dir, "dir.json"))
+            with self.assertRaises(OSError):
+                utils.atomic_write_json(os.path.join(tmp_dir, "dir.json"), {"a": 1})
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["cache", "dir.json"])
+            self.assertEqual(os.listdir(os.path.join(tmp_dir, "cache")), ["data.json"])
+
+    def test_ops_mapping_cache(self):
+        ms_opset = [utils.make_opsetid(constants.MICROSOFT_DOMAIN, 1)]
+        mapping = handler.tf_op.create_mapping(12, ms_opset)
+        self.assertIs(mapping, handler.tf_op.create_mapping(12, [utils.make_opsetid(constants.MICROSOFT_DOMAIN, 1)]))
+        self.assertIsNot(mapping, handler.tf_op.create_mapping(12, None))
+        self.assertIsNot(mapping, handler.tf_op.create_mapping(13, ms_opset))
+        self.assertIn("Conv2D", mapping)
+        self.assertIs(mapping.find_effective_op("Conv2D"), mapping["Conv2D"])
+        self.assertIsNone(mapping.find_effective_op("Conv2D", "not.a.domain"))
+        with self.assertRaises(TypeError):
+            mapping["Conv2D"] = None  # pylint: disable=unsupported-assignment-operation
+        custom = mapping.updated({"MyOp": (None, {})})
+        self.assertIn("MyOp", custom)
+        self.assertNotIn("MyOp", mapping)
+
+    def test_custom_op_handler_in_rewriter(self):
+        # conv2d_with_pad_rewriter converts the Conv2D with the handler of the conversion, a custom one here
+        converted = []
+
+        def conv2d_handler(ctx, node, name, args):  # pylint: disable=unused-argument
+            converted.append(name)
+            node.type = "MyConv"
+            node.domain = "my.domain"
+
+        with tf_session() as sess:
+            x = tf.compat.v1.placeholder(tf.float32, [1, 5, 5, 1], name="input")
+            x_pad = tf.pad(x, paddings=[[0, 0], [2, 2], [2, 2], [0, 0]])
+            kernel = tf.constant(np.ones([3, 3, 1, 2], dtype=np.float32))
+            tf.identity(tf.nn.conv2d(x_pad, kernel, strides=[1, 1, 1, 1], padding="VALID"), name="output")
+            g = process_tf_graph(sess.graph, opset=self.config.opset, input_names=["input:0"],
+                                 output_names=["output:0"], custom_op_handlers={"Conv2D": (conv2d_handler, [])})
+        self.assertEqual(len(converted), 1)
+        self.assertEqual([n.type for n in g.get_nodes() if n.domain == "my.domain"], ["MyConv"])
+        self.assertNotIn("Pad", [n.type for n in g.get_nodes()])
+
+    def test_custom_op_handler_not_registered(self):
+        # a custom handler is only used by its conversion, the handlers of later conversions are unchanged
+        def identity_handler(ctx, node, name, args):  # pylint: disable=unused-argument
+            node.type = "MyIdentity"
+            node.domain = "my.domain"
+
+        mapping = handler.tf_op.create_mapping(self.config.opset, None)
+        with tf_session() as sess:
+            x = tf.compat.v1.placeholder(tf.float32, [2, 3], name="input")
+            tf.identity(x, name="output")
+            g = process_tf_graph(sess.graph, opset=self.config.opset, input_names=["input:0"],
+                                 output_names=["output:0"], custom_op_handlers={"Identity": (identity_handler, [])})
+            self.assertIn("MyIdentity", [n.type for n in g.get_nodes()])
+            g = process_tf_graph(sess.graph, opset=self.config.opset, input_names=["input:0"],
+                                 output_names=["output:0"])
+            self.assertNotIn("MyIdentity", [n.type for n in g.get_nodes()])
+        self.assertIs(handler.tf_op.create_mapping(self.config.opset, None), mapping)
+
     def test_tensor_data(self):
         tensors = {
             "empty_tensor": np.array([], dtype=np.float32),
@@ -285,6 +382,162 @@ class Tf2OnnxInternalTests(Tf2OnnxBackendTestBase):
 
             self.assertTrue(np.array_equal(expected, actual))
 
+    def test_tflist_to_onnx_tensor_content(self):
+        tensors = {
+            "float": np.random.random_sample([64, 8]).astype(np.float32),
+            "half": np.random.random_sample([64, 16]).astype(np.float16),
+            "int64": np.arange(300, dtype=np.int64).reshape([3, 100]),
+            "bool": np.random.random_sample([2000]) > 0.5,
+            "small": np.array([1, 2], dtype=np.int32),
+            "string": np.array([b"a", b"bc"]),
+        }
+        with tf.Graph().as_default() as graph:
+            for n, data in tensors.items():
+                tf.constant(data, name=n)
+        graph_def = graph.as_graph_def()
+        compressed_graph_def = graph.as_graph_def()
+        # with compress_graph_def the values come from outside the graph, as for large models
+        const_node_values = tf_utils.compress_graph_def(compressed_graph_def)
+        for graph_def, const_node_values in [(graph_def, None), (compressed_graph_def, const_node_values)]:
+            with tf.Graph().as_default() as tf_graph:
+                tf.import_graph_def(graph_def, name="")
+            onnx_nodes, _, attr_cnt, _, _, _ = tf_utils.tflist_to_onnx(tf_graph, {}, const_node_values)
+            self.assertEqual(attr_cnt["value"], len(tensors))
+            for node in onnx_nodes:
+                attr = {a.name: a for a in node.attribute}
+                actual = numpy_helper.to_array(attr["value"].t)
+                self.assertEqual(attr["value"].t.name, node.name + ":0")
+                if node.name == "string":
+                    self.assertEqual(actual.tolist(), ["a", "bc"])
+                else:
+                    self.assertEqual(actual.dtype, tensors[node.name].dtype)
+                    self.assertTrue(np.array_equal(actual, tensors[node.name]))
+
+    def test_external_data_writer(self):
+        w1 = np.random.random_sample([64, 64]).astype(np.float32)
+        w2 = np.random.random_sample([64, 64]).astype(np.float32)
+        b = np.random.random_sample([64]).astype(np.float32)
+        graph_proto = helper.make_graph(
+            nodes=[helper.make_node("Add", ["input", "w1"], ["n1:0"], name="n1"),
+                   helper.make_node("Mul", ["n1:0", "w2"], ["n2:0"], name="n2"),
+                   helper.make_node("Add", ["n2:0", "b"], ["n3:0"], name="n3")],
+            name="test",
+            inputs=[helper.make_tensor_value_info("input", TensorProto.FLOAT, [64, 64])],
+            outputs=[helper.make_tensor_value_info("n3:0", TensorProto.FLOAT, [64, 64])],
+            initializer=[numpy_helper.from_array(w1, "w1"), numpy_helper.from_array(w2, "w2"),
+                         numpy_helper.from_array(b, "b")])
+        x = np.random.random_sample([64, 64]).astype(np.float32)
+        os.makedirs(self.test_data_directory, exist_ok=True)
+        # one tensor per shard since a second one doesn't fit behind the first
+        for max_shard_size, expected_files in [(None, ["model.data"]), (20000, ["model.0.data", "model.1.data"])]:
+            g = GraphUtil.create_graph_from_onnx_graph(graph_proto)
+            g.set_config(opset=self.config.opset)
+            model_path = os.path.join(self.test_data_directory, "model.onnx")
+            model_proto, writer = save_model_with_external_data(model_path, g, "test", max_shard_size)
+            self.assertEqual(writer.locations, expected_files)
+            self.assertEqual(writer.name_to_tensor_data, {})
+            external = [t for t in model_proto.graph.initializer if t.data_location == TensorProto.EXTERNAL]
+            self.assertEqual(len(external), 2)
+            for t in external:
+                info = {e.key: e.value for e in t.external_data}
+                self.assertEqual(int(info["offset"]) % 4096, 0)
+                self.assertEqual(int(info["length"]), w1.nbytes)
+            # the model loads without any unpacking
+            loaded = {t.name: numpy_helper.to_array(t) for t in onnx.load(model_path).graph.initializer}
+            self.assertEqual(len(loaded), 3)
+            output_name = model_proto.graph.output[0].name
+            actual = self.run_onnxruntime(model_path, {"input": x}, [output_name])
+            self.assertAllClose((x + w1) * w2 + b, actual[0], rtol=1e-6)
+            # the graph keeps its values
+            np.testing.assert_array_equal(g.get_tensor_value("w1", as_list=False), w1)
+        # strings have no raw data, they stay in the model however large they are
+        strings = np.array(["s{}".format(i) for i in range(2000)], dtype=object)
+        graph_proto = helper.make_graph(
+            nodes=[helper.make_node("Identity", ["strings"], ["n1:0"], name="n1")],
+            name="test", inputs=[],
+            outputs=[helper.make_tensor_value_info("n1:0", TensorProto.STRING, [2000])],
+            initializer=[numpy_helper.from_array(strings, "strings")])
+        g = GraphUtil.create_graph_from_onnx_graph(graph_proto)
+        g.set_config(opset=self.config.opset)
+        model_proto, writer = save_model_with_external_data(model_path, g, "test")
+        self.assertEqual(writer.locations, [])
+        loaded = onnx.load(model_path).graph.initializer
+        self.assertEqual(loaded[0].data_location, TensorProto.DEFAULT)
+        np.testing.assert_array_equal(numpy_helper.to_array(loaded[0]), strings)
+
+    def test_tensor_store(self):
+        w = np.random.random_sample([64, 64]).astype(np.float32)
+        b = np.random.random_sample([64]).astype(np.float32)
+        x = np.random.random_sample([64, 64]).astype(np.float32)
+        store = TensorStore(threshold=1024)
+        with ConversionContext(tensor_store=store).activate():
+            g = Graph([], opset=self.config.opset)
+            g.add_graph_input("input", TensorProto.FLOAT, [64, 64])
+            const_w = g.make_const("w", w)
+            const_b = g.make_const("b", b)
+            # only w is large enough for the store
+            self.assertTrue(is_stored(const_w.get_attr("value").t))
+            self.assertFalse(is_stored(const_b.get_attr("value").t))
+            self.assertIsInstance(const_w.get_tensor_value(as_list=False), np.memmap)
+            self.assertAllClose(const_w.get_tensor_value(as_list=False), w)
+            const_w.set_tensor_value(w * 2)
+            self.assertTrue(is_stored(const_w.get_attr("value").t))
+            self.assertEqual(store.bytes_stored, 2 * w.nbytes)
+            mul = g.make_node("MatMul", ["input", "w"])
+            add = g.make_node("Add", [mul.output[0], "b"])
+            g.add_graph_output(add.output[0], TensorProto.FLOAT, [64, 64])
+            model_proto = g.make_model("test")
+        # the model holds the data, the graph the handle
+        for t in model_proto.graph.initializer:
+            self.assertFalse(is_stored(t))
+        self.assertTrue(is_stored(const_w.get_attr("value").t))
+        model_path = os.path.join(self.test_data_directory, "tensor_store.onnx")
+        utils.save_protobuf(model_path, model_proto)
+        store.close()
+        self.assertFalse(os.path.exists(store.path))
+        actual = self.run_onnxruntime(model_path, {"input": x}, [add.output[0]])
+        self.assertAllClose(x @ (w * 2) + b, actual[0], rtol=1e-5)
+
+    def test_symbolic_shape_inference(self):
+        w = np.random.random_sample([8, 4]).astype(np.float32)
+        nodes = [
+            helper.make_node("Flatten", ["X"], ["flat"], axis=2),
+            helper.make_node("Shape", ["X"], ["shape"]),
+            helper.make_node("Reshape", ["flat", "shape"], ["unflat"]),
+            helper.make_node("MatMul", ["unflat", "W"], ["mm"]),
+            helper.make_node("Transpose", ["mm"], ["Y"], perm=[1, 0, 2]),
+        ]
+        graph_proto = helper.make_graph(
+            nodes, "test",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, ["batch", "seq", 8])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [None, None, None])],
+            initializer=[numpy_helper.from_array(w, "W")])
+        g = GraphUtil.create_graph_from_onnx_graph(graph_proto, opset_version=self.config.opset)
+        symbolic = SymbolicShapeInference(g)
+        self.assertEqual({"batch", "seq"}, symbolic.dim_params)
+        self.assertEqual([None, 8], symbolic.get_dim_params("flat"))
+        self.assertEqual("1*batch*seq", str(symbolic.get_shape("flat")[0]))
+        self.assertEqual(["batch", "seq", 8], symbolic.get_dim_params("unflat"))
+        self.assertEqual(["seq", "batch", 4], symbolic.get_dim_params("Y"))
+        # the graph outputs share the dim_params of the inputs
+        model_proto = g.make_model("test")
+        self.assertEqual(["batch", "seq", 8], [d.dim_param or d.dim_value for d in
+                                              model_proto.graph.input[0].type.tensor_type.shape.dim])
+        self.assertEqual(["seq", "batch"], [d.dim_param for d in
+                                            model_proto.graph.output[0].type.tensor_type.shape.dim][:2])
+
+    def test_make_model_static_inputs(self):
+        graph_proto = helper.make_graph(
+            [helper.make_node("Abs", ["X"], ["Y"])], "test",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [2, 3])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [2, 3])])
+        g = GraphUtil.create_graph_from_onnx_graph(graph_proto, opset_version=self.config.opset)
+        # there are no dynamic dims to name, symbolic shape inference is skipped
+        with mock.patch("tf2onnx.graph.SymbolicShapeInference") as symbolic:
+            model_proto = g.make_model("test")
+        symbolic.assert_not_called()
+        self.assertEqual([2, 3], [d.dim_value for d in model_proto.graph.output[0].type.tensor_type.shape.dim])
+
 
 if __name__ == '__main__':
     unittest_main()
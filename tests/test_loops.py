@@ -8,7 +8,9 @@ import tensorflow as tf
 
 from backend_test_base import Tf2OnnxBackendTestBase
 from common import unittest_main, check_tf_min_version, check_tf_max_version, check_onnxruntime_min_version
-from tf2onnx.tf_loader import is_tf2
+from tf2onnx import optimizer
+from tf2onnx.tf_loader import is_tf2, from_function
+from tf2onnx.tfonnx import process_tf_graph
 
 
 # pylint: disable=missing-docstring,invalid-name,unused-argument,using-constant-test
@@ -297,6 +299,37 @@ class LoopTests(Tf2OnnxBackendTestBase):
         output_names_with_port = ["output:0"]
         self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, rtol=1e-06)
 
+    @check_tf_min_version("2.0")
+    def test_nested_while_loop_with_cond_jobs(self):
+        feed_dict = {_INPUT: np.ones([2, 3], dtype=np.float32), _INPUT1: np.array(4, dtype=np.int32)}
+        self.run_test_case(_nested_while_loop_with_cond, feed_dict, [], [_OUTPUT], process_args={"jobs": 2})
+
+    @check_tf_min_version("2.0")
+    def test_jobs_deterministic(self):
+        concrete_func = tf.function(_nested_while_loop_with_cond).get_concrete_function(
+            tf.TensorSpec([None, 3], tf.float32, name=_TFINPUT), tf.TensorSpec([], tf.int32, name=_TFINPUT1))
+        graph_def = from_function(concrete_func, [_INPUT, _INPUT1], [_OUTPUT])
+        models = []
+        for jobs in [1, 2, 3]:
+            with tf.Graph().as_default() as tf_graph:
+                tf.import_graph_def(graph_def, name="")
+                g = process_tf_graph(tf_graph, opset=self.config.opset, input_names=[_INPUT, _INPUT1],
+                                     output_names=[_OUTPUT], jobs=jobs)
+                g = optimizer.optimize_graph(g)
+                models.append(g.make_graph("test").SerializeToString())
+        # the names made by the workers are replaced by the names a conversion without workers makes
+        self.assertEqual(models[0], models[1])
+        self.assertEqual(models[0], models[2])
+
+
+def _nested_while_loop_with_cond(x, n):
+    def body(i, acc):
+        acc = tf.cond(tf.reduce_sum(acc) > 10., lambda: acc * 0.5, lambda: acc + x)
+        _, acc = tf.while_loop(lambda j, a: j < 2, lambda j, a: (j + 1, a + 1.), [tf.constant(0), acc])
+        return i + 1, acc
+    _, acc = tf.while_loop(lambda i, acc: i < n, body, [0, tf.zeros_like(x)])
+    r = tf.cond(n > 2, lambda: acc * 2., lambda: acc - 1.)
+    return tf.identity(r, name=_TFOUTPUT)
 
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+""" Guard against regressions of the memory used to convert large models. """
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# memory the conversion may use on top of the loaded graph, as a fraction of the size of the weights
+_MEMORY_CAP = float(os.environ.get("TF2ONNX_TEST_MEMORY_CAP", "0.5"))
+
+_CONVERT_SCRIPT = """
+import json, os, sys, tempfile, threading, time
+import numpy as np
+import tensorflow as tf
+import onnxruntime as ort
+from tf2onnx.convert import _convert_common
+
+def rss_anon():
+    # memory mapped files are not counted, the kernel can drop their pages at any time
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def convert(weights, output_path):
+    with tf.Graph().as_default() as tf_graph:
+        x = tf.compat.v1.placeholder(tf.float32, [1, weights[0].shape[0]], name="input")
+        y = x
+        for w in weights:
+            y = tf.matmul(y, tf.constant(w))
+        tf.identity(y, name="output")
+    graph_def = tf_graph.as_graph_def()
+    del tf_graph, x, y
+    peak = [0]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], rss_anon())
+            time.sleep(0.002)
+
+    start = rss_anon()
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        _convert_common(graph_def, input_names=["input:0"], output_names=["output:0"], opset=13,
+                        large_model=True, mmap_tensors=True, output_path=output_path)
+    finally:
+        done.set()
+        sampler.join()
+    return peak[0] - start
+
+rng = np.random.RandomState(1)
+tmp = tempfile.mkdtemp()
+# load everything a conversion needs before measuring
+convert([np.ones((4, 4), np.float32)], os.path.join(tmp, "small.onnx"))
+weights = [rng.uniform(-1, 1, ({size}, {size})).astype(np.float32) / {size} for _ in range({num_weights})]
+used = convert(weights, os.path.join(tmp, "large.onnx"))
+
+x = rng.uniform(-1, 1, (1, {size})).astype(np.float32)
+expected = x
+for w in weights:
+    expected = expected @ w
+got, = ort.InferenceSession(os.path.join(tmp, "large.onnx")).run(None, {{"input:0": x}})
+print(json.dumps({{"weights": sum(w.nbytes for w in weights), "used": used,
+                   "error": float(np.abs(got - expected).max() / np.abs(expected).max())}}))
+"""
+
+
+def convert_in_subprocess(num_weights, size):
+    """ Convert a model with num_weights float matrices of size x size in a fresh interpreter. Returns the size of
+    the weights, the memory the conversion used and the relative error of the converted model. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root, env.get("PYTHONPATH", "")])
+    script = _CONVERT_SCRIPT.format(num_weights=num_weights, size=size)
+    out = subprocess.check_output([sys.executable, "-c", script], env=env)
+    result = json.loads(out.decode().strip().split("\n")[-1])
+    return result["weights"], result["used"], result["error"]
+
+
+class MemoryTests(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.exists("/proc/self/status"), "needs /proc to measure memory")
+    def test_mmap_tensors_memory_cap(self):
+        # 256MB of weights
+        weights, used, error = convert_in_subprocess(16, 2048)
+        self.assertLess(error, 1e-4)
+        self.assertLess(used, weights * _MEMORY_CAP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,15 +3,21 @@
 
 """Unit Tests for optimizers such as TransposeOptimizer."""
 
+import gc
+import re
 import unittest
+from unittest import mock
+from collections import OrderedDict
 import numpy as np
 from onnx import helper, numpy_helper, TensorProto, OperatorSetIdProto
 from parameterized import parameterized
 
 from backend_test_base import Tf2OnnxBackendTestBase
 from common import unittest_main, group_nodes_by_type, check_opset_min_version, check_opset_max_version, get_test_config
-from tf2onnx import utils, constants
-from tf2onnx.graph import GraphUtil
+from tf2onnx import utils, constants, optimizer
+from tf2onnx.graph import GraphUtil, Node
+from tf2onnx.optimizer.back_to_back_optimizer import BackToBackOptimizer
+from tf2onnx.symbolic_executor import SymbolicShapeInference
 
 
 # pylint: disable=missing-docstring,invalid-name,unused-argument,using-constant-test
@@ -74,6 +80,44 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
             pass
         return model_proto
 
+    def test_optimize_graph_frees_copies(self):
+        # the graph is copied for every optimizer, the copies must not wait for the garbage collector
+        then_graph = helper.make_graph([helper.make_node("Abs", ["X"], ["then_out"])], "then_graph", [],
+                                       [helper.make_tensor_value_info("then_out", TensorProto.FLOAT, [2, 3])])
+        else_graph = helper.make_graph([helper.make_node("Neg", ["X"], ["else_out"])], "else_graph", [],
+                                       [helper.make_tensor_value_info("else_out", TensorProto.FLOAT, [2, 3])])
+        node1 = helper.make_node("Transpose", ["X"], ["Y"], perm=[1, 0], name="trans_1")
+        node2 = helper.make_node("Transpose", ["Y"], ["Z"], perm=[1, 0], name="trans_2")
+        node3 = helper.make_node("If", ["cond"], ["res"], then_branch=then_graph, else_branch=else_graph)
+        node4 = helper.make_node("Add", ["Z", "res"], ["out"])
+        graph = helper.make_graph(
+            [node1, node2, node3, node4],
+            "test_optimize_graph_frees_copies",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [2, 3]),
+             helper.make_tensor_value_info("cond", TensorProto.BOOL, [])],
+            [helper.make_tensor_value_info("out", TensorProto.FLOAT, [2, 3])],
+        )
+        g = GraphUtil.create_graph_from_onnx_model(self.make_model(graph))
+
+        def count_nodes():
+            return sum(isinstance(o, Node) for o in gc.get_objects())
+
+        gc.collect()
+        gc.disable()
+        try:
+            before = count_nodes()
+            new_graph = optimizer.optimize_graph(g)
+            after = count_nodes()
+        finally:
+            gc.enable()
+        # only the nodes of the optimized graph and its branches are left
+        branches = new_graph.contained_graphs[new_graph.get_node_by_output("res").name].values()
+        self.assertEqual(after - before, len(new_graph.get_nodes()) + sum(len(b.get_nodes()) for b in branches))
+        self.assertEqual(0, new_graph.dump_node_statistics()["Transpose"])
+        # the graph passed in is left intact
+        self.assertEqual(2, g.dump_node_statistics()["Transpose"])
+        self.assertIs(g, g.get_node_by_name("trans_1").graph)
+
     # Tranpose Optimizer Tests Start
 
     def run_transpose_compare(self, output_names_with_port, onnx_feed_dict, origin_proto,
@@ -1383,6 +1427,21 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
         self.run_transpose_compare(["Y"], {"X": np.random.randn(*input_shape_np).astype(np.float32)},
                                    model_proto, remaining_transpose_num=0)
 
+    def test_trans_can_be_replaced_with_reshape_dynamic(self):
+        # the unknown dim that stays in place is copied with 0, so the new shape is a const
+        node1 = helper.make_node("Transpose", ["X"], ["Y"], perm=[0, 2, 1, 3], name="trans")
+        graph = helper.make_graph(
+            [node1],
+            "test_trans_can_be_replaced_with_reshape_dynamic",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, None, 1, 5])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [None, 1, None, 5])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        new_proto = self.run_transpose_compare(["Y"], {"X": np.random.randn(2, 3, 1, 5).astype(np.float32)},
+                                               model_proto, remaining_transpose_num=0)
+        self.assertEqual(["Reshape"], [n.op_type for n in new_proto.graph.node])
+
     @parameterized.expand([
         ((1, 6, 8), [2, 0, 1], [1, 2, 0]),
         ((1, 6, 8, 9), [0, 2, 3, 1], [0, 3, 1, 2]),
@@ -1834,6 +1893,45 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
         self.run_and_compare(["Y"], {"X": np.random.randn(*x_shape).astype(np.float32)},
                              model_proto, op_type="Shape", remaining_op_num=0)
 
+    @check_opset_max_version(12, "Unsqueeze changed in opset 13")
+    def test_reshape_opt_shape_of_other_tensor(self):
+        # the shape of Y has the same symbolic dims as X
+        node0 = helper.make_node("Relu", ["X"], ["Y"])
+        node1 = helper.make_node("Shape", ["Y"], ["S"])
+        node2 = self._make_onnx_const(np.array([0, 1], np.int64), "indices")
+        node3 = self._make_onnx_const(np.array([2, 2], np.int64), "two_two")
+        node4 = helper.make_node("Gather", ["S", "indices"], ["dims01"])
+        node5 = helper.make_node("Concat", ["dims01", "two_two"], ["shape"], axis=0)
+        node6 = helper.make_node("Reshape", ["X", "shape"], ["R"])
+        node7 = helper.make_node("Add", ["R", "R"], ["Z"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2, node3, node4, node5, node6, node7],
+            "test_reshape_opt_shape_of_other_tensor",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, None, 4])],
+            [helper.make_tensor_value_info("Z", TensorProto.FLOAT, [None, None, 2, 2])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        self.run_and_compare(["Z"], {"X": np.random.randn(3, 5, 4).astype(np.float32)},
+                             model_proto, op_type="Shape", remaining_op_num=0)
+
+    def test_reshape_opt_noop_expand(self):
+        node0 = helper.make_node("Shape", ["X"], ["S"])
+        node1 = helper.make_node("Expand", ["X", "S"], ["E"])
+        node2 = helper.make_node("Add", ["E", "X"], ["Y"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2],
+            "test_reshape_opt_noop_expand",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, 3])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [None, 3])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        self.run_and_compare(["Y"], {"X": np.random.randn(5, 3).astype(np.float32)},
+                             model_proto, op_type="Expand", remaining_op_num=0)
+
     # Reshape Optimizer Tests End
 
     # Const Fold Optimizer Tests Start
@@ -2063,6 +2161,108 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
 
     # Const Fold Optimizer Tests End
 
+    # Shape Fold Optimizer Tests Start
+
+    @check_opset_max_version(12, "Unsqueeze changed in opset 13")
+    def test_shape_fold_static_shape(self):
+        node0 = helper.make_node("Shape", ["X"], ["S"])
+        node1 = self._make_onnx_const(np.array(1, np.int64), "idx")
+        node2 = self._make_onnx_const(np.array([-1], np.int64), "minus_one")
+        node3 = helper.make_node("Gather", ["S", "idx"], ["dim1"])
+        node4 = helper.make_node("Unsqueeze", ["dim1"], ["dim1_unsq"], axes=[0])
+        node5 = helper.make_node("Concat", ["minus_one", "dim1_unsq"], ["shape"], axis=0)
+        node6 = helper.make_node("Reshape", ["X", "shape"], ["Y"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2, node3, node4, node5, node6],
+            "test_shape_fold_static_shape",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [2, 3, 4])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [8, 3])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        new_proto = self.run_and_compare(["Y"], {"X": np.random.randn(2, 3, 4).astype(np.float32)},
+                                         model_proto, op_type="Shape", remaining_op_num=0)
+        self.assertEqual(["Reshape"], [n.op_type for n in new_proto.graph.node])
+
+    def test_shape_fold_partial_shape(self):
+        node0 = helper.make_node("Shape", ["X"], ["S"])
+        node1 = self._make_onnx_const(np.array(2, np.int64), "idx")
+        node2 = helper.make_node("Gather", ["S", "idx"], ["dim2"])
+        node3 = helper.make_node("Cast", ["dim2"], ["dim2_float"], to=TensorProto.FLOAT)
+        node4 = helper.make_node("Mul", ["X", "dim2_float"], ["Y"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2, node3, node4],
+            "test_shape_fold_partial_shape",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, 3, 4])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [None, 3, 4])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        new_proto = self.run_and_compare(["Y"], {"X": np.random.randn(5, 3, 4).astype(np.float32)},
+                                         model_proto, op_type="Shape", remaining_op_num=0)
+        self.assertEqual(["Mul"], [n.op_type for n in new_proto.graph.node])
+
+    @check_opset_min_version(11, "Range")
+    def test_shape_fold_size_arithmetic(self):
+        node0 = helper.make_node("Shape", ["X"], ["S"])
+        node1 = helper.make_node("Size", ["X"], ["size"])
+        node2 = self._make_onnx_const(np.array(1, np.int64), "one")
+        node3 = self._make_onnx_const(np.array(0, np.int64), "zero")
+        node4 = helper.make_node("Gather", ["S", "one"], ["dim1"])
+        node5 = helper.make_node("Div", ["size", "dim1"], ["size_div"])
+        node6 = helper.make_node("Sub", ["size_div", "dim1"], ["limit"])
+        node7 = helper.make_node("Range", ["zero", "limit", "one"], ["range"])
+        node8 = helper.make_node("Cast", ["range"], ["range_float"], to=TensorProto.FLOAT)
+        node9 = helper.make_node("Add", ["X", "range_float"], ["Y"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2, node3, node4, node5, node6, node7, node8, node9],
+            "test_shape_fold_size_arithmetic",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 4, 2])],
+            [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 4, 2])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        new_proto = self.run_and_compare(["Y"], {"X": np.random.randn(3, 4, 2).astype(np.float32)},
+                                         model_proto, op_type="Range", remaining_op_num=0)
+        self.assertEqual(["Add"], [n.op_type for n in new_proto.graph.node])
+
+    @check_opset_min_version(9, "ConstantOfShape")
+    def test_shape_fold_dynamic_shape_unchanged(self):
+        # fold_shapes runs in the default pipeline, shapes that depend on unknown dims are left as they are
+        cast = helper.make_node("Cast", ["dim"], ["dim_float"], to=TensorProto.FLOAT)
+        mul = helper.make_node("Mul", ["X", "dim_float"], ["Y"])
+        models = {
+            "constant_of_shape": ([helper.make_node("Shape", ["X"], ["S"]),
+                                   helper.make_node("ConstantOfShape", ["S"], ["ones"],
+                                                    value=helper.make_tensor("value", TensorProto.FLOAT, [1], [1])),
+                                   helper.make_node("Add", ["X", "ones"], ["Y"])], [None, None]),
+            "size": ([helper.make_node("Size", ["X"], ["dim"]), cast, mul], [None, 4]),
+            "gather_unknown_dim": ([helper.make_node("Shape", ["X"], ["S"]),
+                                    self._make_onnx_const(np.array(0, np.int64), "idx"),
+                                    helper.make_node("Gather", ["S", "idx"], ["dim"]), cast, mul], [None, 3, 4]),
+        }
+        default_optimizers = optimizer._get_optimizers()  # pylint: disable=protected-access
+        without_fold_shapes = OrderedDict((k, v) for k, v in default_optimizers.items() if k != "fold_shapes")
+        for name, (nodes, shape) in models.items():
+            graph = helper.make_graph(nodes, "test_shape_fold_dynamic_shape_unchanged_" + name,
+                                      [helper.make_tensor_value_info("X", TensorProto.FLOAT, shape)],
+                                      [helper.make_tensor_value_info("Y", TensorProto.FLOAT, shape)])
+            model_proto = self.make_model(graph, producer_name="onnx-tests")
+            graphs = []
+            for optimizers in [None, without_fold_shapes]:
+                new_proto = GraphUtil.optimize_model_proto(model_proto, catch_errors=False, optimizers=optimizers)
+                # the indices of the generated names differ
+                indices = {}
+                graphs.append(re.sub(r"__(\d+)", lambda m: "__#{}".format(indices.setdefault(m.group(1), len(indices))),
+                                     str(new_proto.graph)))
+            with self.subTest(name):
+                self.assertEqual(graphs[0], graphs[1])
+
+    # Shape Fold Optimizer Tests End
+
     # Const Dequantize Optimizer Tests Start
 
     @check_opset_min_version(10, "DequantizeLinear")
@@ -2165,6 +2365,47 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
         model_proto = self.make_model(graph, producer_name="onnx-tests")
         self.run_and_compare(["Z"], {}, model_proto, "Transpose", 0)
 
+    def _make_const_cast_float16_model(self, x_val):
+        inputval = numpy_helper.from_array(x_val, name='X')
+        node1 = helper.make_node("Cast", ["X"], ["Y"], name="cast", to=TensorProto.FLOAT)
+        node2 = helper.make_node("Transpose", ["Y"], ["Z"], perm=[2, 0, 1], name="transpose")
+        node3 = helper.make_node("Add", ["Z", "U"], ["res"], name="add")
+
+        graph = helper.make_graph(
+            [node1, node2, node3],
+            "const-dequantize-test",
+            [helper.make_tensor_value_info("U", TensorProto.FLOAT, (4, 2, 3))],
+            [helper.make_tensor_value_info("res", TensorProto.FLOAT, (4, 2, 3))],
+            [inputval]
+        )
+        return self.make_model(graph, producer_name="onnx-tests")
+
+    def test_const_cast_float16_transpose(self):
+        x_val = np.random.random_sample((2, 3, 4)).astype(np.float16)
+        u_val = np.random.random_sample((4, 2, 3)).astype(np.float32)
+        model_proto = self._make_const_cast_float16_model(x_val)
+        # a Cast of a float16 const is folded like any other
+        new_proto = self.run_and_compare(["res"], {"U": u_val}, model_proto, "Transpose", 0)
+        self.assertEqual(0, GraphUtil.get_node_count_from_onnx_graph(new_proto.graph)["Cast"])
+        self.assertEqual([TensorProto.FLOAT], [t.data_type for t in new_proto.graph.initializer])
+
+    def test_compact_weight_cast_transpose(self):
+        x_val = np.random.random_sample((2, 3, 4)).astype(np.float16)
+        u_val = np.random.random_sample((4, 2, 3)).astype(np.float32)
+        model_proto = self._make_const_cast_float16_model(x_val)
+        graph = GraphUtil.create_graph_from_onnx_model(model_proto)
+        graph.get_node_by_name("cast").compact_weight = True
+        graph = GraphUtil.optimize_graph(graph, catch_errors=False)
+        new_proto = graph.make_model("test")
+        # the weight stays float16 and the transpose is folded into its data
+        counts = GraphUtil.get_node_count_from_onnx_graph(new_proto.graph)
+        self.assertEqual(1, counts["Cast"])
+        self.assertEqual(0, counts["Transpose"])
+        self.assertEqual([TensorProto.FLOAT16], [t.data_type for t in new_proto.graph.initializer])
+        new_model_path = self.save_onnx_model(new_proto, {"U": u_val}, postfix="_opt")
+        actual = self.run_onnxruntime(new_model_path, {"U": u_val}, ["res"])
+        self.assertAllClose(np.transpose(x_val.astype(np.float32), [2, 0, 1]) + u_val, actual[0])
+
     # Const Dequantize Optimizer Tests End
 
     def test_transpose_back_to_back_non_const(self):
@@ -2185,6 +2426,49 @@ class OptimizerTests(Tf2OnnxBackendTestBase):
         self.run_transpose_compare(["res"], {"u": np.random.randn(5, 5, 5, 5).astype(np.float32)},
                                    model_proto, remaining_transpose_num=1)
 
+    @parameterized.expand([
+        ([0, 2, 3], [0, 3, 2], 1),  # the 0s copy the same dim
+        ([-1, 4], [0, 2, 2], 2),  # the 0 copies a dim of the first reshape only
+    ])
+    def test_reshape_back_to_back(self, shape1, shape2, remaining_reshape_num):
+        node0 = self._make_onnx_const(np.array(shape1, np.int64), "shape1")
+        node1 = self._make_onnx_const(np.array(shape2, np.int64), "shape2")
+        node2 = helper.make_node("Reshape", ["X", "shape1"], ["Y"])
+        node3 = helper.make_node("Reshape", ["Y", "shape2"], ["Z"])
+
+        graph = helper.make_graph(
+            [node0, node1, node2, node3],
+            "test_reshape_back_to_back",
+            [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, 6])],
+            [helper.make_tensor_value_info("Z", TensorProto.FLOAT, [None, None, None])],
+        )
+
+        model_proto = self.make_model(graph, producer_name="onnx-tests")
+        self.run_and_compare(["Z"], {"X": np.random.randn(2, 6).astype(np.float32)}, model_proto,
+                             "Reshape", remaining_reshape_num)
+
+    def test_reshape_back_to_back_symbolic_once(self):
+        nodes = [self._make_onnx_const(np.array([0, 2, 3], np.int64), "shape1"),
+                 self._make_onnx_const(np.array([0, 3, 2], np.int64), "shape2")]
+        for i in range(2):
+            nodes.append(helper.make_node("Reshape", ["X%d" % i, "shape1"], ["Y%d" % i]))
+            nodes.append(helper.make_node("Reshape", ["Y%d" % i, "shape2"], ["Z%d" % i]))
+
+        graph = helper.make_graph(
+            nodes,
+            "test_reshape_back_to_back_symbolic_once",
+            [helper.make_tensor_value_info("X%d" % i, TensorProto.FLOAT, [None, 6]) for i in range(2)],
+            [helper.make_tensor_value_info("Z%d" % i, TensorProto.FLOAT, [None, None, None]) for i in range(2)],
+        )
+
+        g = GraphUtil.create_graph_from_onnx_graph(graph, opset_version=self.config.opset)
+        # the symbolic shapes are inferred once for both pairs of reshapes
+        with mock.patch("tf2onnx.optimizer.back_to_back_optimizer.SymbolicShapeInference",
+                        wraps=SymbolicShapeInference) as symbolic:
+            g = BackToBackOptimizer().optimize(g, 0)
+        self.assertEqual(symbolic.call_count, 1)
+        self.assertEqual([n.input[0] for n in g.get_nodes() if n.type == "Reshape"], ["X0", "X1"])
+
     #@check_opset_min_version(9, "string type tensor")
     @unittest.skip("temporarily disabled because of issues with ort-nightly")
     def test_cast_back_to_back_non_const_mixed_types(self):
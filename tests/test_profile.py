@@ -2,9 +2,15 @@
 
 
 """Unit Tests for Benchmarks."""
+import importlib
+import json
 import os
 import subprocess
+import sys
+import tempfile
+import numpy as np
 from backend_test_base import Tf2OnnxBackendTestBase
+import perf_harness
 from common import (
     check_opset_min_version, check_tf_min_version,
     unittest_main, check_onnxruntime_min_version
@@ -32,6 +38,65 @@ class ProfileTests(Tf2OnnxBackendTestBase):
             return
         assert b"Profile complete." in outs or outs == b''
 
+    @check_tf_min_version("2.0")
+    def test_benchmark_conversion(self):
+        sys.path.insert(0, ProfileTests.folder)
+        try:
+            benchmark_conversion = importlib.import_module("benchmark_conversion")
+        finally:
+            sys.path.pop(0)
+        with tempfile.TemporaryDirectory() as model_dir:
+            results = benchmark_conversion.benchmark(["regression_graphdef"], self.config.opset, 1, model_dir)
+        result = results["regression_graphdef"]
+        self.assertEqual(list(result["phases"]), benchmark_conversion.PHASES)
+        self.assertAlmostEqual(result["total"], sum(result["phases"].values()))
+        self.assertGreater(result["onnx_nodes"], 0)
+        self.assertGreater(result["model_size"], 0)
+        baseline = json.loads(json.dumps({"models": results}))
+        self.assertEqual([], benchmark_conversion.compare(results, baseline, 0.2, 0.05, 0.01, 0))
+        # fewer nodes and a faster conversion in the baseline
+        baseline["models"]["regression_graphdef"]["onnx_nodes"] -= 1
+        baseline["models"]["regression_graphdef"]["total"] = 0
+        regressions = benchmark_conversion.compare(results, baseline, 0.2, 0, 0.01, 0)
+        self.assertEqual(2, len(regressions))
+        self.assertIn("onnx_nodes", regressions[1])
+        # slowdowns below the minimal delta are noise
+        self.assertEqual(1, len(benchmark_conversion.compare(results, baseline, 0.2, 60, 0.01, 0)))
+
+    def test_perf_harness(self):
+        calls = []
+        config = perf_harness.PerfConfig(duration=0, warmup=3, min_runs=20, batch_sizes=[1, 4], threads=[0])
+        inputs = {"x": np.arange(6).reshape([2, 3]), "n": np.array(2)}
+
+        def make_run(batch):
+            self.assertEqual(batch["n"], 2)
+            return lambda: calls.append(batch["x"].shape[0])
+
+        rows = perf_harness.run_batches("tensorflow", make_run, inputs, config)
+        rows += perf_harness.run_batches("onnxruntime", make_run, inputs, config, threads=0)
+        # a call to check the batch runs, the warm-up and the timed calls
+        self.assertEqual(calls, [1] * 24 + [4] * 24 + [1] * 24 + [4] * 24)
+        self.assertEqual([(r["backend"], r["batch_size"], r["iterations"]) for r in rows],
+                         [("tensorflow", 1, 20), ("tensorflow", 4, 20), ("onnxruntime", 1, 20),
+                          ("onnxruntime", 4, 20)])
+        for row in rows:
+            self.assertTrue(row["min_ms"] <= row["p50_ms"] <= row["p90_ms"] <= row["p99_ms"] <= row["max_ms"])
+        # a tflite model is run by tflite and tensorflow, the speedup over each is reported
+        tflite_rows = perf_harness.run_batches("tflite", make_run, inputs, config)
+        perf_harness.add_speedups(rows[:2] + tflite_rows + rows[2:])
+        self.assertNotIn("speedup_tensorflow", rows[0])
+        self.assertAlmostEqual(rows[2]["speedup_tensorflow"], rows[0]["p50_ms"] / rows[2]["p50_ms"])
+        self.assertAlmostEqual(rows[3]["speedup_tflite"], tflite_rows[1]["p50_ms"] / rows[3]["p50_ms"])
+        np.testing.assert_array_equal(perf_harness.batch_inputs(inputs, 3)["x"], [[0, 1, 2], [3, 4, 5], [0, 1, 2]])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "perf.csv")
+            perf_harness.write_results(path, {"model": rows})
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines[0], ",".join(perf_harness.FIELDS))
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[1].startswith("model,tensorflow,1,,20,"))
+
 
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+""" Test serve.py """
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from tf2onnx.serve import ConversionServer, ConversionClient
+
+
+_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "regression")
+
+
+class Tf2OnnxServeTest(unittest.TestCase):
+    """ test cases for serve.py """
+
+    def test_convert_with_client(self):
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, "tf2onnx.sock")
+        output_path = os.path.join(tmp_dir, "model.onnx")
+
+        async def run():
+            server = ConversionServer(num_workers=1, max_queue=2, output_dir=tmp_dir)
+            await server.start(socket_path=socket_path)
+            try:
+                client = ConversionClient(socket_path=socket_path)
+                events = []
+                async for msg in client.stream(os.path.join(_MODEL_DIR, "graphdef", "frozen.pb"),
+                                               inputs=["X:0"], outputs=["pred:0"], output=output_path):
+                    events.append(msg)
+                # two concurrent jobs, one of them fails to load
+                results = await asyncio.gather(
+                    client.convert(os.path.join(_MODEL_DIR, "checkpoint", "model.meta"), model_type="checkpoint",
+                                   inputs=["X:0"], outputs=["pred:0"]),
+                    client.convert(os.path.join(_MODEL_DIR, "does_not_exist.pb"), inputs=["X:0"],
+                                   outputs=["pred:0"]))
+                return events, results
+            finally:
+                await server.stop()
+
+        events, results = asyncio.run(run())
+        self.assertEqual([e["event"] for e in events], ["queued", "started", "done"])
+        self.assertEqual(events[-1]["result"]["status"], "ok")
+        self.assertTrue(os.path.exists(output_path))
+        self.assertEqual([r["status"] for r in results], ["ok", "failed"])
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, results[0]["name"] + ".onnx")))
+
+    def test_rejected_jobs(self):
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, "tf2onnx.sock")
+        model_path = os.path.join(_MODEL_DIR, "graphdef", "frozen.pb")
+
+        async def run():
+            server = ConversionServer(num_workers=1, output_dir=os.path.join(tmp_dir, "out"))
+            await server.start(socket_path=socket_path)
+            try:
+                client = ConversionClient(socket_path=socket_path)
+                errors = []
+                for options in [{"input_get": "get_ramp"}, {"output": os.path.join(tmp_dir, "model.onnx")},
+                                {"output": "../model.onnx"}]:
+                    with self.assertRaises(RuntimeError) as cm:
+                        await client.convert(model_path, inputs=["X:0"], outputs=["pred:0"], **options)
+                    errors.append(str(cm.exception))
+                return errors
+            finally:
+                await server.stop()
+
+        errors = asyncio.run(run())
+        self.assertIn("unknown job keys ['input_get']", errors[0])
+        self.assertIn("outside of the output directory", errors[1])
+        self.assertIn("outside of the output directory", errors[2])
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, "model.onnx")))
+
+    def test_half_closed_client_waits_idle(self):
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, "tf2onnx.sock")
+        job = {"model": os.path.join(_MODEL_DIR, "graphdef", "frozen.pb"), "inputs": ["X:0"], "outputs": ["pred:0"]}
+
+        async def run():
+            server = ConversionServer(num_workers=1, output_dir=tmp_dir)
+            await server.start(socket_path=socket_path)
+            try:
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                writer.write((json.dumps(job) + "\n").encode())
+                # the client is done sending jobs but still waits for the events of the one it sent
+                writer.write_eof()
+                start, cpu_start = time.time(), time.process_time()
+                events = [json.loads(line) async for line in reader]
+                elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+                writer.close()
+                return events, elapsed, cpu
+            finally:
+                await server.stop()
+
+        events, elapsed, cpu = asyncio.run(run())
+        self.assertEqual([e["event"] for e in events], ["queued", "started", "done"])
+        # the conversion runs in the worker, the server only waits for its events
+        self.assertLess(cpu, 0.1 * elapsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""Unit Tests for TFJS utils."""
+
+import gzip
+import json
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+from onnx import TensorProto
+
+from tf2onnx import optimizer
+from tf2onnx.tfjs_utils import CompactWeight, ShardedBuffer, graphs_from_tfjs, read_tfjs_weights
+from tf2onnx.tfonnx import process_tf_graph
+
+# pylint: disable=missing-docstring
+
+
+def write_tfjs_model(model_dir, groups, shard_size, zip_compressed=False, nodes=None):
+    """Write a model.json with a Const node for each weight followed by the given nodes and the weights of each
+    group in shards of shard_size bytes. groups is a list of lists of (name, numpy array) or (name, quantized numpy
+    array, quantization). Returns the path of model.json."""
+    manifest = []
+    const_nodes = []
+    for group_idx, group in enumerate(groups):
+        data = b''
+        weights = []
+        for name, value, *quantization in group:
+            if value.dtype.kind in "SO":
+                weights.append({"name": name, "shape": list(value.shape), "dtype": "string"})
+                for v in value.flatten():
+                    data += struct.pack('<I', len(v)) + v
+                dtype = "DT_STRING"
+            elif quantization:
+                weights.append({"name": name, "shape": list(value.shape), "dtype": "float32",
+                                "quantization": dict(quantization[0], dtype=value.dtype.name)})
+                data += value.tobytes()
+                dtype = "DT_FLOAT"
+            else:
+                weights.append({"name": name, "shape": list(value.shape), "dtype": value.dtype.name})
+                data += value.tobytes()
+                dtype = {"float32": "DT_FLOAT", "int32": "DT_INT32"}[value.dtype.name]
+            const_nodes.append({"name": name, "op": "Const", "attr": {"dtype": {"type": dtype}}})
+        paths = []
+        for i in range(0, max(len(data), 1), shard_size):
+            path = "group{}-shard{}of{}.bin".format(group_idx + 1, len(paths) + 1, len(data) // shard_size + 1)
+            shard = data[i:i + shard_size]
+            with open(os.path.join(model_dir, path), "wb") as f:
+                f.write(gzip.compress(shard) if zip_compressed else shard)
+            paths.append(path)
+        manifest.append({"paths": paths, "weights": weights})
+    model = {"modelTopology": {"node": const_nodes + list(nodes or [])}, "weightsManifest": manifest}
+    model_path = os.path.join(model_dir, "model.json")
+    with open(model_path, "w") as f:
+        json.dump(model, f)
+    return model_path, model
+
+
+class TFJSUtilsTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.groups = [
+            [("w1", rng.random_sample([3, 5]).astype(np.float32)), ("w2", np.arange(7, dtype=np.int32))],
+            [("s", np.array([b"a", b"bcd", b""])), ("w3", rng.random_sample([10]).astype(np.float32))],
+        ]
+
+    def test_sharded_buffer(self):
+        data = bytes(range(10))
+        buffer = ShardedBuffer([data[:4], data[4:4], data[4:9], data[9:]])
+        self.assertEqual(10, len(buffer))
+        # ranges inside a shard are views of the shard
+        self.assertIsInstance(buffer.read(5, 3), memoryview)
+        self.assertEqual(data[5:8], bytes(buffer.read(5, 3)))
+        self.assertEqual(data[2:10], bytes(buffer.read(2, 8)))
+        self.assertEqual(data[3:6], buffer[3:6])
+        self.assertEqual(b'', bytes(buffer.read(10, 0)))
+        with self.assertRaises(ValueError):
+            buffer.read(8, 3)
+
+    def test_read_tfjs_weights(self):
+        for zip_compressed in [False, True]:
+            with tempfile.TemporaryDirectory() as model_dir:
+                # weights span shards
+                model_path, model = write_tfjs_model(model_dir, self.groups, 16, zip_compressed)
+                weights = read_tfjs_weights(model, os.path.dirname(model_path), zip_compressed)
+                self.assertEqual({"w1", "w2", "s", "w3"}, set(weights))
+                for group in self.groups:
+                    for name, value in group:
+                        np.testing.assert_array_equal(value, weights[name])
+                        self.assertEqual(value.dtype, weights[name].dtype)
+
+    def test_read_tfjs_weights_mmap(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path, model = write_tfjs_model(model_dir, self.groups, 1024)
+            weights = read_tfjs_weights(model, os.path.dirname(model_path), False)
+            # the weights are views of the mapped shards
+            base = weights["w1"]
+            while isinstance(base, np.ndarray):
+                base = base.base
+            self.assertIsInstance(base.obj, mmap.mmap)
+            np.testing.assert_array_equal(self.groups[0][0][1], weights["w1"])
+            del weights, base
+
+    def test_graphs_from_tfjs(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path, _ = write_tfjs_model(model_dir, self.groups, 1024)
+            main_g, subgraphs = graphs_from_tfjs(model_path, output_names=["w1:0", "w3:0"])
+            self.assertEqual([], subgraphs)
+            np.testing.assert_array_equal(self.groups[0][0][1], main_g.get_node_by_name("w1").get_tensor_value(False))
+            np.testing.assert_array_equal(self.groups[1][1][1], main_g.get_node_by_name("w3").get_tensor_value(False))
+
+    def _write_quantized_model(self, model_dir):
+        rng = np.random.RandomState(1)
+        # tfjs quantizes with a min that is a multiple of the scale so that 0 is exact
+        quantized = rng.randint(0, 256, [3, 4]).astype(np.uint8)
+        scale, zero_point = 0.02, 100
+        half = rng.random_sample([4]).astype(np.float16)
+        nodes = [
+            {"name": "x", "op": "Placeholder",
+             "attr": {"dtype": {"type": "DT_FLOAT"}, "shape": {"shape": {"dim": [{"size": "2"}, {"size": "3"}]}}}},
+            {"name": "mm", "op": "MatMul", "input": ["x", "w"], "attr": {"T": {"type": "DT_FLOAT"}}},
+            {"name": "output", "op": "AddV2", "input": ["mm", "b"], "attr": {"T": {"type": "DT_FLOAT"}}},
+        ]
+        groups = [[("w", quantized, {"scale": scale, "min": -zero_point * scale}), ("b", half, {})]]
+        model_path, _ = write_tfjs_model(model_dir, groups, 1024, nodes=nodes)
+        expected_w = (quantized.astype(np.float32) - zero_point) * np.float32(scale)
+        return model_path, expected_w, half.astype(np.float32)
+
+    def test_read_tfjs_weights_quantized(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path, expected_w, expected_b = self._write_quantized_model(model_dir)
+            model = json.load(open(model_path))
+            weights = read_tfjs_weights(model, model_dir, False)
+            np.testing.assert_allclose(expected_w, weights["w"], rtol=1e-6, atol=1e-6)
+            np.testing.assert_array_equal(expected_b, weights["b"])
+            weights = read_tfjs_weights(model, model_dir, False, compact_weights=True)
+            self.assertIsInstance(weights["w"], CompactWeight)
+            self.assertEqual(np.uint8, weights["w"].data.dtype)
+            self.assertEqual(100, weights["w"].zero_point)
+            self.assertEqual(np.float16, weights["b"].data.dtype)
+            self.assertIsNone(weights["b"].scale)
+
+    def test_graphs_from_tfjs_compact_weights(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path, expected_w, expected_b = self._write_quantized_model(model_dir)
+            g = process_tf_graph(None, opset=13, tfjs_path=model_path, input_names=["x:0"],
+                                 output_names=["output:0"], tfjs_compact_weights=True)
+            g = optimizer.optimize_graph(g)
+            model_proto = g.make_model("test")
+        self.assertEqual(["Cast", "DequantizeLinear"],
+                         sorted(n.op_type for n in model_proto.graph.node if n.op_type not in ["MatMul", "Add"]))
+        dtypes = sorted(t.data_type for t in model_proto.graph.initializer if t.dims)
+        self.assertEqual([TensorProto.UINT8, TensorProto.FLOAT16], dtypes)
+        try:
+            import onnxruntime as ort  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            return
+        x = np.random.random_sample([2, 3]).astype(np.float32)
+        got = ort.InferenceSession(model_proto.SerializeToString()).run(None, {"x:0": x})[0]
+        np.testing.assert_allclose(x @ expected_w + expected_b, got, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
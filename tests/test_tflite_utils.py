@@ -3,15 +3,24 @@
 
 """Unit Tests for TFLite utils."""
 
+import mmap
 import os
+import tempfile
+from unittest import mock
+
+import numpy as np
 import tensorflow as tf
+from onnx import numpy_helper
 
 from common import *  # pylint: disable=wildcard-import,unused-wildcard-import
 from backend_test_base import Tf2OnnxBackendTestBase
 from tf2onnx.tf_loader import from_function, tf_session
+from tf2onnx import tflite_utils
+from tf2onnx.flexbuffers import read_flexbuffer, read_flexbuffer_cached
+from tf2onnx.tflite.BuiltinOptions import BuiltinOptions
 from tf2onnx.tflite_utils import read_tflite_model, parse_tflite_graph
 
-# pylint: disable=missing-docstring
+# pylint: disable=missing-docstring,protected-access
 
 
 class TFListUtilsTests(Tf2OnnxBackendTestBase):
@@ -72,3 +81,101 @@ class TFListUtilsTests(Tf2OnnxBackendTestBase):
             self.assertEqual(dtype, dtypes[name])
 
         self.assertTrue(len(onnx_nodes) >= 4)
+
+    @check_tf_min_version("2.0")
+    def test_parse_tflite_graph_constants(self):
+        weight = np.random.random_sample([64, 32]).astype(np.float32)
+        bias = np.arange(32, dtype=np.int32)
+
+        @tf.function(input_signature=[tf.TensorSpec([1, 64], tf.float32), tf.TensorSpec([1, 32], tf.int32)])
+        def func(x, y):
+            return tf.identity(tf.matmul(x, weight), name="output"), tf.identity(y + bias, name="output2")
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([func.get_concrete_function()])
+        tflite_path = os.path.join(self.test_data_directory, self._testMethodName + ".tflite")
+        os.makedirs(self.test_data_directory, exist_ok=True)
+        with open(tflite_path, 'wb') as f:
+            f.write(converter.convert())
+
+        tflite_graphs, opcodes_map, model, _ = read_tflite_model(tflite_path)
+        self.assertIsInstance(model._tab.Bytes, mmap.mmap)
+        # constants are decoded without tensorflow
+        with mock.patch("tensorflow.python.framework.tensor_util.MakeNdarray", side_effect=AssertionError):
+            onnx_nodes = parse_tflite_graph(tflite_graphs[0], opcodes_map, model)[0]
+        values = [numpy_helper.to_array(n.attribute[0].t) for n in onnx_nodes if n.op_type == "Const"]
+        # the converter may store the weight transposed for FULLY_CONNECTED
+        self.assertTrue(any(np.array_equal(v, weight) or np.array_equal(v, weight.T) for v in values))
+        self.assertTrue(any(v.dtype == np.int32 and np.array_equal(v, bias) for v in values))
+
+    @check_tf_min_version("2.0")
+    def test_read_tflite_model_probe_shapes(self):
+        @tf.function(input_signature=[tf.TensorSpec([None, 3], tf.float32)])
+        def func(x):
+            return tf.identity(tf.nn.relu(x) + 1.0, name="output")
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([func.get_concrete_function()])
+        tflite_path = os.path.join(self.test_data_directory, self._testMethodName + ".tflite")
+        os.makedirs(self.test_data_directory, exist_ok=True)
+        with open(tflite_path, 'wb') as f:
+            f.write(converter.convert())
+
+        # the model stores all shapes, the interpreter isn't needed
+        with mock.patch.object(tf.lite, "Interpreter", side_effect=AssertionError):
+            _, _, model, tensor_shapes = read_tflite_model(tflite_path)
+        self.assertTrue(tflite_utils.has_complete_shapes(model))
+        self.assertEqual({}, tensor_shapes)
+
+        interpreter = tf.lite.Interpreter
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.dict(os.environ, {"TF2ONNX_CACHE_DIR": cache_dir}), \
+                mock.patch.dict(tflite_utils._interpreter_shapes_cache, clear=True), \
+                mock.patch.object(tf.lite, "Interpreter", side_effect=interpreter) as probe:
+            tensor_shapes = read_tflite_model(tflite_path, probe_shapes=True)[3]
+            self.assertEqual([-1, 3], tensor_shapes["x"])
+            self.assertEqual(1, probe.call_count)
+            # cached in memory
+            self.assertEqual(tensor_shapes, read_tflite_model(tflite_path, probe_shapes=True)[3])
+            # and on disk
+            tflite_utils._interpreter_shapes_cache.clear()
+            self.assertEqual(tensor_shapes, read_tflite_model(tflite_path, probe_shapes=True)[3])
+            self.assertEqual(1, probe.call_count)
+
+    def test_get_options_accessors(self):
+        self.assertEqual((None, ()), tflite_utils.get_options_accessors(BuiltinOptions.NONE))
+        option_class, accessors = tflite_utils.get_options_accessors(BuiltinOptions.Conv2DOptions)
+        self.assertEqual("Conv2DOptions", option_class.__name__)
+        kinds = {attr_name: (kind, enum_name) for _, attr_name, _, kind, enum_name in accessors}
+        self.assertEqual((tflite_utils.OPTION_ENUM, "Padding"), kinds["padding"])
+        self.assertEqual((tflite_utils.OPTION_VALUE, None), kinds["stride_w"])
+        _, accessors = tflite_utils.get_options_accessors(BuiltinOptions.ReshapeOptions)
+        self.assertEqual([("NewShape", "new_shape", tflite_utils.OPTION_LIST)], [a[:2] + a[3:4] for a in accessors])
+        _, accessors = tflite_utils.get_options_accessors(BuiltinOptions.WhileOptions)
+        self.assertEqual({"cond_subgraph_index", "body_subgraph_index"},
+                         {a[1] for a in accessors if a[3] == tflite_utils.OPTION_FUNCTION})
+        # the tables are built once per options class
+        self.assertIs(accessors, tflite_utils.get_options_accessors(BuiltinOptions.WhileOptions)[1])
+
+    def test_read_flexbuffer(self):
+        # made with the flexbuffers module of the flatbuffers package
+        buffer = b'ints\x00\x00\x03\x00\x01\x00\xfe\xff,\x01floats\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00?' \
+                 b'\x00\x00\xc0?bools\x00\x02\x01\x00fixed\x00\x01\x02\x03mixed\x00\x03\x07\x08\t\x04\x04\x04any\x00' \
+                 b'\x03two\x00\x03\x00\x00\x00\x01\x00\x00\x00\x0c\x00\x00\x00\x00\x00@@\x06\x14\x0ename\x00' \
+                 b'\x07tf2onnx' \
+                 b'\x00blob\x00\x03\x00\x01\x02\x084\x0bUMm|G\x1f\x08\x01\x082\x10YRj\x7fK$*d\x90P6-(\x14\x10$\x01'
+        expected = {
+            "ints": [1, -2, 300],
+            "floats": [0.5, 1.5],
+            "bools": [True, False],
+            "fixed": [1, 2, 3],
+            "mixed": [7, 8, 9],
+            "any": [1, "two", 3.0],
+            "name": "tf2onnx",
+            "blob": b"\x00\x01\x02",
+        }
+        data = read_flexbuffer(buffer)
+        self.assertEqual(expected, data)
+        self.assertEqual([int, int, int], [type(v) for v in data["ints"]])
+        self.assertEqual([bool, bool], [type(v) for v in data["bools"]])
+        self.assertEqual(b"tf2onnx", read_flexbuffer(buffer, decode_strings=False)[b"name"])
+        self.assertEqual(expected, read_flexbuffer_cached(buffer))
+        self.assertIs(read_flexbuffer_cached(buffer), read_flexbuffer_cached(buffer))
@@ -5,8 +5,25 @@
 __all__ = ["utils", "graph_matcher", "graph", "graph_builder",
            "tfonnx", "shape_inference", "schemas", "tf_utils", "tf_loader", "convert"]
 
+import importlib
+import sys
+
 import onnx
 from .version import version as __version__
 from . import verbose_logging as logging
-from tf2onnx import tfonnx, utils, graph, graph_builder, graph_matcher, shape_inference, schemas, convert  # pylint: disable=wrong-import-order
-#from tf2onnx import tf_utils, tf_loader
+
+# Submodules are imported on first access so that onnx-only users (for example GraphUtil.optimize_model_proto
+# or tools/onnx-optimize.py) don't pay for importing tensorflow and registering all the op handlers.
+_LAZY_SUBMODULES = ["tfonnx", "utils", "graph", "graph_builder", "graph_matcher", "shape_inference", "schemas",
+                    "convert", "tf_utils", "tf_loader", "optimizer", "handler", "constants", "onnx_opset"]
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # module level __getattr__ needs python 3.7
+    from tf2onnx import tfonnx, utils, graph, graph_builder, graph_matcher, shape_inference, schemas, convert  # pylint: disable=wrong-import-order
@@ -0,0 +1,432 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+python -m tf2onnx.batch : convert a manifest of models with a pool of long-lived worker processes
+"""
+
+# pylint: disable=broad-except,import-outside-toplevel
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+
+import yaml
+
+from tf2onnx import constants, logging, utils
+
+logger = logging.getLogger("tf2onnx.batch")
+
+_HELP_TEXT = """
+Usage Examples:
+
+python -m tf2onnx.batch manifest.yaml --jobs 4 --output-dir converted
+python -m tf2onnx.batch manifest.yaml --jobs 4 --max-worker-memory 8192 --summary summary.json
+
+The manifest uses the format of tests/run_pretrained_models.yaml, for example:
+
+    regression-graphdef:
+      model: models/regression/graphdef/frozen.pb
+      inputs:
+        "X:0": [1]
+      outputs:
+        - pred:0
+
+Non-absolute model paths are relative to the manifest directory.
+"""
+
+# keys of a job, manifest entries may only use these and _TEST_KEYS
+JOB_KEYS = ["model", "model_type", "inputs", "outputs", "tag", "signature_def", "concrete_function",
+            "large_model", "opset", "extra_opset", "dequantize", "use_custom_ops", "target", "output",
+            "shape_override", "inputs_as_nchw", "custom_ops"]
+
+# keys of run_pretrained_models.yaml that only matter to its tests, they are ignored
+_TEST_KEYS = ["url", "input_get", "rtol", "atol", "ptol", "disabled", "check_only_shape", "skip_tensorflow",
+              "force_input_shape", "tf_min_version", "skip_conversion", "converted_model", "structured_outputs",
+              "run_tf_frozen", "ort_profile", "tf_profile", "opset_constraints"]
+
+# summary columns in the order they are printed
+_SUMMARY_COLUMNS = ["name", "status", "time", "tf_nodes", "onnx_nodes", "output_size", "error"]
+
+
+def get_args():
+    """Parse commandline."""
+    parser = argparse.ArgumentParser(description="Convert a manifest of tensorflow models to ONNX.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=_HELP_TEXT)
+    parser.add_argument("manifest", help="yaml manifest describing the models to convert")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--output-dir", default=".", help="directory for the converted models")
+    parser.add_argument("--models", help="comma-separated list of manifest entries to convert (default all)")
+    parser.add_argument("--include-disabled", help="include entries marked as disabled", action="store_true")
+    parser.add_argument("--opset", type=int, default=None, help="opset version to use for onnx domain")
+    parser.add_argument("--max-worker-memory", type=int, default=0,
+                        help="recycle a worker once its resident memory exceeds this many MB (0 = never)")
+    parser.add_argument("--timeout", type=float, default=None, help="timeout in seconds for each conversion")
+    parser.add_argument("--summary", help="write the per-model summary to this file (.json or .csv)")
+    parser.add_argument("--verbose", "-v", help="verbose output, option is additive", action="count")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.models:
+        args.models = args.models.split(",")
+    return args
+
+
+def load_manifest(path, names=None, include_disabled=False, output_dir=".", opset=None):
+    """Read a yaml manifest and return an ordered dict of job name to job description."""
+    path = os.path.abspath(path)
+    base_dir = os.path.dirname(path)
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+
+    jobs = OrderedDict()
+    for name, settings in config.items():
+        if names is not None and name not in names:
+            continue
+        if settings.get("disabled") and not include_disabled and names is None:
+            logger.info("Skip %s: disabled", name)
+            continue
+        utils.make_sure(not settings.get("url"), "%s: downloading models is not supported, use a local path", name)
+        unknown = [k for k in settings if k not in JOB_KEYS and k not in _TEST_KEYS]
+        utils.make_sure(not unknown, "%s: unknown manifest keys %s", name, unknown)
+        job = {k: settings[k] for k in JOB_KEYS if settings.get(k) is not None}
+        utils.make_sure("model" in job, "%s: manifest entry has no model", name)
+        if not os.path.isabs(job["model"]):
+            job["model"] = os.path.join(base_dir, job["model"])
+        if opset is not None:
+            job["opset"] = opset
+        if "output" not in job:
+            ext = ".zip" if job.get("large_model") else ".onnx"
+            job["output"] = os.path.join(output_dir, name + ext)
+        job["name"] = name
+        jobs[name] = job
+    if names is not None:
+        missing = [n for n in names if n not in jobs]
+        utils.make_sure(not missing, "models not found in manifest: %s", missing)
+    return jobs
+
+
+def _load_model(job):
+    """Load the tensorflow model described by job. Returns graph_def, inputs, outputs and extra convert kwargs."""
+    from tf2onnx import tf_loader
+
+    model_path = job["model"]
+    model_type = job.get("model_type", "frozen")
+    inputs = job.get("inputs")
+    if isinstance(inputs, dict):
+        inputs = list(inputs.keys())
+    outputs = job.get("outputs")
+    large_model = job.get("large_model", False)
+    kwargs = {}
+
+    if model_type == "checkpoint":
+        graph_def, inputs, outputs = tf_loader.from_checkpoint(model_path, inputs, outputs)
+    elif model_type == "saved_model":
+        signature_def = job.get("signature_def")
+        graph_def, inputs, outputs, kwargs["initialized_tables"], kwargs["tensors_to_rename"] = \
+            tf_loader.from_saved_model(model_path, None, None, job.get("tag"),
+                                       [signature_def] if signature_def else None, job.get("concrete_function"),
+                                       large_model, return_initialized_tables=True, return_tensors_to_rename=True)
+    elif model_type == "keras":
+        graph_def, inputs, outputs = tf_loader.from_keras(model_path, inputs, outputs)
+    elif model_type == "tflite":
+        graph_def = None
+        kwargs["tflite_path"] = model_path
+        kwargs["dequantize"] = job.get("dequantize", False)
+    elif model_type == "tfjs":
+        graph_def = None
+        kwargs["tfjs_path"] = model_path
+    else:
+        graph_def, inputs, outputs = tf_loader.from_graphdef(model_path, inputs, outputs)
+    return graph_def, inputs, outputs, kwargs
+
+
+def run_job(job):
+    """Convert a single model. Runs inside a worker and returns a summary dict, never raises."""
+    result = OrderedDict((k, None) for k in _SUMMARY_COLUMNS)
+    result["name"] = job["name"]
+    start = time.time()
+    try:
+        import tensorflow as tf
+        from tf2onnx import convert
+
+        graph_def, inputs, outputs, kwargs = _load_model(job)
+        if graph_def is not None:
+            result["tf_nodes"] = len(graph_def.node)
+
+        extra_opset = []
+        if job.get("extra_opset"):
+            domain, version = job["extra_opset"].split(":")
+            extra_opset.append(utils.make_opsetid(domain, int(version)))
+        if job.get("use_custom_ops"):
+            extra_opset.append(utils.make_opsetid(constants.CONTRIB_OPS_DOMAIN, 1))
+        custom_ops = job.get("custom_ops")
+        if custom_ops:
+            if isinstance(custom_ops, str):
+                custom_ops = custom_ops.split(",")
+            kwargs["custom_op_handlers"], custom_opsets = convert.make_custom_op_handlers(custom_ops)
+            extra_opset.extend(custom_opsets)
+
+        output_path = job["output"]
+        with tf.device("/cpu:0"):
+            model_proto, _ = convert._convert_common(  # pylint: disable=protected-access
+                graph_def,
+                name=job["model"],
+                continue_on_error=False,
+                target=job.get("target", constants.DEFAULT_TARGET),
+                opset=job.get("opset"),
+                extra_opset=extra_opset,
+                input_names=inputs,
+                output_names=outputs,
+                shape_override=job.get("shape_override"),
+                inputs_as_nchw=job.get("inputs_as_nchw"),
+                large_model=job.get("large_model", False),
+                output_path=output_path,
+                **kwargs)
+
+        result["onnx_nodes"] = len(model_proto.graph.node)
+        result["output_size"] = os.path.getsize(output_path) if os.path.exists(output_path) else None
+        result["status"] = "ok"
+    except Exception as ex:
+        logger.debug("conversion of %s failed:\n%s", job["name"], traceback.format_exc())
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(ex).__name__, ex)
+    result["time"] = round(time.time() - start, 3)
+    return result
+
+
+def _worker_main(worker_id, task_queue, result_queue, max_rss, log_level):
+    """Main loop of a worker process. Exits on a None job or once its memory grows beyond max_rss."""
+    logging.basicConfig(level=log_level)
+    # pay the import cost once per worker instead of once per model
+    from tf2onnx import convert  # pylint: disable=unused-import
+
+    result_queue.put(("ready", worker_id, None))
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+        result_queue.put(("started", worker_id, job["name"]))
+        result = run_job(job)
+        result["worker"] = worker_id
+        result["worker_rss"] = utils.get_current_rss()
+        if max_rss and result["worker_rss"] > max_rss:
+            logger.info("worker %d uses %d MB, recycling", worker_id, result["worker_rss"] // 2**20)
+            # the last result, so no job is handed to a worker that is about to exit
+            result_queue.put(("exit", worker_id, result))
+            break
+        result_queue.put(("done", worker_id, result))
+
+
+class WorkerPool:
+    """A pool of long-lived conversion workers that are recycled when they use too much memory.
+
+    Workers are started with the spawn method so they don't inherit tensorflow state from the parent.
+    Each worker has a queue of its own and is handed a job only when it is idle, so the pool always knows which
+    job a worker has and can report it as failed if the worker dies.
+    Jobs are dicts as returned by load_manifest, results are the dicts returned by run_job.
+    submit and poll may be called from different threads.
+    """
+
+    def __init__(self, num_workers, max_worker_memory_mb=0, timeout=None):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._num_workers = num_workers
+        self._max_rss = max_worker_memory_mb * 2**20
+        self._timeout = timeout
+        self._result_queue = self._ctx.Queue()
+        # worker id -> (process, task queue)
+        self._workers = {}
+        # worker id -> (job name, time the job was handed to the worker)
+        self._running = {}
+        self._idle = []
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._next_worker_id = 0
+        self._log_level = logging.getLogger().getEffectiveLevel()
+        self.recycled = 0
+
+    def __enter__(self):
+        for _ in range(self._num_workers):
+            self._start_worker()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start_worker(self):
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        task_queue = self._ctx.Queue()
+        proc = self._ctx.Process(target=_worker_main, name="tf2onnx-worker-{}".format(worker_id),
+                                 args=(worker_id, task_queue, self._result_queue, self._max_rss,
+                                       self._log_level), daemon=True)
+        proc.start()
+        self._workers[worker_id] = (proc, task_queue)
+
+    def _replace_worker(self, worker_id):
+        proc, _ = self._workers.pop(worker_id)
+        proc.join(5)
+        if proc.is_alive():
+            proc.kill()
+        self._running.pop(worker_id, None)
+        if worker_id in self._idle:
+            self._idle.remove(worker_id)
+        self.recycled += 1
+        self._start_worker()
+
+    def _dispatch(self):
+        """Hand pending jobs to idle workers. Called with the lock held."""
+        while self._pending and self._idle:
+            worker_id = self._idle.pop(0)
+            job = self._pending.popleft()
+            self._running[worker_id] = (job["name"], time.time())
+            self._workers[worker_id][1].put(job)
+
+    def submit(self, job):
+        with self._lock:
+            self._pending.append(job)
+            self._dispatch()
+
+    def _failed(self, name, error):
+        result = OrderedDict((k, None) for k in _SUMMARY_COLUMNS)
+        result.update(name=name, status="failed", error=error)
+        return result
+
+    def _check_workers(self):
+        """Return failure results for jobs whose worker died or timed out, and replace those workers."""
+        failed = []
+        now = time.time()
+        for worker_id, (proc, _) in list(self._workers.items()):
+            name, started = self._running.get(worker_id, (None, None))
+            if not proc.is_alive():
+                if proc.exitcode == 0:
+                    # a recycled worker, it is replaced when its exit message is read
+                    continue
+                self._replace_worker(worker_id)
+                if name is not None:
+                    failed.append(self._failed(name, "worker exited with code {}".format(proc.exitcode)))
+            elif name is not None and self._timeout and now - started > self._timeout:
+                proc.kill()
+                self._replace_worker(worker_id)
+                failed.append(self._failed(name, "timeout after {}s".format(self._timeout)))
+        return failed
+
+    def poll(self, timeout=1):
+        """Wait up to timeout seconds for worker events. Returns a list of (event, payload) tuples.
+
+        event is "started" with the job name as payload or "done" with the result of run_job as payload.
+        """
+        try:
+            message = self._result_queue.get(timeout=timeout)
+        except queue.Empty:
+            message = None
+        with self._lock:
+            events = self._handle_message(*message) if message is not None else []
+            # checked on every poll, a steady stream of messages must not hide a dead or hung worker
+            return events + [("done", result) for result in self._check_workers()]
+
+    def _handle_message(self, event, worker_id, payload):
+        """Update the workers for a message of a worker and return its events. Called with the lock held."""
+        if worker_id not in self._workers:
+            # a late message of a worker that was already replaced
+            return []
+        if event == "ready":
+            self._idle.append(worker_id)
+            self._dispatch()
+            return []
+        if event == "started":
+            self._running[worker_id] = (payload, time.time())
+            return [(event, payload)]
+        self._running.pop(worker_id, None)
+        if event == "exit":
+            self._replace_worker(worker_id)
+        else:
+            self._idle.append(worker_id)
+            self._dispatch()
+        return [("done", payload)]
+
+    def results(self, count):
+        """Yield count results in order of completion."""
+        done = 0
+        while done < count:
+            for event, payload in self.poll():
+                if event == "done":
+                    done += 1
+                    yield payload
+
+    def close(self):
+        for _, task_queue in self._workers.values():
+            task_queue.put(None)
+        for proc, _ in self._workers.values():
+            proc.join(5)
+            if proc.is_alive():
+                proc.kill()
+        self._workers = {}
+
+
+def run_jobs(jobs, num_workers=1, max_worker_memory_mb=0, timeout=None):
+    """Convert jobs with a pool of workers. Returns the summaries in manifest order."""
+    results = {}
+    with WorkerPool(min(num_workers, max(len(jobs), 1)), max_worker_memory_mb, timeout) as pool:
+        for job in jobs.values():
+            pool.submit(job)
+        for result in pool.results(len(jobs)):
+            logger.info("%s: %s in %ss", result["name"], result["status"], result["time"])
+            results[result["name"]] = result
+        if pool.recycled:
+            logger.info("recycled %d workers", pool.recycled)
+    return [results[name] for name in jobs]
+
+
+def format_summary(results):
+    """Format the summaries as a plain text table."""
+    rows = [_SUMMARY_COLUMNS[:-1]]
+    for r in results:
+        rows.append([str(r[c]) if r[c] is not None else "-" for c in _SUMMARY_COLUMNS[:-1]])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ["  ".join(v.ljust(w) for v, w in zip(row, widths)) for row in rows]
+    for r in results:
+        if r["error"]:
+            lines.append("{}: {}".format(r["name"], r["error"]))
+    return "\n".join(lines)
+
+
+def save_summary(path, results):
+    """Save the summaries as json or csv depending on the file extension."""
+    if path.endswith(".csv"):
+        import csv
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=_SUMMARY_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.get_verbosity_level(args.verbose))
+
+    jobs = load_manifest(args.manifest, args.models, args.include_disabled, args.output_dir, args.opset)
+    os.makedirs(args.output_dir, exist_ok=True)
+    logger.info("Converting %d models with %d workers", len(jobs), args.jobs)
+    results = run_jobs(jobs, args.jobs, args.max_worker_memory, args.timeout)
+
+    print(format_summary(results))
+    if args.summary:
+        save_summary(args.summary, results)
+    failed = sum(1 for r in results if r["status"] != "ok")
+    logger.info("%d/%d models converted", len(results) - failed, len(results))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
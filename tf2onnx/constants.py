@@ -44,6 +44,8 @@ NCHW_TO_HWCN = [2, 3, 1, 0]
 # Environment variables
 ENV_TF2ONNX_DEBUG_MODE = "TF2ONNX_DEBUG_MODE"
 ENV_TF2ONNX_CATCH_ERRORS = "TF2ONNX_CATCH_ERRORS"
+# directory for tf2onnx's on-disk caches, set to an empty string to disable them
+ENV_TF2ONNX_CACHE_DIR = "TF2ONNX_CACHE_DIR"
 
 # Mapping opset to IR version.
 # Note: opset 7 and opset 8 came out with IR3 but we need IR4 because of PlaceholderWithDefault
@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.conversion_context - state that belongs to a single conversion
+"""
+
+import threading
+from contextlib import contextmanager
+
+_active = threading.local()
+
+
+class ConversionContext(object):
+    """Mutable state of a single conversion.
+
+    Holds the counter used by utils.make_name, the tf functions converted so far (see tf_loader.find_function),
+    the handler mapping the graph is converted with and the store for large constants. process_tf_graph
+    activates a context for the duration of a conversion and every Graph keeps a reference to the context it was
+    created in. The active context is
+    tracked per thread, so conversions in different threads don't see each other's state and produce the same
+    names as a conversion running alone.
+    """
+
+    def __init__(self, name_scope="", tensor_store=None):
+        # index for internally generated names
+        self.name_counter = 1
+        # inserted between name and index, keeps the names of contexts that are merged later apart
+        self.name_scope = name_scope
+        # tensor_store.TensorStore holding large constants, None keeps them in memory
+        self.tensor_store = tensor_store
+        # function name -> graph of the function, tf graphs while resolving, onnx graphs once converted
+        self.functions = {}
+        # handler.OpsMapping used for the conversion including the custom_op_handlers, set by process_parsed_graph.
+        # rewriters and handlers that convert a node with the handler of another op look the handler up here
+        self.ops_mapping = None
+
+    def make_name(self, name):
+        """Make op name for inserted ops."""
+        self.name_counter += 1
+        return "{}__{}{}".format(name, self.name_scope, self.name_counter)
+
+    def reserve_names(self, index):
+        """Make sure generated names use indices greater than index."""
+        self.name_counter = max(self.name_counter, index)
+
+    def reserve_name_block(self, count):
+        """Reserve the next count indices for names made elsewhere. Returns the index before the first of them."""
+        start = self.name_counter
+        self.name_counter += count
+        return start
+
+    @contextmanager
+    def activate(self):
+        """Make this the context of the current thread while inside the with block."""
+        stack = _get_stack()
+        stack.append(self)
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    def __deepcopy__(self, memo):
+        # graphs are deep-copied by the optimizers, the copies still belong to the same conversion
+        return self
+
+    def __reduce__(self):
+        # graphs sent to or received from worker processes join the conversion that is active where they are loaded
+        return (get_context, ())
+
+
+_default_context = ConversionContext()
+
+
+def _get_stack():
+    stack = getattr(_active, "stack", None)
+    if stack is None:
+        stack = _active.stack = []
+    return stack
+
+
+def get_context():
+    """Return the context of the conversion running in this thread, or the default context outside conversions."""
+    stack = _get_stack()
+    return stack[-1] if stack else _default_context
+
+
+def get_default_context():
+    """Return the context used outside of conversions."""
+    return _default_context
+
+
+def in_conversion():
+    """True if a conversion context is active in this thread."""
+    return bool(_get_stack())
@@ -8,8 +8,12 @@ python -m tf2onnx.convert : api and commandline tool to convert a tensorflow mod
 # pylint: disable=unused-argument,unused-import,ungrouped-imports,wrong-import-position
 
 import argparse
+import collections
+import functools
+import gc
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import LooseVersion
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
@@ -19,7 +23,12 @@ import tensorflow as tf
 from tf2onnx.tfonnx import process_tf_graph
 from tf2onnx import constants, logging, utils, optimizer
 from tf2onnx import tf_loader
+from tf2onnx.conversion_context import ConversionContext
 from tf2onnx.graph import ExternalTensorStorage
+from tf2onnx.tensor_store import TensorStore
+from tf2onnx.external_data import ExternalDataWriter, save_model_with_external_data
+from tf2onnx.shape_specialization import specialize_graph
+from tf2onnx.ort_optimization import OPTIMIZATION_LEVELS, optimize_with_ort
 from tf2onnx.tf_utils import compress_graph_def
 
 
@@ -49,7 +58,10 @@ def get_args():
     parser.add_argument("--graphdef", help="input from graphdef")
     parser.add_argument("--saved-model", help="input from saved model")
     parser.add_argument("--tag", help="tag to use for saved_model")
-    parser.add_argument("--signature_def", help="signature_def from saved_model to use")
+    parser.add_argument("--signature_def",
+                        help="signature_def from saved_model to use. With a comma separated list (TF2.x) each "
+                             "signature is converted to <output>_<signature>.onnx, all sharing the weights in "
+                             "<output>.data")
     parser.add_argument("--concrete_function", type=int, default=None,
                         help="For TF2.x saved_model, index of func signature in __call__ (--signature_def is ignored)")
     parser.add_argument("--checkpoint", help="input from checkpoint")
@@ -57,7 +69,22 @@ def get_args():
     parser.add_argument("--tflite", help="input from tflite model")
     parser.add_argument("--tfjs", help="input from tfjs model")
     parser.add_argument("--large_model", help="use the large model format (for models > 2GB)", action="store_true")
+    parser.add_argument("--external-data-shard-size", type=int, default=None,
+                        help="with --large_model split the external data into files of at most this many MB")
+    parser.add_argument("--mmap-tensors", help="keep large constants in a memory-mapped file during conversion",
+                        action="store_true")
+    parser.add_argument("--low-memory", help="release each stage of the conversion as soon as it is done and log "
+                        "the peak memory of the stages, implies --mmap-tensors", action="store_true")
     parser.add_argument("--output", help="output model file")
+    parser.add_argument("--shape-variant", action="append", dest="shape_variants",
+                        help="input shapes in the format of --inputs, e.g. input:0[8,224,224,3], the model is "
+                        "specialized to. Repeat it to save a model per variant to <output>_<n>.onnx, converting "
+                        "the model only once")
+    parser.add_argument("--ort-optimize", nargs="?", const="extended", choices=OPTIMIZATION_LEVELS,
+                        help="apply the graph optimizations of onnxruntime at this level (default extended) to the "
+                        "saved model and save the optimized model next to it")
+    parser.add_argument("--ort-format", help="save the model optimized with --ort-optimize in the ORT format",
+                        action="store_true")
     parser.add_argument("--inputs", help="model input_names (optional for saved_model, keras, and tflite)")
     parser.add_argument("--outputs", help="model output_names (optional for saved_model, keras, and tflite)")
     parser.add_argument("--ignore_default", help="comma-separated list of names of PlaceholderWithDefault "
@@ -71,6 +98,11 @@ def get_args():
     parser.add_argument("--opset", type=int, default=None, help="opset version to use for onnx domain")
     parser.add_argument("--dequantize", help="Remove quantization from model. Only supported for tflite currently.",
                         action="store_true")
+    parser.add_argument("--tflite-probe-shapes", choices=["auto", "always", "never"], default="auto",
+                        help="run the tflite interpreter to find tensor shapes, auto does it only if the tflite "
+                        "model doesn't store all shapes")
+    parser.add_argument("--tfjs-compact-weights", help="keep the weights of tfjs models quantized to uint8 or "
+                        "float16 in that form instead of expanding them to float", action="store_true")
     parser.add_argument("--custom-ops", help="comma-separated map of custom ops to domains in format OpName:domain")
     parser.add_argument("--extra_opset", default=None,
                         help="extra opset with format like domain:version, e.g. com.microsoft:1")
@@ -79,6 +111,8 @@ def get_args():
     parser.add_argument("--target", default=",".join(constants.DEFAULT_TARGET), choices=constants.POSSIBLE_TARGETS,
                         help="target platform")
     parser.add_argument("--continue_on_error", help="continue_on_error", action="store_true")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of worker processes used to convert the functions of the model (tf control flow)")
     parser.add_argument("--verbose", "-v", help="verbose output, option is additive", action="count")
     parser.add_argument("--debug", help="debug mode", action="store_true")
     parser.add_argument("--output_frozen_graph", help="output frozen tf graph to file")
@@ -100,6 +134,8 @@ def get_args():
         sys.exit(1)
     if args.inputs:
         args.inputs, args.shape_override = utils.split_nodename_and_shape(args.inputs)
+    if args.shape_variants:
+        args.shape_variants = [utils.split_nodename_and_shape(v)[1] or {} for v in args.shape_variants]
     if args.outputs:
         args.outputs = args.outputs.split(",")
     if args.ignore_default:
@@ -115,10 +151,23 @@ def get_args():
     if args.target:
         args.target = args.target.split(",")
     if args.signature_def:
-        args.signature_def = [args.signature_def]
+        args.signature_def = args.signature_def.split(",")
+        if len(args.signature_def) > 1:
+            if not args.saved_model or not args.output or args.output.endswith(".zip"):
+                parser.error("several signature_defs need a saved_model and an output that isn't a zip file")
+            if args.inputs or args.outputs or args.rename_inputs or args.rename_outputs or args.output_frozen_graph:
+                parser.error("inputs, outputs, renames and output_frozen_graph can't be given for several "
+                             "signature_defs")
+            if args.shape_variants:
+                parser.error("shape variants can't be used with several signature_defs")
+    if args.ort_format and not args.ort_optimize:
+        args.ort_optimize = "extended"
+    if args.ort_optimize and (not args.output or args.large_model and args.output.endswith(".zip")):
+        parser.error("ort-optimize needs an output that isn't a zip file")
     if args.dequantize:
         if not args.tflite:
             parser.error("dequantize flag is currently only supported for tflite")
+    args.tflite_probe_shapes = {"auto": None, "always": True, "never": False}[args.tflite_probe_shapes]
     if args.extra_opset:
         tokens = args.extra_opset.split(':')
         if len(tokens) != 2:
@@ -129,46 +178,191 @@ def get_args():
     return args
 
 
+def _default_custom_op_handler(domain, ctx, node, name, args):
+    node.domain = domain
+    return node
+
+
 def make_default_custom_op_handler(domain):
-    def default_custom_op_handler(ctx, node, name, args):
-        node.domain = domain
-        return node
-    return default_custom_op_handler
+    # a partial of a module level function can be sent to the workers used by --jobs
+    return functools.partial(_default_custom_op_handler, domain)
+
+
+def make_custom_op_handlers(custom_ops):
+    """Default handlers for custom_ops, a list of op types that may be followed by :domain, as given to
+    --custom-ops. Returns the custom_op_handlers and the extra opsets they need."""
+    handlers = {}
+    extra_opset = []
+    for op in custom_ops:
+        if ":" in op:
+            op, domain = op.split(":")
+        else:
+            # default custom ops for tensorflow-onnx are in the "tf" namespace
+            domain = constants.TENSORFLOW_OPSET.domain
+            if constants.TENSORFLOW_OPSET not in extra_opset:
+                extra_opset.append(constants.TENSORFLOW_OPSET)
+        handlers[op] = (make_default_custom_op_handler(domain), [])
+    return handlers, extra_opset
+
+
+class _StagePeakRss(object):
+    """Logs the peak RSS of each stage of a low memory conversion."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        # stage -> (peak RSS during the stage, RSS at its end) in bytes
+        self.stats = collections.OrderedDict()
+        if enabled and not utils.reset_peak_rss():
+            logging.getLogger(constants.TF2ONNX_PACKAGE_NAME).info(
+                "Peak RSS can't be reset on this platform, reporting the peak since the process started")
+
+    def end(self, stage):
+        if not self.enabled:
+            return
+        # graphs and their nodes reference each other, collect what the stage released before measuring
+        gc.collect()
+        self.stats[stage] = (utils.get_peak_rss(), utils.get_current_rss())
+        logging.getLogger(constants.TF2ONNX_PACKAGE_NAME).info(
+            "Stage %s: peak RSS %d MB, RSS after the stage %d MB",
+            stage, self.stats[stage][0] // 2**20, self.stats[stage][1] // 2**20)
+        utils.reset_peak_rss()
 
 
 def _convert_common(frozen_graph, name="unknown", large_model=False, output_path=None,
-                    output_frozen_graph=None, **kwargs):
-    """Common processing for conversion."""
-
+                    output_frozen_graph=None, external_data_shard_size=None, mmap_tensors=False, low_memory=False,
+                    checkpoint_variables=None, external_data_writer=None, shape_variants=None, ort_optimize=None,
+                    ort_format=False, **kwargs):
+    """Common processing for conversion.
+    With low_memory each stage releases its input as soon as it is done, frozen_graph is cleared once it is
+    imported, large constants go to a tensor store and the peak RSS of each stage is logged.
+    checkpoint_variables is the CheckpointVariables of a frozen_graph made by from_saved_model with stream_variables,
+    its values are read into a tensor store.
+    external_data_writer is an ExternalDataWriter the tensors of a large_model go to instead of one of its own.
+    shape_variants is a list of dicts mapping inputs to static shapes. The model is converted once and then
+    specialized, optimized and saved for each of them. A list of model_protos is returned in place of model_proto.
+    ort_optimize is an onnxruntime optimization level, the saved models are optimized with it offline and the result
+    is saved next to them, in the ORT format with ort_format. See ort_optimization.optimize_with_ort."""
+
+    utils.make_sure(not ort_optimize or output_path and not (large_model and output_path.endswith(".zip")),
+                    "ort_optimize needs an output_path that isn't a zip file")
+    context = ConversionContext()
+    if mmap_tensors or low_memory or checkpoint_variables is not None:
+        # large constants live in a memory-mapped file until the model is written
+        context.tensor_store = TensorStore(os.path.dirname(os.path.abspath(output_path)) if output_path else None)
+    try:
+        with context.activate():
+            result = _convert_in_context(frozen_graph, name, large_model, output_path, output_frozen_graph,
+                                         external_data_shard_size, low_memory, checkpoint_variables,
+                                         external_data_writer, shape_variants, **kwargs)
+    finally:
+        if context.tensor_store is not None:
+            context.tensor_store.close()
+    if ort_optimize:
+        paths = [variant_output_path(output_path, i) for i in range(len(shape_variants))] if shape_variants \
+            else [output_path]
+        for path in paths:
+            optimize_with_ort(path, ort_optimize, ort_format)
+    return result
+
+
+def _convert_in_context(frozen_graph, name, large_model, output_path, output_frozen_graph,
+                        external_data_shard_size, low_memory, checkpoint_variables, external_data_writer,
+                        shape_variants, **kwargs):
     model_proto = None
     external_tensor_storage = None
     const_node_values = None
+    stages = _StagePeakRss(low_memory)
 
+    if output_frozen_graph:
+        utils.save_protobuf(output_frozen_graph, frozen_graph)
     with tf.Graph().as_default() as tf_graph:
-        if large_model:
+        if (large_model or low_memory) and frozen_graph is not None:
+            # the values of large constants are moved out, so importing the graph doesn't copy them
             const_node_values = compress_graph_def(frozen_graph)
+        if checkpoint_variables is not None:
+            const_node_values = const_node_values or {}
+            const_node_values.update(checkpoint_variables.read_values())
+            stages.end("read variables")
+        if large_model:
             external_tensor_storage = ExternalTensorStorage()
-        if output_frozen_graph:
-            utils.save_protobuf(output_frozen_graph, frozen_graph)
         if not kwargs.get("tflite_path") and not kwargs.get("tfjs_path"):
             tf.import_graph_def(frozen_graph, name='')
+        if low_memory and frozen_graph is not None:
+            frozen_graph.Clear()
+        stages.end("import")
         g = process_tf_graph(tf_graph, const_node_values=const_node_values, **kwargs)
-        if constants.ENV_TF2ONNX_CATCH_ERRORS in os.environ:
-            catch_errors = constants.ENV_TF2ONNX_CATCH_ERRORS.upper() == "TRUE"
-        else:
-            catch_errors = not large_model
-        onnx_graph = optimizer.optimize_graph(g, catch_errors)
-        model_proto = onnx_graph.make_model("converted from {}".format(name),
-                                            external_tensor_storage=external_tensor_storage)
+    if low_memory:
+        del tf_graph
+        const_node_values = None
+    stages.end("process")
+
+    if constants.ENV_TF2ONNX_CATCH_ERRORS in os.environ:
+        catch_errors = constants.ENV_TF2ONNX_CATCH_ERRORS.upper() == "TRUE"
+    else:
+        catch_errors = not large_model
+    doc = "converted from {}".format(name)
+    if shape_variants:
+        return _save_shape_variants(g, doc, shape_variants, large_model, output_path, external_data_shard_size,
+                                    external_data_writer, catch_errors, kwargs.get("tensors_to_rename")), None
+    g = optimizer.optimize_graph(g, catch_errors)
+    stages.end("optimize")
+
+    if large_model and output_path and not output_path.endswith(".zip"):
+        # write the tensors to external data files next to the model while the model is made
+        model_proto, external_tensor_storage = save_model_with_external_data(
+            output_path, g, doc, external_data_shard_size, writer=external_data_writer)
+        del g
+        stages.end("make_model")
+        return model_proto, external_tensor_storage
+    model_proto = g.make_model(doc, external_tensor_storage=external_tensor_storage)
+    del g
+    stages.end("make_model")
     if output_path:
         if large_model:
             utils.save_onnx_zip(output_path, model_proto, external_tensor_storage)
         else:
             utils.save_protobuf(output_path, model_proto)
+        stages.end("save")
 
     return model_proto, external_tensor_storage
 
 
+def variant_output_path(output_path, index):
+    """Path of the model for the shape variant at index when several shape variants are saved to output_path."""
+    base, ext = os.path.splitext(output_path)
+    return "{}_{}{}".format(base, index, ext or ".onnx")
+
+
+def _save_shape_variants(g, doc, shape_variants, large_model, output_path, external_data_shard_size,
+                         external_data_writer, catch_errors, tensors_to_rename):
+    """Specialize the converted graph g to each of the shape_variants, optimize and save it. With large_model all
+    the variants share their weights in <output_path>.data. Returns the model_protos."""
+    utils.make_sure(not large_model or output_path and not output_path.endswith(".zip"),
+                    "shape variants of a large model need an output path that isn't a zip file")
+    tensors_to_rename = tensors_to_rename or {}
+    writer = external_data_writer
+    if large_model and writer is None:
+        writer = ExternalDataWriter(output_path, external_data_shard_size, deduplicate=True)
+    model_protos = []
+    try:
+        for i, input_shapes in enumerate(shape_variants):
+            input_shapes = {tensors_to_rename.get(k, k): v for k, v in input_shapes.items()}
+            logging.getLogger(constants.TF2ONNX_PACKAGE_NAME).info("Specializing the model to %s", input_shapes)
+            variant = optimizer.optimize_graph(specialize_graph(g, input_shapes), catch_errors)
+            path = variant_output_path(output_path, i) if output_path else None
+            if writer is not None:
+                model_proto, _ = save_model_with_external_data(path, variant, doc, writer=writer)
+            else:
+                model_proto = variant.make_model(doc)
+                if path:
+                    utils.save_protobuf(path, model_proto)
+            model_protos.append(model_proto)
+    finally:
+        if writer is not None and writer is not external_data_writer:
+            writer.close()
+    return model_protos
+
+
 def main():
     args = get_args()
     logging.basicConfig(level=logging.get_verbosity_level(args.verbose))
@@ -182,19 +376,11 @@ def main():
     tfjs_path = None
     custom_ops = {}
     initialized_tables = None
+    checkpoint_variables = None
     tensors_to_rename = {}
     if args.custom_ops:
-        using_tf_opset = False
-        for op in args.custom_ops.split(","):
-            if ":" in op:
-                op, domain = op.split(":")
-            else:
-                # default custom ops for tensorflow-onnx are in the "tf" namespace
-                using_tf_opset = True
-                domain = constants.TENSORFLOW_OPSET.domain
-            custom_ops[op] = (make_default_custom_op_handler(domain), [])
-        if using_tf_opset:
-            extra_opset.append(constants.TENSORFLOW_OPSET)
+        custom_ops, custom_opsets = make_custom_op_handlers(args.custom_ops.split(","))
+        extra_opset.extend(custom_opsets)
 
     if any(opset.domain == constants.CONTRIB_OPS_DOMAIN for opset in extra_opset):
         try:
@@ -221,11 +407,44 @@ def main():
     if args.checkpoint:
         graph_def, inputs, outputs = tf_loader.from_checkpoint(args.checkpoint, args.inputs, args.outputs)
         model_path = args.checkpoint
+    if args.saved_model and args.signature_def and len(args.signature_def) > 1:
+        with tf.device("/cpu:0"):
+            model_protos = _convert_signatures(
+                args.saved_model, args.signature_def, args.output, tag=args.tag,
+                use_graph_names=args.use_graph_names,
+                external_data_shard_size=args.external_data_shard_size * 2**20 if args.external_data_shard_size
+                else None,
+                continue_on_error=args.continue_on_error,
+                jobs=args.jobs,
+                target=args.target,
+                opset=args.opset,
+                custom_op_handlers=custom_ops,
+                extra_opset=extra_opset,
+                inputs_as_nchw=args.inputs_as_nchw,
+                mmap_tensors=args.mmap_tensors,
+                low_memory=args.low_memory,
+                ignore_default=args.ignore_default,
+                use_default=args.use_default,
+                ort_optimize=args.ort_optimize,
+                ort_format=args.ort_format)
+        logger.info("")
+        logger.info("Successfully converted TensorFlow model %s to ONNX", args.saved_model)
+        for signature, model_proto in model_protos.items():
+            logger.info("Signature %s is saved at %s, inputs: %s, outputs: %s", signature,
+                        signature_output_path(args.output, signature), [n.name for n in model_proto.graph.input],
+                        [n.name for n in model_proto.graph.output])
+        return
     if args.saved_model:
-        graph_def, inputs, outputs, initialized_tables, tensors_to_rename = tf_loader.from_saved_model(
+        # large models are frozen without their variables, they are read from the checkpoint while converting
+        stream_variables = args.large_model and not args.output_frozen_graph and tf_loader.is_tf2() and \
+            tf_loader.can_stream_variables()
+        result = tf_loader.from_saved_model(
             args.saved_model, args.inputs, args.outputs, args.tag, args.signature_def, args.concrete_function,
             args.large_model, return_initialized_tables=True, return_tensors_to_rename=True,
-            use_graph_names=args.use_graph_names)
+            use_graph_names=args.use_graph_names, stream_variables=stream_variables)
+        graph_def, inputs, outputs, initialized_tables, tensors_to_rename = result[:5]
+        if stream_variables:
+            checkpoint_variables = result[5]
         model_path = args.saved_model
     if args.keras:
         graph_def, inputs, outputs = tf_loader.from_keras(
@@ -257,6 +476,7 @@ def main():
             graph_def,
             name=model_path,
             continue_on_error=args.continue_on_error,
+            jobs=args.jobs,
             target=args.target,
             opset=args.opset,
             custom_op_handlers=custom_ops,
@@ -266,14 +486,23 @@ def main():
             output_names=outputs,
             inputs_as_nchw=args.inputs_as_nchw,
             large_model=args.large_model,
+            external_data_shard_size=args.external_data_shard_size * 2**20 if args.external_data_shard_size else None,
+            mmap_tensors=args.mmap_tensors,
+            low_memory=args.low_memory,
             tensors_to_rename=tensors_to_rename,
             ignore_default=args.ignore_default,
             use_default=args.use_default,
             tflite_path=tflite_path,
             dequantize=args.dequantize,
+            tflite_probe_shapes=args.tflite_probe_shapes,
             tfjs_path=tfjs_path,
+            tfjs_compact_weights=args.tfjs_compact_weights,
             initialized_tables=initialized_tables,
             output_frozen_graph=args.output_frozen_graph,
+            checkpoint_variables=checkpoint_variables,
+            shape_variants=args.shape_variants,
+            ort_optimize=args.ort_optimize,
+            ort_format=args.ort_format,
             output_path=args.output)
 
 
@@ -281,11 +510,20 @@ def main():
     logger.info("")
     logger.info("Successfully converted TensorFlow model %s to ONNX", model_path)
 
+    if args.shape_variants:
+        for i, (input_shapes, variant) in enumerate(zip(args.shape_variants, model_proto)):
+            logger.info("Model for the input shapes %s%s", input_shapes,
+                        " is saved at " + variant_output_path(args.output, i) if args.output else "")
+            logger.info("Model outputs: %s", [n.name for n in variant.graph.output])
+        return
     logger.info("Model inputs: %s", [n.name for n in model_proto.graph.input])
     logger.info("Model outputs: %s", [n.name for n in model_proto.graph.output])
     if args.output:
-        if args.large_model:
+        if args.large_model and args.output.endswith(".zip"):
             logger.info("Zipped ONNX model is saved at %s. Unzip before opening in onnxruntime.", args.output)
+        elif args.large_model:
+            logger.info("ONNX model is saved at %s with its large tensors in external data files next to it",
+                        args.output)
         else:
             logger.info("ONNX model is saved at %s", args.output)
     else:
@@ -403,7 +641,8 @@ def from_keras(model, input_signature=None, opset=None, custom_ops=None, custom_
         extra_opset: list of extra opset's, for example the opset's used by custom ops
         shape_override: dict with inputs that override the shapes given by tensorflow
         inputs_as_nchw: transpose inputs in list from nchw to nhwc
-        large_model: use the ONNX external tensor storage format
+        large_model: use the ONNX external tensor storage format. If output_path ends with .zip the model and
+            tensors are saved in a zip file, otherwise the tensors are written to external data files next to it
         output_path: save model to output_path
 
     Returns:
@@ -491,7 +730,7 @@ def from_keras(model, input_signature=None, opset=None, custom_ops=None, custom_
 
 def from_function(function, input_signature=None, opset=None, custom_ops=None, custom_op_handlers=None,
                   custom_rewriter=None, inputs_as_nchw=None, extra_opset=None, shape_override=None, target=None,
-                  large_model=False, output_path=None):
+                  large_model=False, output_path=None, shape_variants=None, ort_optimize=None, ort_format=False):
     """Returns a ONNX model_proto for a tf.function.
 
     Args:
@@ -507,11 +746,17 @@ def from_function(function, input_signature=None, opset=None, custom_ops=None, c
         extra_opset: list of extra opset's, for example the opset's used by custom ops
         shape_override: dict with inputs that override the shapes given by tensorflow
         inputs_as_nchw: transpose inputs in list from nchw to nhwc
-        large_model: use the ONNX external tensor storage format
+        large_model: use the ONNX external tensor storage format. If output_path ends with .zip the model and
+            tensors are saved in a zip file, otherwise the tensors are written to external data files next to it
         output_path: save model to output_path
+        shape_variants: list of dicts mapping inputs to static shapes. The model is converted once and a model
+            specialized to each of them is made and saved to <output_path without extension>_<index>.onnx
+        ort_optimize: onnxruntime graph optimization level, one of basic, extended and all. The saved model is
+            optimized with onnxruntime offline and saved to <output_path without extension>.optimized.onnx
+        ort_format: save the model optimized with ort_optimize to <output_path without extension>.ort instead
 
     Returns:
-        An ONNX model_proto and an external_tensor_storage dict.
+        An ONNX model_proto and an external_tensor_storage dict, a list of model_protos with shape_variants.
     """
     if LooseVersion(tf.__version__) < "2.0":
         raise NotImplementedError("from_function requires tf-2.0 or newer")
@@ -546,6 +791,9 @@ def from_function(function, input_signature=None, opset=None, custom_ops=None, c
             large_model=large_model,
             tensors_to_rename=tensors_to_rename,
             initialized_tables=initialized_tables,
+            shape_variants=shape_variants,
+            ort_optimize=ort_optimize,
+            ort_format=ort_format,
             output_path=output_path)
 
         return model_proto, external_tensor_storage
@@ -553,7 +801,8 @@ def from_function(function, input_signature=None, opset=None, custom_ops=None, c
 
 def from_graph_def(graph_def, name=None, input_names=None, output_names=None, opset=None, custom_ops=None,
                    custom_op_handlers=None, custom_rewriter=None, inputs_as_nchw=None, extra_opset=None,
-                   shape_override=None, target=None, large_model=False, tensors_to_rename=None, output_path=None):
+                   shape_override=None, target=None, large_model=False, tensors_to_rename=None, output_path=None,
+                   shape_variants=None, ort_optimize=None, ort_format=False):
     """Returns a ONNX model_proto for a tensorflow graphdef.
 
     Args:
@@ -571,11 +820,17 @@ def from_graph_def(graph_def, name=None, input_names=None, output_names=None, op
         extra_opset: list of extra opset's, for example the opset's used by custom ops
         shape_override: dict with inputs that override the shapes given by tensorflow
         inputs_as_nchw: transpose inputs in list from nchw to nhwc
-        large_model: use the ONNX external tensor storage format
+        large_model: use the ONNX external tensor storage format. If output_path ends with .zip the model and
+            tensors are saved in a zip file, otherwise the tensors are written to external data files next to it
         output_path: save model to output_path
+        shape_variants: list of dicts mapping inputs to static shapes. The model is converted once and a model
+            specialized to each of them is made and saved to <output_path without extension>_<index>.onnx
+        ort_optimize: onnxruntime graph optimization level, one of basic, extended and all. The saved model is
+            optimized with onnxruntime offline and saved to <output_path without extension>.optimized.onnx
+        ort_format: save the model optimized with ort_optimize to <output_path without extension>.ort instead
 
     Returns:
-        An ONNX model_proto and an external_tensor_storage dict.
+        An ONNX model_proto and an external_tensor_storage dict, a list of model_protos with shape_variants.
     """
     if not input_names:
         raise ValueError("input_names needs to be provided")
@@ -608,10 +863,92 @@ def from_graph_def(graph_def, name=None, input_names=None, output_names=None, op
         large_model=large_model,
         tensors_to_rename=tensors_to_rename,
         initialized_tables=initialized_tables,
+        shape_variants=shape_variants,
+        ort_optimize=ort_optimize,
+        ort_format=ort_format,
         output_path=output_path)
 
     return model_proto, external_tensor_storage
 
 
+def signature_output_path(output_path, signature):
+    """Path of the model converted from signature when several signatures are converted to output_path."""
+    base, ext = os.path.splitext(output_path)
+    return "{}_{}{}".format(base, signature, ext or ".onnx")
+
+
+def _convert_signatures(model_path, signatures, output_path, tag=None, use_graph_names=False,
+                        external_data_shard_size=None, max_workers=None, **kwargs):
+    """Convert several signatures of a saved_model, see from_saved_model_signatures.
+    kwargs are passed on to _convert_common."""
+    # the models can only be loaded by onnxruntime once all the tensors are written
+    ort_optimize = kwargs.pop("ort_optimize", None)
+    ort_format = kwargs.pop("ort_format", False)
+    stream_variables = tf_loader.can_stream_variables()
+    frozen = tf_loader.from_saved_model_signatures(model_path, signatures, tag, large_model=True,
+                                                   use_graph_names=use_graph_names, stream_variables=stream_variables)
+
+    def convert(signature):
+        frozen_graph, input_names, output_names, initialized_tables, tensors_to_rename, checkpoint_variables = \
+            frozen[signature]
+        with tf.device("/cpu:0"):
+            model_proto, _ = _convert_common(
+                frozen_graph, name="{} {}".format(model_path, signature), large_model=True,
+                output_path=signature_output_path(output_path, signature), input_names=input_names,
+                output_names=output_names, tensors_to_rename=tensors_to_rename,
+                initialized_tables=initialized_tables, checkpoint_variables=checkpoint_variables,
+                external_data_writer=writer, **kwargs)
+        # the frozen graph isn't needed anymore
+        frozen[signature] = None
+        return model_proto
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with ExternalDataWriter(output_path, external_data_shard_size, deduplicate=True) as writer:
+        with ThreadPoolExecutor(max_workers=max_workers or min(len(frozen), os.cpu_count() or 1)) as executor:
+            model_protos = list(executor.map(convert, list(frozen)))
+    logging.getLogger(constants.TF2ONNX_PACKAGE_NAME).info(
+        "Wrote %d bytes of tensor data to %s, skipped %d bytes of duplicate tensors",
+        writer.bytes_written, ", ".join(writer.locations), writer.bytes_deduplicated)
+    if ort_optimize:
+        for signature in frozen:
+            optimize_with_ort(signature_output_path(output_path, signature), ort_optimize, ort_format)
+    return collections.OrderedDict(zip(frozen, model_protos))
+
+
+def from_saved_model_signatures(model_path, signatures=None, output_path=None, tag=None, opset=None,
+                                custom_ops=None, custom_op_handlers=None, custom_rewriter=None, extra_opset=None,
+                                target=None, external_data_shard_size=None, max_workers=None):
+    """Converts several signatures of a tensorflow 2 saved_model, loading it once and converting the signatures
+    concurrently. Each signature is saved to <output_path without extension>_<signature>.onnx. The weights of all
+    the models go to shared external data files next to them and identical tensors are written once.
+
+    Args:
+        model_path: the directory of the saved_model
+        signatures: list of the signatures to convert, all of them if None
+        output_path: path of the shared external data, <output_path without extension>.data
+        tag: the tag of the saved_model to load, default is serve
+        opset: the opset to be used for the ONNX model, default is the latest
+        custom_ops: if a model contains ops not recognized by onnx runtime,
+            you can tag these ops with a custom op domain so that the
+            runtime can still open the model. Type is a dictionary `{op name: domain}`.
+        custom_op_handlers: dictionary of custom ops handlers
+        custom_rewriter: list of custom graph rewriters
+        extra_opset: list of extra opset's, for example the opset's used by custom ops
+        target: list of workarounds applied to help certain platforms
+        external_data_shard_size: split the external data into files of at most this many bytes
+        max_workers: number of signatures converted at the same time, default is one per signature up to the
+            number of cpus
+
+    Returns:
+        An OrderedDict mapping the signatures to their ONNX model_proto.
+    """
+    if not output_path or output_path.endswith(".zip"):
+        raise ValueError("output_path needs to be provided and can't be a zip file")
+    return _convert_signatures(
+        model_path, signatures, output_path, tag=tag, external_data_shard_size=external_data_shard_size,
+        max_workers=max_workers, continue_on_error=True, target=target, opset=opset, custom_op_handlers=custom_ops,
+        extra_opset=extra_opset)
+
+
 if __name__ == "__main__":
     main()
@@ -7,7 +7,7 @@ import logging
 import numpy as np
 from onnx.onnx_pb import TensorProto
 from onnx.helper import make_attribute
-from tf2onnx import constants, handler
+from tf2onnx import constants
 from tf2onnx.handler import tf_op
 from tf2onnx import utils
 from tf2onnx.graph_builder import GraphBuilder
@@ -93,7 +93,7 @@ class StringEqual:
         dtype = ctx.get_dtype(node.input[0])
         if dtype != TensorProto.STRING:
             # Fallback to normal domain conversion
-            func, _ = handler.tf_op.find_effective_op(node.type, constants.ONNX_DOMAIN)
+            func, _ = ctx.conversion_context.ops_mapping.find_effective_op(node.type, constants.ONNX_DOMAIN)
             func(ctx, node, **kwargs)
             return
 
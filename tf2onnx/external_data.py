@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.external_data - write large tensors to onnx external data files while the model is created
+"""
+
+import hashlib
+import os
+import threading
+
+from tf2onnx import logging, utils
+from tf2onnx.tensor_store import tensor_data
+from tf2onnx.graph import ExternalTensorStorage, make_external_tensor
+
+logger = logging.getLogger(__name__)
+
+# mmap needs offsets aligned to the allocation granularity, which is 64KB on windows and the page size elsewhere
+DEFAULT_ALIGNMENT = 4096
+
+
+class ExternalDataWriter(ExternalTensorStorage):
+    """ExternalTensorStorage that writes each tensor to an external data file next to the model as soon as
+    Graph.make_graph hands it over, instead of collecting the data of all tensors in memory. The nodes of the graph
+    keep their values, so the tensors are only released with the graph. The model saved to model_path can be loaded
+    with onnx.load or onnxruntime directly.
+
+    The data goes to <model name>.data, or to <model name>.<n>.data files of at most max_shard_size bytes if
+    max_shard_size is given. Every tensor starts at a multiple of alignment so runtimes can mmap it.
+
+    With deduplicate tensors with the same data are written once and all point to it. Several models in the same
+    directory, made one after the other or concurrently, can share a writer and so their weights.
+
+    Example:
+        with ExternalDataWriter("model.onnx") as writer:
+            model_proto = g.make_model("doc", external_tensor_storage=writer)
+        utils.save_protobuf("model.onnx", model_proto)
+    """
+
+    def __init__(self, model_path, max_shard_size=None, alignment=DEFAULT_ALIGNMENT, deduplicate=False):
+        super().__init__()
+        self.model_dir = os.path.dirname(os.path.abspath(model_path))
+        self.base_name = os.path.splitext(os.path.basename(model_path))[0]
+        self.max_shard_size = max_shard_size
+        self.alignment = alignment
+        # names of the data files relative to the model, in the order they were written
+        self.locations = []
+        self.bytes_written = 0
+        self.bytes_deduplicated = 0
+        # (sha256, length) of the data written -> (location, offset), if deduplicate
+        self._written = {} if deduplicate else None
+        self._lock = threading.Lock()
+        self._file = None
+        self._offset = 0
+        self._closed = False
+
+    def _shard_name(self, index):
+        if self.max_shard_size is None:
+            return self.base_name + ".data"
+        return "{}.{}.data".format(self.base_name, index)
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        location = self._shard_name(len(self.locations))
+        os.makedirs(self.model_dir, exist_ok=True)
+        self._file = open(os.path.join(self.model_dir, location), "wb")
+        self._offset = 0
+        self.locations.append(location)
+
+    def add_tensor(self, name, tensor):
+        """Append the data of tensor to the current data file. Returns a tensor without data that points to it."""
+        utils.make_sure(not self._closed, "tensor %s added after the external data was closed", name)
+        # tensors from a TensorStore are copied from the mapped file without reading them into memory first
+        data = memoryview(tensor_data(tensor)).cast("B")
+        digest = (hashlib.sha256(data).digest(), data.nbytes) if self._written is not None else None
+        with self._lock:
+            if digest is not None and digest in self._written:
+                location, offset = self._written[digest]
+                self.bytes_deduplicated += data.nbytes
+            else:
+                location, offset = self._write(data)
+                if digest is not None:
+                    self._written[digest] = location, offset
+        return make_external_tensor(tensor, [("location", location), ("offset", offset), ("length", data.nbytes)])
+
+    def _write(self, data):
+        offset = (self._offset + self.alignment - 1) // self.alignment * self.alignment
+        if self._file is None or (self.max_shard_size is not None and self._offset > 0 and
+                                  offset + data.nbytes > self.max_shard_size):
+            self._open_shard()
+            offset = 0
+        if offset > self._offset:
+            self._file.write(b"\0" * (offset - self._offset))
+        self._file.write(data)
+        self._offset = offset + data.nbytes
+        self.bytes_written += data.nbytes
+        return self.locations[-1], offset
+
+    def close(self):
+        """Finish writing the data files."""
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def save_model_with_external_data(model_path, graph, doc, max_shard_size=None, alignment=DEFAULT_ALIGNMENT,
+                                  writer=None, **kwargs):
+    """Make the model for graph, writing large tensors to external data files, and save it to model_path.
+    If writer is given the tensors go to it, it must be in the directory of model_path and is left open for
+    more models. kwargs are passed on to Graph.make_model. Returns the model_proto and the writer."""
+    if writer is None:
+        with ExternalDataWriter(model_path, max_shard_size, alignment) as writer:
+            model_proto = graph.make_model(doc, external_tensor_storage=writer, **kwargs)
+        logger.info("Wrote %d bytes of tensor data to %s", writer.bytes_written, ", ".join(writer.locations))
+    else:
+        utils.make_sure(writer.model_dir == os.path.dirname(os.path.abspath(model_path)),
+                        "external data in %s can't be shared with %s", writer.model_dir, model_path)
+        model_proto = graph.make_model(doc, external_tensor_storage=writer, **kwargs)
+    utils.make_sure(model_proto.ByteSize() < 2**31, "model without its tensors is still larger than 2GB")
+    utils.save_protobuf(model_path, model_proto)
+    return model_proto, writer
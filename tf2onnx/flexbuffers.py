@@ -5,8 +5,11 @@
 tf2onnx.flexbuffers - Code for parsing flexbuffers
 """
 
+import functools
 import struct
 
+import numpy as np
+
 
 class FlexbufferParseException(Exception):
     pass
@@ -57,6 +60,29 @@ def read_array(buffer, offset, length, bit_size, packed_type, decode_strings):
     return arr
 
 
+# numpy dtypes of the items of typed vectors by value type (int, uint, float, bool) and bit size
+_TYPED_VECTOR_DTYPES = {
+    0x1: ['<i1', '<i2', '<i4', '<i8'],
+    0x2: ['<u1', '<u2', '<u4', '<u8'],
+    0x3: [None, None, '<f4', '<f8'],
+    0x1a: ['<u1', '<u2', '<u4', '<u8'],
+}
+
+
+def read_typed_array(buffer, offset, length, bit_size, value_type, decode_strings):
+    """read_array for vectors whose items all have the same type. Numbers and bools are decoded with one
+    np.frombuffer call, keys and strings one by one."""
+    if value_type not in _TYPED_VECTOR_DTYPES:
+        return read_array(buffer, offset, length, bit_size, value_type << 2, decode_strings)
+    dtype = _TYPED_VECTOR_DTYPES[value_type][bit_size]
+    if dtype is None:
+        raise FlexbufferParseException("Invalid bit size for flexbuffer float: %d" % bit_size)
+    arr = np.frombuffer(buffer, dtype=dtype, count=length, offset=offset)
+    if value_type == 0x1a:
+        arr = arr != 0
+    return arr.tolist()
+
+
 def read_buffer(buffer, offset, parent_bit_size, packed_type, decode_strings):
     """Recursively decode flatbuffer object into python representation"""
     bit_size = packed_type & 3
@@ -70,16 +96,14 @@ def read_buffer(buffer, offset, parent_bit_size, packed_type, decode_strings):
         return read_fn(buffer, offset, parent_bit_size)
     if value_type == 0x4:
         str_offset = read_indirect(buffer, offset, parent_bit_size)
-        size = 0
-        while read_int(buffer, str_offset + size, 0) != 0:
-            size += 1
+        size = buffer.index(b'\x00', str_offset) - str_offset
         return read_string(buffer, str_offset, size, decode_strings)
     if value_type == 0x5:
         str_offset = read_indirect(buffer, offset, parent_bit_size)
         size_bit_size = bit_size
         size_byte_size = 1 << size_bit_size
         size = read_uint(buffer, str_offset - size_byte_size, bit_size)
-        while read_int(buffer, str_offset + size, 0) != 0:
+        while buffer[str_offset + size] != 0:
             size_byte_size <<= 1
             size_bit_size += 1
             size = read_uint(buffer, str_offset - size_byte_size, size_bit_size)
@@ -101,7 +125,7 @@ def read_buffer(buffer, offset, parent_bit_size, packed_type, decode_strings):
             key_offset = keys_vector_offset + i * key_byte_size
             key = read_buffer(buffer, key_offset, key_bit_size, (0x4 << 2) | key_bit_size, decode_strings)
             value_offset = values_offset + i * byte_size
-            value_packed_type = read_uint(buffer, packed_types_offset + i, 0)
+            value_packed_type = buffer[packed_types_offset + i]
             value = read_buffer(buffer, value_offset, bit_size, value_packed_type, decode_strings)
             obj[key] = value
         return obj
@@ -110,24 +134,26 @@ def read_buffer(buffer, offset, parent_bit_size, packed_type, decode_strings):
         arr = []
         items_offset = read_indirect(buffer, offset, parent_bit_size)
         packed_types_offset = items_offset + (length * byte_size)
+        item_value_types = {t >> 2 for t in buffer[packed_types_offset:packed_types_offset + length]}
+        if len(item_value_types) == 1 and next(iter(item_value_types)) in _TYPED_VECTOR_DTYPES:
+            # numbers or bools stored inline, they have the width of the vector like the items of typed vectors
+            return read_typed_array(buffer, items_offset, length, bit_size, item_value_types.pop(), decode_strings)
         for i in range(length):
             item_offset = items_offset + (i * byte_size)
-            packed_type = read_uint(buffer, packed_types_offset + i, 0)
+            packed_type = buffer[packed_types_offset + i]
             arr.append(read_buffer(buffer, item_offset, bit_size, packed_type, decode_strings))
         return arr
     if value_type in [0xb, 0xc, 0xd, 0xe, 0xf, 0x24]:
         length_offset = read_indirect(buffer, offset, parent_bit_size) - byte_size
         length = read_uint(buffer, length_offset, bit_size)
         item_value_type = value_type - 0xb + 0x1
-        packed_type = item_value_type << 2
         items_offset = read_indirect(buffer, offset, parent_bit_size)
-        return read_array(buffer, items_offset, length, bit_size, packed_type, decode_strings)
+        return read_typed_array(buffer, items_offset, length, bit_size, item_value_type, decode_strings)
     if 0x10 <= value_type <= 0x18:
         length = (value_type - 0x10) // 3 + 2
         value_type = ((value_type - 0x10) % 3) + 1
-        packed_type = value_type << 2
         items_offset = read_indirect(buffer, offset, parent_bit_size)
-        return read_array(buffer, items_offset, length, bit_size, packed_type, decode_strings)
+        return read_typed_array(buffer, items_offset, length, bit_size, value_type, decode_strings)
     if value_type == 0x19:
         data_offset = read_indirect(buffer, offset, parent_bit_size)
         size_offset = data_offset - byte_size
@@ -139,8 +165,15 @@ def read_buffer(buffer, offset, parent_bit_size, packed_type, decode_strings):
 
 
 def read_flexbuffer(buffer, decode_strings=True):
-    byte_size = read_uint(buffer, len(buffer) - 1, 0)
+    byte_size = buffer[-1]
     bit_size = {1: 0, 2: 1, 4: 2, 8: 3, 16: 4}[byte_size]
-    packed_type = read_uint(buffer, len(buffer) - 2, 0)
+    packed_type = buffer[-2]
     offset = len(buffer) - 2 - byte_size
     return read_buffer(buffer, offset, bit_size, packed_type, decode_strings)
+
+
+@functools.lru_cache(maxsize=1024)
+def read_flexbuffer_cached(buffer, decode_strings=True):
+    """read_flexbuffer for the options of ops, which are often identical for many ops of a model.
+    buffer must be bytes. The result is shared by all calls with the same buffer and must not be modified."""
+    return read_flexbuffer(buffer, decode_strings)
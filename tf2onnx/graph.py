@@ -17,6 +17,9 @@ from tf2onnx.utils import make_name, port_name, find_opset
 from tf2onnx import optimizer
 from tf2onnx.schemas import get_schema, infer_onnx_shape_dtype
 from tf2onnx import constants
+from tf2onnx.conversion_context import get_context
+from tf2onnx import tensor_store
+from tf2onnx.symbolic_executor import SymbolicShapeInference
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +35,24 @@ class ExternalTensorStorage():
         self.external_tensor_size_threshold = 1024
         self.node_to_modified_value_attr = {}
 
+    def add_tensor(self, name, tensor):
+        """Keep a copy of the data of tensor in the storage. Returns a tensor without data that points to it, tensor
+        itself is left as it is."""
+        self.name_to_tensor_data[name] = bytes(tensor_store.tensor_data(tensor))
+        return make_external_tensor(tensor, [("location", name)])
+
+
+def make_external_tensor(tensor, external_data):
+    """Return a tensor with the name, type and shape of tensor whose data is at external_data, a list of key value
+    pairs. The data of tensor isn't copied."""
+    result = TensorProto(name=tensor.name, doc_string=tensor.doc_string, data_type=tensor.data_type,
+                         dims=tensor.dims, data_location=TensorProto.EXTERNAL)
+    for key, value in external_data:
+        entry = result.external_data.add()
+        entry.key = key
+        entry.value = str(value)
+    return result
+
 class Node(object):
     """A Node - wrapper around onnx nodes that we use for graph manipulations."""
 
@@ -52,6 +73,7 @@ class Node(object):
         for a in node.attribute:
             self._attr[a.name] = a
         self._skip_conversion = skip_conversion
+        self._compact_weight = False
 
     @property
     def input(self):
@@ -104,20 +126,18 @@ class Node(object):
             return external_tensor_storage.node_to_modified_value_attr[self]
         if external_tensor_storage is None or a.type != AttributeProto.TENSOR:
             return a
-        if np.product(a.t.dims) > external_tensor_storage.external_tensor_size_threshold:
-            a = copy.deepcopy(a)
+        # only raw data can be stored externally, tensors of strings stay in the model
+        has_raw_data = a.t.HasField("raw_data") or tensor_store.is_stored(a.t)
+        if has_raw_data and np.product(a.t.dims) > external_tensor_storage.external_tensor_size_threshold:
             tensor_name = self.name.strip() + "_" + str(external_tensor_storage.name_counter)
             for c in '~"#%&*:<>?/\\{|}':
                 tensor_name = tensor_name.replace(c, '_')
             external_tensor_storage.name_counter += 1
-            external_tensor_storage.name_to_tensor_data[tensor_name] = a.t.raw_data
-            external_tensor_storage.node_to_modified_value_attr[self] = a
-            a.t.raw_data = b''
-            a.t.ClearField("raw_data")
-            location = a.t.external_data.add()
-            location.key = "location"
-            location.value = tensor_name
-            a.t.data_location = TensorProto.EXTERNAL
+            # the attr of the model only gets the reference to the data, the node keeps its own value
+            external_attr = AttributeProto(name=a.name, type=a.type)
+            external_attr.t.CopyFrom(external_tensor_storage.add_tensor(tensor_name, a.t))
+            external_tensor_storage.node_to_modified_value_attr[self] = external_attr
+            a = external_attr
         return a
 
     def get_onnx_attrs(self, external_tensor_storage=None):
@@ -195,7 +215,7 @@ class Node(object):
         t = self.get_attr("value", default=None)
         if t is None:
             return False
-        t = numpy_helper.to_array(helper.get_attribute_value(t))
+        t = tensor_store.tensor_to_array(helper.get_attribute_value(t))
         return t.shape == tuple()
 
     def is_graph_input(self):
@@ -284,6 +304,16 @@ class Node(object):
     def need_skip(self):
         return self._skip_conversion
 
+    @property
+    def compact_weight(self):
+        """True if the node restores the dtype of a weight stored in a compact form, see
+        tfjs_utils.make_compact_weight_nodes. Folding it would store the expanded weight in the model."""
+        return self._compact_weight
+
+    @compact_weight.setter
+    def compact_weight(self, val):
+        self._compact_weight = val
+
     @property
     def output_shapes(self):
         """Get output shapes."""
@@ -315,7 +345,7 @@ class Node(object):
 
         t = self.get_attr("value")
         if t:
-            t = numpy_helper.to_array(helper.get_attribute_value(t))
+            t = tensor_store.tensor_to_array(helper.get_attribute_value(t))
             if as_list is True:
                 t = t.tolist()  # t might be scalar after tolist()
         return t
@@ -343,7 +373,7 @@ class Node(object):
         if not t:
             raise ValueError("set tensor value: {} is None".format(self.name))
         t = helper.get_attribute_value(t)
-        onnx_tensor = numpy_helper.from_array(new_val, t.name)
+        onnx_tensor = tensor_store.make_tensor(new_val, t.name)
         del t
         self.set_attr("value", onnx_tensor)
         # track shapes in _output_shapes
@@ -443,15 +473,17 @@ class Graph(object):
     """"Class that provides graph manipulation and matching."""
 
     def __init__(self, nodes, output_shapes=None, dtypes=None, target=None, opset=None, extra_opset=None,
-                 input_names=None, output_names=None, is_subgraph=False, graph_name=None):
+                 input_names=None, output_names=None, is_subgraph=False, graph_name=None, conversion_context=None):
         """Create Graph.
         Args:
             nodes: list of Node()
             output_shapes: dict of tensorflow output shapes
             dtypes: dict of tensorflow dtype
+            conversion_context: ConversionContext the graph belongs to, defaults to the active one
         """
         if target is None:
             target = []
+        self.conversion_context = conversion_context or get_context()
         self._nodes = []
         self._nodes_by_name = {}
         self._output_to_node_name = {}
@@ -472,6 +504,8 @@ class Graph(object):
 
         self._dtypes = dtypes
         self._output_shapes = output_shapes
+        # names of the unknown dims of graph inputs and outputs, emitted as dim_param
+        self._dim_params = {}
 
         self.set_config(target, opset, extra_opset)
 
@@ -533,7 +567,7 @@ class Graph(object):
     def create_new_graph_with_same_config(self):
         """Create a clean graph inheriting current graph's configuration."""
         return Graph([], output_shapes={}, dtypes={}, target=self._target, opset=self._opset,
-                     extra_opset=self.extra_opset, output_names=[])
+                     extra_opset=self.extra_opset, output_names=[], conversion_context=self.conversion_context)
 
     def set_config(self, target=None, opset=None, extra_opset=None):
         """Set graph fields containing conversion options"""
@@ -583,7 +617,7 @@ class Graph(object):
         np_val_flat = np_val.flatten()
         is_bytes = np_val.dtype == np.object and len(np_val_flat) > 0 and isinstance(np_val_flat[0], bytes)
         if raw and not is_bytes:
-            onnx_tensor = numpy_helper.from_array(np_val, name)
+            onnx_tensor = tensor_store.make_tensor(np_val, name)
         else:
             onnx_tensor = helper.make_tensor(name, utils.map_numpy_to_onnx_dtype(np_val.dtype),
                                              np_val.shape, np_val_flat, raw=False)
@@ -758,6 +792,26 @@ class Graph(object):
         self._dtypes = remained_dtypes
         self._output_shapes = remained_shapes
 
+    def release(self):
+        """Drop the nodes and subgraphs of a graph that is no longer used.
+        Graphs, their nodes and their subgraphs reference each other, so without this the nodes and their
+        tensors are only freed by the garbage collector. The graph can't be used afterwards."""
+        sub_graphs = [g for graphs in self.contained_graphs.values() for g in graphs.values()]
+        sub_graphs += [g for graphs in self._input_to_graph.values() for g in graphs.values()]
+        for g in sub_graphs:
+            if g.parent_graph is self:
+                g.release()
+        for node in self._nodes:
+            node.graph = None
+        self._nodes = []
+        self._nodes_by_name = {}
+        self._output_to_node_name = {}
+        self._output_to_consumers = {}
+        self._input_to_graph = {}
+        self.inputs = []
+        self.parent_graph = None
+        self.contained_graphs = {}
+
     def is_empty_input(self, name):
         # in ONNX, operation may have optional input and an empty string may be used
         # in the place of an actual argument's name to indicate a missing argument
@@ -775,9 +829,10 @@ class Graph(object):
                     broken_outputs.add(inp)
         return list(broken_outputs)
 
-    def update_node_shape_dtype(self, node, override=False):
+    def update_node_shape_dtype(self, node, override=False, refine=False):
         """Try the best to infer shapes and dtypes for outputs of the node,
         by default, we respect TF shapes and dtypes.
+        With refine the unknown dims of existing shapes are filled in from the inferred shapes.
         """
         if node.is_const() or node.is_graph_input():
             return
@@ -825,7 +880,9 @@ class Graph(object):
                 logger.debug("Inferred shape for [%s, type: %s] is None, SKIP", node.name, node.type)
             else:
                 existing_shape = self.get_shape(output)
-                if existing_shape is not None and not utils.are_shapes_equal(existing_shape, shape) and not override:
+                if refine and utils.are_shapes_compatible(existing_shape, shape):
+                    shape = utils.merge_shapes(existing_shape, shape)
+                elif existing_shape is not None and not utils.are_shapes_equal(existing_shape, shape) and not override:
                     shape = existing_shape
                 self.set_shape(output, shape)
                 logger.debug("Set shape of [%s] to %s", output, shape)
@@ -895,6 +952,7 @@ class Graph(object):
         self._output_to_consumers = rename_keys(self._output_to_consumers)
         self._dtypes = rename_keys(self._dtypes)
         self._output_shapes = rename_keys(self._output_shapes)
+        self._dim_params = rename_keys(self._dim_params)
         self.outputs = rename_list(self.outputs)
         for node in self._nodes:
             node._input = rename_list(node._input)
@@ -1013,6 +1071,36 @@ class Graph(object):
         utils.make_sure(node is not None, "cannot find node by output id %s", name)
         node.graph._output_shapes[name] = val
 
+    def get_dim_params(self, name):
+        """Get the dim_param names of the graph input or output name, a list with None for unnamed dims."""
+        return self._dim_params.get(name)
+
+    def set_dim_params(self, name, dim_params):
+        """Set the dim_param names of the graph input or output name."""
+        self._dim_params[name] = list(dim_params)
+
+    def name_dynamic_dims(self, input_ids):
+        """Name the unknown dims of the graph inputs and outputs such that an output dim that always equals an
+        input dim shares its dim_param, e.g. the batch dim. Symbolic shape inference tells which dims are equal."""
+        symbolic = SymbolicShapeInference(self)
+        names = {}
+
+        for name in input_ids + self.outputs:
+            shape = self.get_shape(name)
+            dim_params = symbolic.get_dim_params(name)
+            if shape is None or dim_params is None or len(dim_params) != len(shape):
+                continue
+            old_params = self.get_dim_params(name) or [None] * len(shape)
+            res = []
+            for d, param, old_param in zip(shape, dim_params, old_params):
+                if d != -1 or not isinstance(param, str):
+                    res.append(old_param if d == -1 else None)
+                    continue
+                if param not in names:
+                    names[param] = param if param in symbolic.dim_params else utils.make_name("unk")
+                res.append(names[param])
+            self.set_dim_params(name, res)
+
     def copy_shape(self, input_name, output_name):
         """Copy shape from another node."""
         shape = self.get_shape(input_name)
@@ -1089,6 +1177,11 @@ class Graph(object):
             optimize: optimize graph via onnx
             doc: text for doc string of the graph
         """
+        # names generated for unknown dimensions must come from the conversion this graph belongs to
+        with self.conversion_context.activate():
+            return self._make_graph(doc, graph_name, external_tensor_storage)
+
+    def _make_graph(self, doc, graph_name=None, external_tensor_storage=None):
         graph_name = graph_name or self.graph_name
         self.delete_unused_nodes(self.outputs)
         self.topological_sort(self.get_nodes())
@@ -1135,6 +1228,9 @@ class Graph(object):
             # such as at upsample it only checks the float_data field.
             t = op.get_value_attr(external_tensor_storage)
             tensor = helper.get_attribute_value(t)
+            if tensor_store.is_stored(tensor):
+                # the graph keeps the handle, the model gets the data
+                tensor = tensor_store.materialize(tensor)
             tensor.name = op.output[0]
             initializers.append(tensor)
 
@@ -1147,6 +1243,14 @@ class Graph(object):
         if self.opset < 9:
             input_ids += [op.output[0] for op in const_ops]
 
+        # symbolic shape inference is only needed to name the dims when some input dims are unknown
+        if self.parent_graph is None and not self._is_subgraph and \
+                any(-1 in (self.get_shape(name) or []) for name in input_ids):
+            try:
+                self.name_dynamic_dims(input_ids)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.warning("Failed to name the dynamic dims of the graph: %s", ex)
+
         input_tensor_values = self.make_onnx_graph_io(input_ids)
 
         # create output_tensor_values
@@ -1228,6 +1332,9 @@ class Graph(object):
             #utils.make_sure(shape is not None, "missing output shape for " + name)
             if shape is None: logger.warning("missing output shape for %s", name)
 
+            dim_params = self.get_dim_params(name)
+            if shape is not None and dim_params is not None and len(dim_params) == len(shape):
+                shape = [param if d == -1 and param else d for d, param in zip(shape, dim_params)]
             v = utils.make_onnx_inputs_outputs(name, dtype, shape)
             tensor_value_infos.append(v)
         return tensor_value_infos
@@ -1564,7 +1671,15 @@ class Graph(object):
             node = self.get_node_by_output(output, search_in_parent_graphs=False)
             res_set = res_set.union(self._extract_sub_graph_nodes(node, input_checker))
 
-        return list(res_set)
+        # keep the order of the graph, the order of the set depends on where the nodes live in memory.
+        # each node is returned once, even if a rewriter left it in the node list twice.
+        res = []
+        for n in self.get_nodes():
+            if n in res_set:
+                res.append(n)
+                res_set.remove(n)
+        # nodes that can only be found by their outputs come last
+        return res + sorted(res_set, key=lambda n: n.name)
 
     def delete_unused_nodes(self, outputs_name):
         """Delete nodes not in subgraph ending with output_names."""
@@ -1731,6 +1846,7 @@ class GraphUtil(object):
         g = Graph(nodes_to_append, output_shapes, output_dtypes, target, opset_version, extra_opset, None, output_names)
         const_nodes = GraphUtil._parse_graph_initializer(g, graph_proto)
         GraphUtil._parse_graph_input(g, graph_proto, [n.name for n in const_nodes])
+        GraphUtil._parse_graph_dim_params(g, list(graph_proto.input) + list(graph_proto.output))
 
         for n in g.get_nodes():
             for attr_name, attr_val in n.attr.items():
@@ -1773,6 +1889,14 @@ class GraphUtil(object):
 
         return output_shapes, output_dtypes
 
+    @staticmethod
+    def _parse_graph_dim_params(g, value_infos):
+        """Keep the dim_params of graph inputs and outputs."""
+        for value_info in value_infos:
+            tensor_type = value_info.type.tensor_type
+            if tensor_type.HasField("shape") and any(d.HasField("dim_param") for d in tensor_type.shape.dim):
+                g.set_dim_params(value_info.name, [d.dim_param or None for d in tensor_type.shape.dim])
+
     @staticmethod
     def _parse_graph_initializer(g, graph_proto):
         """Get graph initializers and put into Graph object."""
@@ -4,22 +4,66 @@
 """Opset registry."""
 
 import collections
+import collections.abc
 import inspect
+import types
 
 from tf2onnx import constants
 
 # pylint: disable=unused-argument,missing-docstring,invalid-name
 
 
+class OpsMapping(collections.abc.Mapping):
+    """Immutable mapping of op names to handlers [(func, kwargs) tuple] for a set of opsets.
+
+    Returned by tf_op.create_mapping and shared between conversions, so neither the mapping nor the kwargs
+    of the handlers may be modified.
+    """
+
+    def __init__(self, ops_mapping, domain_to_ops_mapping):
+        self._ops = types.MappingProxyType(dict(ops_mapping))
+        # mapping from domain to map of op name to handlers. Used to fetch handlers from different domains
+        self._domain_ops = types.MappingProxyType(
+            {domain: types.MappingProxyType(dict(m)) for domain, m in domain_to_ops_mapping.items()})
+
+    def __getitem__(self, name):
+        return self._ops[name]
+
+    def __iter__(self):
+        return iter(self._ops)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def updated(self, ops_mapping):
+        """Return a new mapping with the handlers in ops_mapping added or overridden."""
+        merged = dict(self._ops)
+        merged.update(ops_mapping)
+        return OpsMapping(merged, self._domain_ops)
+
+    def find_effective_op(self, name, domain=None):
+        """Find the effective version of an op in this mapping.
+           This is used if we need to compose ops from other ops where we'd need to find the
+           op that is going to be used in the final graph, for example there is a custom op
+           that overrides a onnx op ...
+
+        :param name: The operator name.
+        :param domain: The domain to use (optional).
+        """
+        if domain is None:
+            return self._ops.get(name)
+        if domain not in self._domain_ops:
+            return None
+        return self._domain_ops[domain].get(name)
+
+
 class tf_op:
     """Class to implement the decorator to register handlers that map tf to onnx."""
 
     # Maps domains (string) to lists (idx represents opset) of dicts (key = op to handle, value = handler)
     _OPSETS = collections.OrderedDict()
-    # Cache of mapping for current domain and opset. Maps op names to handlers [(func, kwargs) tuple]
-    _MAPPING = None
-    # Cache of mapping from domain to map of op name to handlers. Used to fetch handlers from different domains
-    _DOMAIN_MAPPING = None
+    # Cache of the mappings returned by create_mapping, keyed by (onnx opset, frozenset of extra opsets)
+    _MAPPING_CACHE = {}
 
     def __init__(self, name, domain=constants.ONNX_DOMAIN, **kwargs):
         """Called decorator from decorator.
@@ -68,6 +112,7 @@ class tf_op:
         opset_dict = opset[version]
         for name in names:
             opset_dict[name] = (func, kwargs)
+        tf_op._MAPPING_CACHE = {}
 
     @staticmethod
     def get_opsets():
@@ -75,7 +120,8 @@ class tf_op:
 
     @staticmethod
     def create_mapping(max_onnx_opset_version, extra_opsets):
-        """Create the final mapping dictionary by stacking domains and opset versions.
+        """Create the final mapping by stacking domains and opset versions.
+        The result is an immutable OpsMapping that is cached per opset and extra_opsets.
 
         :param max_onnx_opset_version: The highest onnx opset the resulting graph may use.
         :param extra_opsets: Extra opsets the resulting graph may use.
@@ -84,6 +130,12 @@ class tf_op:
         if extra_opsets:
             for extra_opset in extra_opsets:
                 mapping[extra_opset.domain] = extra_opset.version
+        key = (max_onnx_opset_version, frozenset(mapping.items()))
+        cache = tf_op._MAPPING_CACHE
+        ops_mapping = cache.get(key)
+        if ops_mapping is not None:
+            return ops_mapping
+
         ops_mapping = {}
         domain_to_ops_mapping = collections.defaultdict(dict)
         for domain, opsets in tf_op.get_opsets().items():
@@ -94,28 +146,10 @@ class tf_op:
                         domain_to_ops_mapping[domain].update(ops_mapping)
                         ops_mapping.update(op_map)
 
-        tf_op._MAPPING = ops_mapping
-        tf_op._DOMAIN_MAPPING = domain_to_ops_mapping
+        ops_mapping = OpsMapping(ops_mapping, domain_to_ops_mapping)
+        cache[key] = ops_mapping
         return ops_mapping
 
-    @staticmethod
-    def find_effective_op(name, domain=None):
-        """Find the effective version of an op create_mapping.
-           This is used if we need to compose ops from other ops where we'd need to find the
-           op that is going to be used in the final graph, for example there is a custom op
-           that overrides a onnx op ...
-
-        :param name: The operator name.
-        :param domain: The domain to use (optional).
-        """
-        if domain is None:
-            map_info = tf_op._MAPPING.get(name)
-        else:
-            map_info = tf_op._DOMAIN_MAPPING[domain].get(name)
-        if map_info is None:
-            return None
-        return map_info
-
 
 class tfl_op:
     """Class to implement the decorator to register handlers that map tflite to tf or onnx."""
@@ -144,4 +178,4 @@ class tfl_op:
 
     @staticmethod
     def create_tfl_to_tf_mapping():
-        return tf_op.get_opsets()['com.google.tensorflow'][0]
+        return types.MappingProxyType(tf_op.get_opsets()['com.google.tensorflow'][0])
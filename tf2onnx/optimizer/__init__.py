@@ -6,6 +6,7 @@ from collections import OrderedDict
 import copy
 
 from .const_fold_optimizer import ConstFoldOptimizer
+from .shape_fold_optimizer import ShapeFoldOptimizer
 from .einsum_optimizer import EinsumOptimizer
 from .identity_optimizer import IdentityOptimizer
 from .merge_duplicated_nodes_optimizer import MergeDuplicatedNodesOptimizer
@@ -24,6 +25,7 @@ _optimizers = OrderedDict([
     ("optimize_transpose", TransposeOptimizer),
     ("remove_redundant_upsample", UpsampleOptimizer),
     ("fold_constants", ConstFoldOptimizer),
+    ("fold_shapes", ShapeFoldOptimizer),
     ("const_dequantize_optimizer", ConstDequantizeOptimizer),
     ("loop_optimizer", LoopOptimizer),
     # merge_duplication should be used after optimize_transpose
@@ -44,6 +46,12 @@ def _get_optimizers():
 
 def optimize_graph(graph, catch_errors=True, optimizers=None):
     """ Optimize graph, return optimized graph. Catch errors and restore old graph if catch_errors is True"""
+    # generate names in the conversion the graph belongs to
+    with graph.conversion_context.activate():
+        return _optimize_graph(graph, catch_errors, optimizers)
+
+
+def _optimize_graph(graph, catch_errors, optimizers):
     logger = logging.getLogger(__name__)
     logger.info("Optimizing ONNX model")
 
@@ -51,19 +59,27 @@ def optimize_graph(graph, catch_errors=True, optimizers=None):
     opts = _get_optimizers() if optimizers is None else optimizers
     continue_flag = True
     iteration = 0
+    input_graph = graph
     while continue_flag:
         continue_flag = False
         for name, factory in opts.items():
             logger.verbose("Apply %s", name)
             if catch_errors:
+                current = None
+                optimized = graph
                 try:
                     current = copy.deepcopy(graph)
                     opt = factory()
-                    graph = opt.optimize(current, iteration) or graph
+                    optimized = opt.optimize(current, iteration) or graph
                     continue_flag = continue_flag or opt.graph_been_opt
                 except Exception:  # pylint: disable=broad-except
                     # if current optimizer fails, continue with other optimizers
                     logger.warning("Failed to apply %s", name, exc_info=1)
+                # free the copies that are no longer used right away instead of leaving them to the garbage collector
+                for discarded in [graph, current]:
+                    if discarded is not None and discarded is not optimized and discarded is not input_graph:
+                        discarded.release()
+                graph = optimized
             else:
                 opt = factory()
                 graph = opt.optimize(graph, iteration)
@@ -6,6 +6,8 @@
 """
 
 import numpy as np
+from tf2onnx import utils
+from tf2onnx.symbolic_executor import SymbolicShapeInference
 from tf2onnx.utils import ONNX_DTYPE_NAMES  # lgtm[py/unsafe-cyclic-import]
 from .optimizer_base import GraphOptimizerBase  # lgtm[py/unsafe-cyclic-import]
 
@@ -35,6 +37,12 @@ class BackToBackOptimizer(GraphOptimizerBase):
         return self._apply_optimization(graph, self._optimize_at_current_graph_level)
 
     def _optimize_at_current_graph_level(self, g):
+        # merging reshapes needs the symbolic shapes, they are inferred once per pass. The merges and the other
+        # handlers keep the shapes of the remaining tensors, the shapes of new tensors are unknown.
+        symbolic = None
+        if any(n.type == "Reshape" and n.inputs[0] is not None and n.inputs[0].type == "Reshape"
+               for n in g.get_nodes()):
+            symbolic = SymbolicShapeInference(g)
         for optype, handler in _func_map.items():
             # candidate nodes for removal/optimization
             nodes = [n for n in g.get_nodes() if n.type in optype]
@@ -64,14 +72,14 @@ class BackToBackOptimizer(GraphOptimizerBase):
                     if set(node.output) & set(g.outputs):
                         # if this node is part of graph outputs, skip
                         continue
-                    q2 = handler(g, node, consumer_nodes)
+                    q2 = handler(g, node, consumer_nodes, symbolic)
                     # add more nodes which can now be processed
                     q.extend(q2)
         return g
 
     @staticmethod
     @_register_func("Cast")
-    def _optimize_cast(g, node, consumer_nodes):
+    def _optimize_cast(g, node, consumer_nodes, symbolic):
         """remove long chains of cast ops"""
         q2 = []
         type1 = node.get_attr('to').i
@@ -124,7 +132,7 @@ class BackToBackOptimizer(GraphOptimizerBase):
 
     @staticmethod
     @_register_func("Transpose")
-    def _optimize_transpose(g, node, consumer_nodes):
+    def _optimize_transpose(g, node, consumer_nodes, symbolic):
         """remove long chains of transpose ops"""
         t1 = list(node.get_attr('perm').ints)
         q2 = []
@@ -151,7 +159,7 @@ class BackToBackOptimizer(GraphOptimizerBase):
 
     @staticmethod
     @_register_func(('Squeeze', 'Unsqueeze'))
-    def _optimize_squeeze_unsqueeze(g, node, consumer_nodes):
+    def _optimize_squeeze_unsqueeze(g, node, consumer_nodes, symbolic):
         """remove pairs of squeeze-unsqueeze nodes"""
         if node.type != 'Squeeze' or len(consumer_nodes) != 1:
             # no need to return any value, since not removing long chain of nodes
@@ -189,7 +197,7 @@ class BackToBackOptimizer(GraphOptimizerBase):
 
     @staticmethod
     @_register_func(('Conv', 'BatchNormalization'))
-    def _optimize_conv_batchnorm_fusion(g, node, consumer_nodes):
+    def _optimize_conv_batchnorm_fusion(g, node, consumer_nodes, symbolic):
         """fuse conv and batchnorm"""
         if node.type != 'Conv' or len(consumer_nodes) != 1:
             # can only fuse 1 conv + batchnorm
@@ -255,7 +263,7 @@ class BackToBackOptimizer(GraphOptimizerBase):
 
     @staticmethod
     @_register_func('Reshape')
-    def _optimize_reshape_reshape(g, node, consumer_nodes):
+    def _optimize_reshape_reshape(g, node, consumer_nodes, symbolic):
         """remove sequential reshape nodes"""
         if node.type != 'Reshape' or len(consumer_nodes) != 1:
             return []
@@ -264,6 +272,29 @@ class BackToBackOptimizer(GraphOptimizerBase):
         if node2.type != 'Reshape':
             return []
 
-        g.replace_inputs(node2, [node.input[0], node2.input[1]])
+        shape_input = node2.input[1]
+        if node2.inputs[1].is_const() and not node2.get_attr_value("allowzero", 0):
+            shape = node2.inputs[1].get_tensor_value(as_list=True)
+            if 0 in shape:
+                # a 0 copies a dim of the first reshape's output, which the merged reshape only sees if it is
+                # a known dim or the same dim of the first reshape's input
+                if symbolic is None:
+                    return []
+                inp_shape = symbolic.get_shape(node.input[0])
+                mid_shape = symbolic.get_shape(node.output[0])
+                if inp_shape is None or mid_shape is None:
+                    return []
+                new_shape = list(shape)
+                for i, d in enumerate(shape):
+                    if d != 0:
+                        continue
+                    if mid_shape[i].is_const():
+                        new_shape[i] = mid_shape[i].constant
+                    elif i >= len(inp_shape) or inp_shape[i] != mid_shape[i]:
+                        return []
+                if new_shape != shape:
+                    shape_input = g.make_const(utils.make_name("new_shape"), np.array(new_shape, np.int64)).output[0]
+
+        g.replace_inputs(node2, [node.input[0], shape_input])
         g.remove_node(node.name)
         return []
@@ -2,7 +2,8 @@
 
 
 """const dequantize Optimizer.
-   if a dequantize op's inputs are const we may be able to fold it through the next op
+   if a dequantize op's inputs are const we may be able to fold it through the next op,
+   the same goes for a Cast expanding a float16 const
 """
 
 from .optimizer_base import GraphOptimizerBase
@@ -37,7 +38,7 @@ class ConstDequantizeOptimizer(GraphOptimizerBase):
         if node.type not in ["Transpose", "Reshape", "Unsqueeze"]:
             return False
         dequant_node = node.inputs[0]
-        if dequant_node.type != "DequantizeLinear":
+        if dequant_node.type != "DequantizeLinear" and not dequant_node.compact_weight:
             return False
         if len(graph.find_output_consumers(dequant_node.output[0])) > 1:
             return False
@@ -45,7 +46,8 @@ class ConstDequantizeOptimizer(GraphOptimizerBase):
             return False
         if not self._all_inputs_are_const(dequant_node.inputs):
             return False
-        if len(dequant_node.inputs[1].get_tensor_value(as_list=False).flatten()) != 1:
+        if dequant_node.type == "DequantizeLinear" and \
+                len(dequant_node.inputs[1].get_tensor_value(as_list=False).flatten()) != 1:
             # If using per-channel quantization, we must compute the new axis
             old_axis = dequant_node.get_attr_value("axis")
             input_shape = dequant_node.inputs[0].get_tensor_value(as_list=False).shape
@@ -55,6 +57,7 @@ class ConstDequantizeOptimizer(GraphOptimizerBase):
             dequant_node.set_attr("axis", new_axis)
         graph.replace_input(node, node.input[0], dequant_node.input[0], 0)
         const_outputs = ConstFoldOptimizer.compute_const_folding(node, graph)
+        graph.set_shape(dequant_node.output[0], graph.get_shape(node.output[0]))
         graph.replace_all_inputs(node.output[0], dequant_node.output[0])
         graph.remove_node(node.name)
         dequant_const = dequant_node.inputs[0]
@@ -59,6 +59,9 @@ class ConstFoldOptimizer(GraphOptimizerBase):
         if node.type in skip_type:
             return True
 
+        if node.compact_weight:
+            return True
+
         return False
 
     def _fold_node(self, node, graph):
@@ -74,6 +77,10 @@ class ConstFoldOptimizer(GraphOptimizerBase):
             self.logger.debug("need to add function to fold op %s whose op_type is %s", node.name, node.type)
         return False
 
+    @staticmethod
+    def can_compute_const_folding(node):
+        return node.type in _func_map
+
     @staticmethod
     def compute_const_folding(node, graph):
         return _func_map[node.type](node, graph)
@@ -8,9 +8,11 @@
 """
 
 from collections import defaultdict
+import hashlib
 
 import numpy as np
 
+from tf2onnx.tensor_store import tensor_data
 from .optimizer_base import GraphOptimizerBase
 
 # pylint: disable=logging-not-lazy,unused-argument,missing-docstring
@@ -56,7 +58,8 @@ class MergeDuplicatedNodesOptimizer(GraphOptimizerBase):
             tensor_data_hash = None
             if node.is_const():
                 # Many constants have the same size so this is helpful
-                tensor_data_hash = hash(node.attr['value'].t.raw_data)
+                # stored tensors are hashed straight from the mapped file
+                tensor_data_hash = hashlib.sha1(tensor_data(node.attr['value'].t)).digest()
             res[(node.type, tuple(node.input), tensor_data_hash)].append(node)
         return res
 
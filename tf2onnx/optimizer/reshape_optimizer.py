@@ -6,13 +6,15 @@
    Even if some of the dimensions are non-constant, they can often be replaced with -1 or 0.
    Specifically, optimizes the pattern:  node -> shape -> [computation] -> reshape
                                              `-----------------------------^
+   The dims are tracked with symbolic shape inference, so the shape may also come from another tensor with the
+   same dims. Reshape and Expand ops whose output has the same symbolic shape as their input are removed.
 """
 
 from collections import Counter
 import numpy as np
 from tf2onnx import utils
 from tf2onnx.graph_builder import GraphBuilder
-from tf2onnx.symbolic_executor import SymbolicExecutor, SymbolicTensorElement, SymbolicExecutionException
+from tf2onnx.symbolic_executor import SymbolicShapeInference, SymbolicTensorElement
 from .optimizer_base import GraphOptimizerBase
 
 # pylint: disable=logging-not-lazy,unused-argument,missing-docstring
@@ -30,37 +32,43 @@ class ReshapeOptimizer(GraphOptimizerBase):
         graph_changed = True
         while graph_changed:
             graph_changed = False
-            ops = graph.get_nodes()
-            for op in ops:
-                if op.type == "Reshape" and self._optimize_reshape(op, graph):
+            symbolic = SymbolicShapeInference(graph)
+            # the symbolic shapes of the outputs of changed nodes are recomputed in the next round
+            changed_outputs = set()
+            for op in graph.get_nodes():
+                if op.type not in ["Reshape", "Expand"] or op.input[0] in changed_outputs:
+                    continue
+                if self._remove_noop(op, graph, symbolic) or \
+                        op.type == "Reshape" and self._optimize_reshape(op, graph, symbolic):
+                    changed_outputs.update(op.output)
                     graph_changed = True
                     self.graph_been_opt = True
         return graph
 
-    def _optimize_reshape(self, node, graph):
-        if node.inputs[1].is_const():
+    @staticmethod
+    def _remove_noop(node, graph, symbolic):
+        """Reshape and Expand don't do anything if their output has the same symbolic shape as their input"""
+        if node.output[0] in graph.outputs:
             return False
-        inp_shape = graph.get_shape(node.input[0])
+        inp_shape = symbolic.get_shape(node.input[0])
+        if inp_shape is None or inp_shape != symbolic.get_shape(node.output[0]):
+            return False
+        graph.replace_all_inputs(node.output[0], node.input[0])
+        graph.remove_node(node.name)
+        return True
+
+    def _optimize_reshape(self, node, graph, symbolic):
+        if node.inputs[1].is_const() or node.get_attr_value("allowzero", 0):
+            return False
+        inp_shape = symbolic.get_shape(node.input[0])
         if inp_shape is None:
             # The rank must be known
             return False
-        feed_dict = {}
-        for n in graph.find_output_consumers(node.input[0]):
-            if n.type == "Shape":
-                symbolic_shape = []
-                for i, d in enumerate(inp_shape):
-                    if d == -1:
-                        # Make a variable representing each unknown dim
-                        symbolic_shape.append(SymbolicTensorElement.from_variable(i))
-                    else:
-                        symbolic_shape.append(SymbolicTensorElement.from_const(d))
-                feed_dict[n.output[0]] = np.array(symbolic_shape, np.object)
-        try:
-            symbolic_res = SymbolicExecutor(graph).compute_outputs([node.input[1]], feed_dict)
-        except SymbolicExecutionException:
+        target = symbolic.get_value(node.input[1])
+        if target is None or target.size == 0:
             return False
-        utils.make_sure(len(symbolic_res[0].shape) == 1, "Shape must have rank 1")
-        symbolic_shape = symbolic_res[0].tolist()
+        utils.make_sure(len(target.shape) == 1, "Shape must have rank 1")
+        symbolic_shape = SymbolicTensorElement.np_array(target).tolist()
         product_cnt = len([val for val in symbolic_shape if val.has_multiple_terms()])
         idx_cnt = len([val for val in symbolic_shape if val.is_single_var()])
         if product_cnt > 1:
@@ -75,7 +83,9 @@ class ReshapeOptimizer(GraphOptimizerBase):
             def get_shift(val, i):
                 if not val.is_single_var():
                     return None
-                return val.terms[0] - i
+                # the dims of the input are variables unless they are known
+                shifts = [j - i for j, d in enumerate(inp_shape) if d == val]
+                return shifts[0] if shifts else None
             shifts = [get_shift(val, i) for i, val in enumerate(symbolic_shape)]
             # Find the most popular shift
             most_common = Counter(s for s in shifts if s is not None).most_common(1)
@@ -91,6 +101,11 @@ class ReshapeOptimizer(GraphOptimizerBase):
         if new_shape.count(-1) > 1:
             return False
 
+        if graph.get_shape(node.output[0]) is None:
+            out_shape = symbolic.get_shape(node.output[0])
+            if out_shape is not None:
+                graph.set_shape(node.output[0], [d.constant if d.is_const() else -1 for d in out_shape])
+
         new_reshape_shape = None
         if shift > 0:
             new_shape = [1] * shift + new_shape
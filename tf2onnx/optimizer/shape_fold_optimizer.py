@@ -0,0 +1,357 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""shape fold Optimizer.
+   Replaces Shape and Size ops whose input has a known shape with consts and folds the integer arithmetic
+   handlers emit on shapes, for example Shape -> Gather -> Unsqueeze -> Concat -> Reshape becomes a Reshape
+   with a const shape once the input shape is static.
+"""
+
+from functools import reduce
+
+import numpy as np
+from onnx import numpy_helper
+from .const_fold_optimizer import ConstFoldOptimizer
+
+# pylint: disable=logging-not-lazy,unused-argument,missing-docstring
+
+# key is op_type, value is the function to compute outputs
+# the schema of function is: inputs are (node, list of input values), output is a list of constant values or
+# None if the node can't be folded.
+_func_map = {}
+
+# shape arithmetic works on small tensors, bigger consts are left to the ConstFoldOptimizer
+_MAX_FOLD_SIZE = 1024
+
+
+def _register_func(op_type):
+    def _internal_fun(func):
+        _func_map[op_type] = func
+        return func
+
+    return _internal_fun
+
+
+def _is_shape_value(value):
+    return value.dtype.kind in "iub" and value.size <= _MAX_FOLD_SIZE
+
+
+def _is_static_shape(shape):
+    return shape is not None and all(d >= 0 for d in shape)
+
+
+class ShapeFoldOptimizer(ConstFoldOptimizer):
+    """With refine_shapes the shapes of the graph inputs are first propagated through the graph with onnx shape
+    inference, filling in the dims that are unknown. This is used when the graph is specialized for static input
+    shapes and is too slow to do on every optimizer iteration."""
+
+    def __init__(self, refine_shapes=False):
+        super(ShapeFoldOptimizer, self).__init__()
+        self._refine_shapes = refine_shapes
+        self._folded_consumers = []
+
+    def _optimize_at_current_graph_level(self, graph):
+        graph_changed = True
+        while graph_changed:
+            graph_changed = self._refine_shapes and self.refine_graph_shapes(graph)
+            self._folded_consumers = []
+            for op in graph.get_nodes():
+                if self._should_skip(op) or self._is_graph_output(op, graph):
+                    continue
+                if self._fold_shape_node(op, graph):
+                    graph_changed = True
+                    self.graph_been_opt = True
+            if not self._refine_shapes:
+                self._refine_consumer_shapes(graph, self._folded_consumers)
+        return graph
+
+    def _replace_node_with_const(self, node, graph, vals):
+        self._folded_consumers.extend(c for out in node.output for c in graph.find_output_consumers(out))
+        super(ShapeFoldOptimizer, self)._replace_node_with_const(node, graph, vals)
+
+    @staticmethod
+    def _refine_consumer_shapes(graph, consumers):
+        """The consts that replaced the folded nodes can make the shapes of their consumers known, fill in the
+        unknown dims downstream as far as they change."""
+        queue = list(consumers)
+        while queue:
+            node = queue.pop()
+            if graph.get_node_by_name(node.name) is not node:
+                continue
+            before = [graph.get_shape(out) for out in node.output]
+            graph.update_node_shape_dtype(node, refine=True)
+            for out, shape in zip(node.output, before):
+                if graph.get_shape(out) != shape:
+                    queue.extend(graph.find_output_consumers(out))
+
+    @staticmethod
+    def refine_graph_shapes(graph):
+        """Fill in the unknown dims of the shapes in graph by propagating the shapes of its inputs.
+        Returns True if a shape changed."""
+        changed = False
+        graph.topological_sort(graph.get_nodes())
+        for node in graph.get_nodes():
+            before = [graph.get_shape(out) for out in node.output]
+            graph.update_node_shape_dtype(node, refine=True)
+            changed = changed or before != [graph.get_shape(out) for out in node.output]
+        return changed
+
+    def _fold_shape_node(self, node, graph):
+        """Replace node with consts if its outputs only depend on known shapes and consts. Returns True if the
+        graph changed."""
+        if node.type in ["Shape", "Size"]:
+            shape = graph.get_shape(node.input[0])
+            if not _is_static_shape(shape):
+                return False
+            if node.type == "Size":
+                value = np.array(np.prod(shape, dtype=np.int64), dtype=np.int64)
+            else:
+                # Shape-15 can return a slice of the shape
+                start = node.get_attr_value("start", 0)
+                end = node.get_attr_value("end", len(shape))
+                value = np.array(shape[start:end], dtype=np.int64)
+            self._replace_node_with_const(node, graph, [value])
+            return True
+
+        if node.type in ["Gather", "Slice"] and node.inputs[0] and node.inputs[0].type == "Shape":
+            return self._fold_partial_shape(node, graph)
+
+        if not self._all_inputs_are_const(node.inputs):
+            return False
+        values = [inp.get_tensor_value(as_list=False) if inp else None for inp in node.inputs]
+        if not all(_is_shape_value(v) for v in values if v is not None):
+            return False
+        if node.type in _func_map:
+            const_outputs = _func_map[node.type](node, values)
+        elif self.can_compute_const_folding(node):
+            const_outputs = self.compute_const_folding(node, graph)
+        else:
+            self.logger.debug("need to add function to fold op %s whose op_type is %s", node.name, node.type)
+            return False
+        if const_outputs is None or any(v.size > _MAX_FOLD_SIZE for v in const_outputs):
+            return False
+        self._replace_node_with_const(node, graph, const_outputs)
+        return True
+
+    def _fold_partial_shape(self, node, graph):
+        """Gather and Slice can pick the known dims out of a shape in which other dims are unknown."""
+        shape_node = node.inputs[0]
+        shape = graph.get_shape(shape_node.input[0])
+        if shape is None or not self._all_inputs_are_const(node.inputs[1:]):
+            return False
+        start = shape_node.get_attr_value("start", 0)
+        end = shape_node.get_attr_value("end", len(shape))
+        # unknown dims are -1, which a real dim never is
+        values = [np.array(shape[start:end], dtype=np.int64)]
+        values += [inp.get_tensor_value(as_list=False) if inp else None for inp in node.inputs[1:]]
+        const_outputs = _func_map[node.type](node, values)
+        if const_outputs is None or (const_outputs[0] < 0).any():
+            return False
+        self._replace_node_with_const(node, graph, const_outputs)
+        return True
+
+    @staticmethod
+    def _axes(node, values, index, opset_version):
+        """The axes of node, an attribute before opset_version and the input at index from then on."""
+        if node.graph.opset < opset_version:
+            return node.get_attr_value("axes")
+        if len(values) > index and values[index] is not None:
+            return values[index].tolist()
+        return None
+
+    @staticmethod
+    @_register_func("Gather")
+    def _fold_gather(node, values):
+        data, indices = values
+        return [np.take(data, indices, axis=node.get_attr_value("axis", 0))]
+
+    @staticmethod
+    @_register_func("Slice")
+    def _fold_slice(node, values):
+        data = values[0]
+        if node.graph.opset >= 10:
+            starts, ends, axes, steps = (values[1:] + [None] * 4)[:4]
+            starts, ends = starts.tolist(), ends.tolist()
+            axes = axes.tolist() if axes is not None else None
+            steps = steps.tolist() if steps is not None else None
+        else:
+            starts, ends = node.get_attr_value("starts"), node.get_attr_value("ends")
+            axes, steps = node.get_attr_value("axes"), None
+        if axes is None:
+            axes = list(range(len(starts)))
+        if steps is None:
+            steps = [1] * len(starts)
+        slices = [slice(None)] * data.ndim
+        for axis, start, end, step in zip(axes, starts, ends, steps):
+            slices[axis] = slice(start, end, step)
+        return [data[tuple(slices)]]
+
+    @staticmethod
+    @_register_func("Squeeze")
+    def _fold_squeeze(node, values):
+        data = values[0]
+        axes = ShapeFoldOptimizer._axes(node, values, 1, 13)
+        if axes is None:
+            return [np.squeeze(data)]
+        return [np.squeeze(data, axis=tuple(axes))]
+
+    @staticmethod
+    @_register_func("Add")
+    def _fold_add(node, values):
+        return [np.add(*values).astype(values[0].dtype)]
+
+    @staticmethod
+    @_register_func("Sub")
+    def _fold_sub(node, values):
+        return [np.subtract(*values).astype(values[0].dtype)]
+
+    @staticmethod
+    @_register_func("Mul")
+    def _fold_mul(node, values):
+        return [np.multiply(*values).astype(values[0].dtype)]
+
+    @staticmethod
+    @_register_func("Div")
+    def _fold_div(node, values):
+        a, b = values
+        if (b == 0).any():
+            return None
+        # integer Div truncates towards zero
+        return [(np.sign(a) * np.sign(b) * (np.abs(a) // np.abs(b))).astype(a.dtype)]
+
+    @staticmethod
+    @_register_func("Mod")
+    def _fold_mod(node, values):
+        a, b = values
+        if (b == 0).any():
+            return None
+        if node.get_attr_value("fmod", 0):
+            return [np.fmod(a, b).astype(a.dtype)]
+        return [np.mod(a, b).astype(a.dtype)]
+
+    @staticmethod
+    @_register_func("Neg")
+    def _fold_neg(node, values):
+        return [np.negative(values[0])]
+
+    @staticmethod
+    @_register_func("Abs")
+    def _fold_abs(node, values):
+        return [np.abs(values[0])]
+
+    @staticmethod
+    @_register_func("Min")
+    def _fold_min(node, values):
+        return [reduce(np.minimum, values).astype(values[0].dtype)]
+
+    @staticmethod
+    @_register_func("Max")
+    def _fold_max(node, values):
+        return [reduce(np.maximum, values).astype(values[0].dtype)]
+
+    @staticmethod
+    @_register_func("Sum")
+    def _fold_sum(node, values):
+        return [reduce(np.add, values).astype(values[0].dtype)]
+
+    @staticmethod
+    def _fold_reduce(node, values, np_func, opset_version):
+        axes = ShapeFoldOptimizer._axes(node, values, 1, opset_version)
+        if not axes and node.get_attr_value("noop_with_empty_axes", 0):
+            return [values[0]]
+        axes = tuple(axes) if axes else None
+        keepdims = bool(node.get_attr_value("keepdims", 1))
+        return [np.array(np_func(values[0], axis=axes, keepdims=keepdims), dtype=values[0].dtype)]
+
+    @staticmethod
+    @_register_func("ReduceProd")
+    def _fold_reduce_prod(node, values):
+        return ShapeFoldOptimizer._fold_reduce(node, values, np.prod, 18)
+
+    @staticmethod
+    @_register_func("ReduceSum")
+    def _fold_reduce_sum(node, values):
+        return ShapeFoldOptimizer._fold_reduce(node, values, np.sum, 13)
+
+    @staticmethod
+    @_register_func("ReduceMin")
+    def _fold_reduce_min(node, values):
+        return ShapeFoldOptimizer._fold_reduce(node, values, np.min, 18)
+
+    @staticmethod
+    @_register_func("ReduceMax")
+    def _fold_reduce_max(node, values):
+        return ShapeFoldOptimizer._fold_reduce(node, values, np.max, 18)
+
+    @staticmethod
+    @_register_func("Range")
+    def _fold_range(node, values):
+        start, limit, delta = values
+        if delta == 0:
+            return None
+        return [np.arange(start, limit, delta).astype(start.dtype)]
+
+    @staticmethod
+    @_register_func("Equal")
+    def _fold_equal(node, values):
+        return [np.equal(*values)]
+
+    @staticmethod
+    @_register_func("Less")
+    def _fold_less(node, values):
+        return [np.less(*values)]
+
+    @staticmethod
+    @_register_func("LessOrEqual")
+    def _fold_less_or_equal(node, values):
+        return [np.less_equal(*values)]
+
+    @staticmethod
+    @_register_func("Greater")
+    def _fold_greater(node, values):
+        return [np.greater(*values)]
+
+    @staticmethod
+    @_register_func("GreaterOrEqual")
+    def _fold_greater_or_equal(node, values):
+        return [np.greater_equal(*values)]
+
+    @staticmethod
+    @_register_func("Not")
+    def _fold_not(node, values):
+        return [np.logical_not(values[0])]
+
+    @staticmethod
+    @_register_func("And")
+    def _fold_and(node, values):
+        return [np.logical_and(*values)]
+
+    @staticmethod
+    @_register_func("Or")
+    def _fold_or(node, values):
+        return [np.logical_or(*values)]
+
+    @staticmethod
+    @_register_func("Where")
+    def _fold_where(node, values):
+        cond, x, y = values
+        return [np.where(cond, x, y).astype(x.dtype)]
+
+    @staticmethod
+    @_register_func("Expand")
+    def _fold_expand(node, values):
+        data, shape = values
+        if np.prod(shape) > _MAX_FOLD_SIZE:
+            return None
+        return [data * np.ones(shape.tolist(), dtype=data.dtype)]
+
+    @staticmethod
+    @_register_func("ConstantOfShape")
+    def _fold_constant_of_shape(node, values):
+        shape = values[0].tolist()
+        if np.prod(shape) > _MAX_FOLD_SIZE:
+            return None
+        value = node.get_attr("value")
+        value = numpy_helper.to_array(value.t) if value else np.array([0], dtype=np.float32)
+        return [np.full(shape, value.flatten()[0], dtype=value.dtype)]
+
@@ -9,6 +9,7 @@ import numpy as np
 import onnx
 from tf2onnx.constants import NCHW_TO_NHWC, NHWC_TO_NCHW, NCDHW_TO_NDHWC, NDHWC_TO_NCDHW, TARGET_CHANNELS_LAST
 from .. import utils
+from ..symbolic_executor import SymbolicShapeInference
 from .optimizer_base import GraphOptimizerBase
 
 
@@ -89,6 +90,8 @@ class TransposeOptimizer(GraphOptimizerBase):
             self._g.topological_sort(self._g.get_nodes())
 
     def post_optimize_action(self):
+        symbolic = []
+
         def _calculate_new_shape(graph, op):
             input_shape = graph.get_shape(op.input[0])
             tagged_shape = [d if d == 1 else "var" + str(i) for i, d in enumerate(input_shape)]
@@ -105,6 +108,17 @@ class TransposeOptimizer(GraphOptimizerBase):
                 new_shape = [input_shape[p] for p in perm]
                 return graph.make_const(utils.make_name("new_shape"), np.array(new_shape, dtype=np.int64)).output[0]
 
+            # symbolic shape inference may know more dims, unknown dims that stay in place are copied with 0
+            if not symbolic:
+                symbolic.append(SymbolicShapeInference(graph))
+            symbolic_shape = symbolic[0].get_shape(op.input[0])
+            if symbolic_shape is not None and len(symbolic_shape) == len(input_shape):
+                new_shape = [symbolic_shape[p].constant if symbolic_shape[p].is_const() else 0 if p == i else -1
+                             for i, p in enumerate(perm)]
+                if new_shape.count(-1) <= 1:
+                    return graph.make_const(utils.make_name("new_shape"),
+                                            np.array(new_shape, dtype=np.int64)).output[0]
+
             # reshape requires tha output shape can only contain one -1, if not some extra op needed.
             input_shape = graph.make_node("Shape", [op.input[0]]).output[0]
             indice = graph.make_const(utils.make_name("indice"), np.array(perm, np.int64)).output[0]
@@ -343,8 +357,9 @@ class TransposeOptimizer(GraphOptimizerBase):
         return True
 
     def _cost_to_transpose(self, node, inp_id):
-        if node.type in ["Const", "Transpose"]:
-            # Transposes can be combined/folded, so there is no additional cost
+        if node.type in ["Const", "Transpose"] or node.compact_weight:
+            # Transposes can be combined/folded, so there is no additional cost.
+            # Transposes of compact weights are folded into their data by the const dequantize optimizer.
             return 0
         prod = 1
         shape = self._g.get_shape(inp_id)
@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.ort_optimization - apply the graph optimizations of onnxruntime to a converted model offline
+"""
+
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import onnx
+from onnx import TensorProto
+from onnx.external_data_helper import uses_external_data
+
+from tf2onnx import logging, utils
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZATION_LEVELS = ["basic", "extended", "all"]
+
+# session start-up times in seconds of the model and of the optimized model saved at path
+OrtOptimizationResult = namedtuple("OrtOptimizationResult", ["path", "startup_time", "optimized_startup_time"])
+
+
+def ort_optimized_path(model_path, ort_format=False):
+    """Path of the optimized model saved next to the model at model_path."""
+    base, _ = os.path.splitext(model_path)
+    return base + (".ort" if ort_format else ".optimized.onnx")
+
+
+def _session_options(ort, level=None):
+    options = ort.SessionOptions()
+    if level is None:
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    else:
+        options.graph_optimization_level = {
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[level]
+    return options
+
+
+def _start_session(ort, path, options, runs):
+    """Create a session for the model at path runs times. Returns the last session and the fastest start-up."""
+    startup_time = None
+    session = None
+    for _ in range(runs):
+        # let the previous session go before the next one is made
+        session = None
+        start = time.perf_counter()
+        session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        elapsed = time.perf_counter() - start
+        startup_time = elapsed if startup_time is None else min(startup_time, elapsed)
+    return session, startup_time
+
+
+def random_inputs(model_proto, seed=0):
+    """Random values for the inputs of model_proto, unknown dims are 1. Ints are small and non-negative so they
+    are valid indices into most tensors."""
+    rng = np.random.RandomState(seed)
+    inputs = {}
+    for inp in model_proto.graph.input:
+        tensor_type = inp.type.tensor_type
+        shape = [d.dim_value if d.HasField("dim_value") and d.dim_value > 0 else 1 for d in tensor_type.shape.dim]
+        if tensor_type.elem_type == TensorProto.STRING:
+            inputs[inp.name] = np.array([b"a"] * int(np.prod(shape)), dtype=object).reshape(shape)
+            continue
+        dtype = utils.map_onnx_to_numpy_type(tensor_type.elem_type)
+        if tensor_type.elem_type == TensorProto.BOOL:
+            inputs[inp.name] = rng.random_sample(shape) < 0.5
+        elif np.issubdtype(dtype, np.integer):
+            inputs[inp.name] = rng.randint(0, 4, shape).astype(dtype)
+        else:
+            inputs[inp.name] = rng.random_sample(shape).astype(dtype)
+    return inputs
+
+
+def _verify_outputs(expected, actual, output_names, rtol, atol):
+    for name, e, a in zip(output_names, expected, actual):
+        e, a = np.asarray(e), np.asarray(a)
+        utils.make_sure(e.shape == a.shape, "output %s of the optimized model has shape %s instead of %s",
+                        name, a.shape, e.shape)
+        if e.dtype.kind in "fc":
+            utils.make_sure(np.allclose(e, a, rtol=rtol, atol=atol, equal_nan=True),
+                            "output %s of the optimized model differs by up to %g", name,
+                            np.max(np.abs(e.astype(np.float64) - a.astype(np.float64))) if e.size else 0)
+        else:
+            utils.make_sure(np.array_equal(e, a), "output %s of the optimized model differs", name)
+
+
+def optimize_with_ort(model_path, level="extended", ort_format=False, verify=True, rtol=1e-3, atol=1e-5,
+                      startup_runs=3):
+    """Apply the graph optimizations of onnxruntime at level, one of OPTIMIZATION_LEVELS, to the model saved at
+    model_path and save the optimized model next to it, see ort_optimized_path. With ort_format it is saved in the
+    ORT format. With verify the outputs of both models are compared on random inputs and the optimized model is
+    removed if they differ.
+    The optimized model is meant to be loaded with the graph optimizations disabled, so its start-up time is
+    measured that way and compared to the start-up of the model with the default session options. Each is the
+    fastest of startup_runs sessions.
+    Returns an OrtOptimizationResult."""
+    import onnxruntime as ort  # pylint: disable=import-outside-toplevel
+
+    utils.make_sure(level in OPTIMIZATION_LEVELS, "optimization level %s is not one of %s", level,
+                    OPTIMIZATION_LEVELS)
+    model_proto = onnx.load(model_path, load_external_data=False)
+    external_data = any(uses_external_data(t) for t in model_proto.graph.initializer)
+    utils.make_sure(not (ort_format and external_data), "models with external data can't be saved in the ORT format")
+    optimized_path = ort_optimized_path(model_path, ort_format)
+    # the optimized model keeps the large tensors in a data file of its own
+    optimized_data_path = os.path.splitext(optimized_path)[0] + ".data" if external_data else None
+
+    options = _session_options(ort, level)
+    options.optimized_model_filepath = optimized_path
+    if ort_format:
+        options.add_session_config_entry("session.save_model_format", "ORT")
+    if external_data:
+        options.add_session_config_entry("session.optimized_model_external_initializers_file_name",
+                                         os.path.basename(optimized_data_path))
+        options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+    logger.info("Optimizing %s with onnxruntime %s, level %s", model_path, ort.__version__, level)
+    ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+    session, startup_time = _start_session(ort, model_path, ort.SessionOptions(), startup_runs)
+    optimized_session, optimized_startup_time = _start_session(ort, optimized_path, _session_options(ort),
+                                                               startup_runs)
+    if verify:
+        inputs = random_inputs(model_proto)
+        output_names = [o.name for o in session.get_outputs()]
+        expected = session.run(output_names, inputs)
+        try:
+            _verify_outputs(expected, optimized_session.run(output_names, inputs), output_names, rtol, atol)
+        except ValueError:
+            del optimized_session
+            for path in [optimized_path, optimized_data_path]:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            raise
+    logger.info("Optimized model is saved at %s, session start-up %.1f ms instead of %.1f ms", optimized_path,
+                optimized_startup_time * 1000, startup_time * 1000)
+    return OrtOptimizationResult(optimized_path, startup_time, optimized_startup_time)
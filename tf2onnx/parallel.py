@@ -0,0 +1,222 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.parallel - convert the functions of a tensorflow graph in worker processes
+"""
+
+import copyreg
+import io
+import multiprocessing
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import tensorflow as tf
+from onnx import NodeProto
+
+from tf2onnx import logging
+from tf2onnx.conversion_context import ConversionContext, get_context
+from tf2onnx.tf_loader import function_to_graph, resolve_function_dependencies, toposort_functions, \
+    set_function, find_function
+from tf2onnx.tfonnx import graph_from_tf_function, process_parsed_graph
+
+logger = logging.getLogger(__name__)
+
+# state of a worker process, set up by _init_worker
+_worker = {}
+
+# names made in a worker look like name__f3~7, made by the function at index 3 of the dependency order with index 7
+# of its counter. ~ can't be part of a tensorflow name, so these are only names made by the worker.
+_NAME_SCOPE = "f{}~"
+_WORKER_NAME = re.compile(r"__f(\d+)~(\d+)")
+
+
+def _make_node_proto(data, name):
+    node = NodeProto()
+    node.ParseFromString(data)
+    node.name = name
+    return node
+
+
+def _reduce_node_proto(node):
+    # pickle the name as a string so it is seen by _Pickler.persistent_id
+    data = NodeProto()
+    data.CopyFrom(node)
+    data.ClearField("name")
+    return _make_node_proto, (data.SerializeToString(), node.name)
+
+
+class _Pickler(pickle.Pickler):
+    """Pickles the names made in a worker as persistent ids, so they can be replaced when they are loaded."""
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table[NodeProto] = _reduce_node_proto
+
+    def persistent_id(self, obj):  # pylint: disable=method-hidden
+        if isinstance(obj, str) and _WORKER_NAME.search(obj):
+            return obj
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, rename=None):
+        super().__init__(file)
+        self._rename = rename
+
+    def persistent_load(self, pid):  # pylint: disable=method-hidden
+        return self._rename(pid) if self._rename else pid
+
+
+def _dumps(obj):
+    f = io.BytesIO()
+    _Pickler(f).dump(obj)
+    return f.getvalue()
+
+
+def _loads(data, rename=None):
+    return _Unpickler(io.BytesIO(data), rename).load()
+
+
+def _init_worker(library, options, log_level):
+    logging.basicConfig(level=log_level)
+    graph_def = tf.compat.v1.GraphDef()
+    graph_def.library.ParseFromString(library)
+    # functions calling other functions need them in the graph they are imported into
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name="")
+    _worker["tf_graph"] = tf_graph
+    _worker["functions"] = {fdef.signature.name: fdef for fdef in graph_def.library.function}
+    _worker["options"] = pickle.loads(options)
+
+
+def _convert_function(name, index, input_shapes, dependencies):
+    """Convert the function name, at index of the dependency order, to an onnx graph. dependencies maps the
+    functions it calls to their pickled onnx graphs. Returns the pickled onnx graph and the number of names made
+    while the function was parsed and while it was processed."""
+    opts = _worker["options"]
+    context = ConversionContext(_NAME_SCOPE.format(index))
+    with context.activate(), _worker["tf_graph"].as_default():
+        for dep_name, dep in dependencies.items():
+            set_function(dep_name, _loads(dep))
+        start = context.name_counter
+        func = function_to_graph(_worker["functions"][name], input_shapes)
+        g = graph_from_tf_function(func, opts["output_names"], opts["shape_override"], opts["const_node_values"],
+                                   opts["ignore_default"], opts["use_default"])
+        g.set_config(opts["target"], opts["opset"], opts["extra_opset"])
+        parsed = context.name_counter
+        g = process_parsed_graph(g, opts["custom_op_handlers"], opts["inputs_as_nchw"], opts["continue_on_error"],
+                                 opts["custom_rewriter"], opts["initialized_tables"], dequantize=opts["dequantize"])
+        return _dumps(g), parsed - start, context.name_counter - parsed
+
+
+class ConvertedFunctions(object):
+    """The functions converted by the workers, see convert_functions.
+
+    A conversion in this process makes the names of all functions while they are parsed, then the names of the main
+    graph while it is parsed, then the names of each function while it is processed. The workers make their names
+    in name scopes of their own, they are replaced by names from the blocks reserved in the same order in the
+    ConversionContext, so the result is the same as a conversion in this process.
+    """
+
+    def __init__(self, ordered, results):
+        self._ordered = ordered
+        # function name -> (pickled graph, number of names made while parsing, while processing)
+        self._results = results
+        context = get_context()
+        self._parse_blocks = [context.reserve_name_block(results[name][1]) for name in ordered]
+
+    def register(self):
+        """Register the functions with set_function. Call this once the main graph is parsed."""
+        context = get_context()
+        process_blocks = [context.reserve_name_block(self._results[name][2]) for name in self._ordered]
+
+        def rename_index(match):
+            i, index = int(match.group(1)), int(match.group(2))
+            parse_count = self._results[self._ordered[i]][1]
+            if index <= parse_count + 1:
+                return "__{}".format(self._parse_blocks[i] + index - 1)
+            return "__{}".format(process_blocks[i] + index - 1 - parse_count)
+
+        def rename(name):
+            return _WORKER_NAME.sub(rename_index, name)
+
+        for name in self._ordered:
+            set_function(name, _loads(self._results[name][0], rename))
+
+
+def convert_functions(tf_graph, jobs, output_names, shape_override=None, const_node_values=None,
+                      ignore_default=None, use_default=None, target=None, opset=None, extra_opset=None,
+                      custom_op_handlers=None, inputs_as_nchw=None, continue_on_error=False, custom_rewriter=None,
+                      initialized_tables=None, dequantize=False):
+    """Convert the functions of tf_graph to onnx graphs using up to jobs worker processes. A function is
+    converted once all functions it calls are converted.
+
+    Returns the tf graphs of the functions that still need to be converted, in dependency order, and the
+    ConvertedFunctions of the workers. That is all functions and None if there are too few of them or the options
+    can't be sent to a worker, otherwise no functions and the ConvertedFunctions. Its register method must be
+    called once the main graph is parsed, the result is then the same as a conversion in this process.
+    """
+    dependencies, input_shapes = resolve_function_dependencies(tf_graph)
+    ordered = [name for names in toposort_functions(dependencies) for name in names]
+    tf_functions = [tf_graph._functions[name].definition for name in ordered]  # pylint: disable=protected-access
+    if len(ordered) < 2:
+        return [find_function(name) for name in ordered], None
+
+    node_names = set(node.name for fdef in tf_functions for node in fdef.node_def)
+    options = {
+        "output_names": output_names,
+        "shape_override": shape_override or {},
+        "const_node_values": {k: v for k, v in (const_node_values or {}).items() if k in node_names},
+        "ignore_default": ignore_default,
+        "use_default": use_default,
+        "target": target,
+        "opset": opset,
+        "extra_opset": extra_opset,
+        "custom_op_handlers": custom_op_handlers,
+        "inputs_as_nchw": inputs_as_nchw or [],
+        "continue_on_error": continue_on_error,
+        "custom_rewriter": custom_rewriter,
+        "initialized_tables": initialized_tables,
+        "dequantize": dequantize,
+    }
+    try:
+        options = pickle.dumps(options)
+    except (pickle.PicklingError, AttributeError, TypeError) as ex:
+        logger.warning("Converting functions in this process, the conversion options can't be sent to a worker: %s",
+                       ex)
+        return [find_function(name) for name in ordered], None
+
+    library = tf_graph.as_graph_def().library.SerializeToString()
+    num_workers = min(jobs, len(ordered))
+    logger.info("Converting %d functions with %d workers", len(ordered), num_workers)
+
+    converted = {}
+    remaining = {name: set(dependencies[name]) & set(ordered) for name in ordered}
+    indices = {name: i for i, name in enumerate(ordered)}
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(library, options, logger.getEffectiveLevel())) as executor:
+        running = {}
+
+        def submit_ready():
+            for name in ordered:
+                if name in remaining and not remaining[name]:
+                    del remaining[name]
+                    deps = {k: converted[k][0] for k in sorted(dependencies[name]) if k in converted}
+                    future = executor.submit(_convert_function, name, indices[name], input_shapes[name], deps)
+                    running[future] = name
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                converted[name] = future.result()
+                for deps in remaining.values():
+                    deps.discard(name)
+            submit_ready()
+
+    return [], ConvertedFunctions(ordered, converted)
@@ -7,7 +7,7 @@ tf2onnx.rewriter - rewrite tensorflow subgraph to onnx condv2 op with pad
 
 import numpy as np
 
-from tf2onnx import handler, logging
+from tf2onnx import logging
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
 
 logger = logging.getLogger(__name__)
@@ -57,8 +57,8 @@ def rewrite_conv2d_with_pad(g, ops):
         g.replace_input(conv, conv.input[0], pad.input[0], 0)
         # convert Conv2D
         conv.type = "Conv2D"
-        func, _ = handler.tf_op.find_effective_op("Conv2D")
-        func(g, conv)
+        func, kwargs = g.conversion_context.ops_mapping.find_effective_op("Conv2D")
+        func(g, conv, **kwargs)
         conv.skip_conversion = True
         conv.set_attr("auto_pad", "NOTSET")
         conv.set_attr("pads", paddings_val)
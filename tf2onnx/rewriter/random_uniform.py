@@ -7,7 +7,7 @@ tf2onnx.rewriter - rewrite tensorflow subgraph to onnx random_uniform op
 import numpy as np
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
 from tf2onnx.graph_builder import GraphBuilder
-from tf2onnx import utils, handler
+from tf2onnx import utils
 
 
 # pylint: disable=missing-docstring
@@ -106,8 +106,8 @@ def create_onnx_random_uniform_op(g, tmax, tmin, ru_op, output, to_delete):
             zero = g.make_const(utils.make_name("zero"), np.zeros((), dtype=np.float32))
             fill_node = g.make_node("Fill", inputs=[shape_node_output, zero.name],
                                     shapes=[shape], dtypes=[dtype])
-            func, _ = handler.tf_op.find_effective_op("Fill")
-            func(g, fill_node)
+            func, kwargs = g.conversion_context.ops_mapping.find_effective_op("Fill")
+            func(g, fill_node, **kwargs)
             # and use RandomUniformLike to create the random tensor
             new_node = g.make_node("RandomUniformLike", inputs=[fill_node.output[0]], name=op_name,
                                    attr={"low": tmin, "high": tmax, "dtype": dtype},
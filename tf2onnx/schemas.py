@@ -5,9 +5,12 @@
 tf2onnx.schema
 """
 
+import json
 import logging
 import copy
+import os
 from collections import defaultdict, OrderedDict
+import onnx
 from onnx import defs, helper, TensorProto, OperatorSetIdProto, shape_inference
 
 from . import constants
@@ -60,12 +63,44 @@ class OnnxOpSchema(object):
         return attr in self.attributes
 
 
+def _schema_cache_path():
+    """Path of the on-disk schema cache for the installed onnx package, None if caching is disabled."""
+    cache_dir = utils.get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "onnx_schemas_{}.json".format(onnx.__version__))
+
+
+def _read_schema_rows():
+    """Return all schemas as [name, domain, since_version, [attribute names]] rows.
+
+    Walking the schemas of the onnx package is slow, so the rows are cached on disk per onnx version.
+    """
+    path = _schema_cache_path()
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cache = json.load(f)
+            if cache.get("format") == _SCHEMA_CACHE_FORMAT:
+                return cache["schemas"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            logger.debug("Ignoring unreadable schema cache %s", path, exc_info=1)
+
+    rows = [[s.name, s.domain, int(s.since_version), sorted(s.attributes)]
+            for s in defs.get_all_schemas_with_history()]
+    if path:
+        try:
+            utils.atomic_write_json(path, {"format": _SCHEMA_CACHE_FORMAT, "schemas": rows})
+        except OSError:
+            logger.debug("Unable to write schema cache %s", path, exc_info=1)
+    return rows
+
+
 def _register_all_schemas_with_history():
     """Register all schemas with history"""
-    onnx_schemas = defs.get_all_schemas_with_history()
     name_domain_version_schema_map = defaultdict(lambda: defaultdict(dict))
-    for s in onnx_schemas:
-        schema = OnnxOpSchema.from_onnx_schema(s)
+    for name, domain, since_version, attributes in _read_schema_rows():
+        schema = OnnxOpSchema(name, domain, since_version, frozenset(attributes))
         name_domain_version_schema_map[schema.name][schema.domain][schema.since_version] = schema
 
     ordered_map = defaultdict(lambda: defaultdict(OrderedDict))
@@ -91,27 +126,50 @@ def _parse_domain_opset_versions(schemas):
     return domain_opset_versions
 
 
+# bump when the layout of the on-disk schema cache changes
+_SCHEMA_CACHE_FORMAT = 1
+
 # format is <OpName, <Domain, <SinceVersion, OpSchema>>>
-# SinceVersion is sorted from high to low
-_schemas = _register_all_schemas_with_history()
+# SinceVersion is sorted from high to low. Built on first use by _get_schemas().
+_schemas = None
+
+_domain_opset_versions = None
 
-_domain_opset_versions = _parse_domain_opset_versions(_schemas)
+# (name, domain, max_inclusive_opset_version) -> OpSchema or None, filled by get_schema
+_schema_lookup = {}
+
+
+def _get_schemas():
+    global _schemas, _domain_opset_versions
+    if _schemas is None:
+        schemas = _register_all_schemas_with_history()
+        _domain_opset_versions = _parse_domain_opset_versions(schemas)
+        _schemas = schemas
+    return _schemas
 
 
 def get_schema(name, max_inclusive_opset_version, domain=None):
     """Get schema by name within specific version."""
     domain = domain or constants.ONNX_DOMAIN
-    domain_version_schema_map = _schemas[name]
-    version_schema_map = domain_version_schema_map[domain]
-    for version, schema in version_schema_map.items():
+    key = (name, domain, max_inclusive_opset_version)
+    try:
+        return _schema_lookup[key]
+    except KeyError:
+        pass
+    schema = None
+    version_schema_map = _get_schemas().get(name, {}).get(domain, {})
+    for version, s in version_schema_map.items():
         if version <= max_inclusive_opset_version:
-            return schema
-    return None
+            schema = s
+            break
+    _schema_lookup[key] = schema
+    return schema
 
 
 def get_max_supported_opset_version(domain=None):
     """Get max supported opset version by current onnx package given a domain."""
     domain = domain or constants.ONNX_DOMAIN
+    _get_schemas()
     return _domain_opset_versions.get(domain, None)
 
 
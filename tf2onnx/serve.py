@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+python -m tf2onnx.serve : long-lived conversion server with a pool of warm workers
+
+The server listens on a unix socket or a localhost tcp port and speaks newline-delimited json.
+A client sends one job per line. A job uses the keys of a tf2onnx.batch manifest entry, for example
+    {"model": "/models/frozen.pb", "inputs": ["X:0"], "outputs": ["pred:0"], "output": "/models/model.onnx"}
+and gets back a stream of events for that job:
+    {"id": "job-1", "event": "queued", "position": 0}
+    {"id": "job-1", "event": "started"}
+    {"id": "job-1", "event": "done", "result": {"status": "ok", "time": 1.2, ...}}
+If the queue is full the only event is {"event": "rejected"}. Jobs sent on one connection may be interleaved.
+Jobs with unknown keys, or with an output outside of --output-dir, get an {"event": "error"} unless the server
+was started with --allow-any-output. Relative outputs are relative to --output-dir.
+"""
+
+# pylint: disable=broad-except
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+
+from tf2onnx import logging, utils
+from tf2onnx.batch import JOB_KEYS, WorkerPool
+
+logger = logging.getLogger("tf2onnx.serve")
+
+_HELP_TEXT = """
+Usage Examples:
+
+python -m tf2onnx.serve --socket /tmp/tf2onnx.sock --jobs 2
+python -m tf2onnx.serve --port 8765 --jobs 4 --max-queue 64 --output-dir /tmp/converted
+"""
+
+# events that end a job
+_FINAL_EVENTS = ["done", "rejected", "error"]
+
+
+def get_args():
+    """Parse commandline."""
+    parser = argparse.ArgumentParser(description="Serve tensorflow to ONNX conversions.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=_HELP_TEXT)
+    parser.add_argument("--socket", help="listen on this unix socket")
+    parser.add_argument("--port", type=int, help="listen on this tcp port")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind when listening on a tcp port")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--max-queue", type=int, default=32, help="maximum number of queued and running jobs")
+    parser.add_argument("--output-dir", default=utils.get_temp_directory(),
+                        help="directory for converted models, outputs of jobs must be inside of it")
+    parser.add_argument("--allow-any-output", action="store_true",
+                        help="let jobs write their output anywhere the server can write")
+    parser.add_argument("--max-worker-memory", type=int, default=0,
+                        help="recycle a worker once its resident memory exceeds this many MB (0 = never)")
+    parser.add_argument("--timeout", type=float, default=None, help="timeout in seconds for each conversion")
+    parser.add_argument("--verbose", "-v", help="verbose output, option is additive", action="count")
+    args = parser.parse_args()
+    if bool(args.socket) == bool(args.port):
+        parser.error("exactly one of --socket and --port is required")
+    return args
+
+
+class ConversionServer:
+    """Accepts conversion jobs from clients and runs them on a WorkerPool."""
+
+    def __init__(self, num_workers=1, max_queue=32, output_dir=None, max_worker_memory_mb=0, timeout=None,
+                 allow_any_output=False):
+        self._pool = WorkerPool(num_workers, max_worker_memory_mb, timeout)
+        self._max_queue = max_queue
+        self._output_dir = os.path.realpath(output_dir or utils.get_temp_directory())
+        self._allow_any_output = allow_any_output
+        self._ids = itertools.count(1)
+        # job id -> asyncio.Queue receiving the events of that job
+        self._listeners = {}
+        self._loop = None
+        self._server = None
+        self._pump_thread = None
+        self._stopping = threading.Event()
+
+    async def start(self, socket_path=None, host="127.0.0.1", port=None):
+        """Start the workers and listen on socket_path or host:port."""
+        self._loop = asyncio.get_running_loop()
+        os.makedirs(self._output_dir, exist_ok=True)
+        self._pool.__enter__()
+        self._pump_thread = threading.Thread(target=self._pump, name="tf2onnx-serve-pump", daemon=True)
+        self._pump_thread.start()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._server = await asyncio.start_unix_server(self._handle_client, path=socket_path)
+            logger.info("Listening on %s", socket_path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host=host, port=port)
+            logger.info("Listening on %s:%s", host, port)
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._stopping.set()
+        await self._loop.run_in_executor(None, self._pump_thread.join)
+        self._pool.close()
+
+    def _pump(self):
+        """Forward worker events to the event loop. Runs in its own thread since the pool api is blocking."""
+        while not self._stopping.is_set():
+            for event, payload in self._pool.poll(timeout=0.5):
+                if event == "started":
+                    job_id, msg = payload, {"event": "started"}
+                else:
+                    job_id, msg = payload["name"], {"event": "done", "result": payload}
+                self._loop.call_soon_threadsafe(self._publish, job_id, msg)
+
+    def _publish(self, job_id, msg):
+        listener = self._listeners.get(job_id)
+        if listener is not None:
+            msg["id"] = job_id
+            listener.put_nowait(msg)
+            if msg["event"] in _FINAL_EVENTS:
+                del self._listeners[job_id]
+
+    def _submit(self, job, listener):
+        if len(self._listeners) >= self._max_queue:
+            listener.put_nowait({"event": "rejected", "reason": "queue is full"})
+            return
+        unknown = sorted(k for k in job if k not in JOB_KEYS)
+        utils.make_sure(not unknown, "unknown job keys %s, jobs may use %s", unknown, JOB_KEYS)
+        utils.make_sure("model" in job, "job has no model")
+        job_id = "job-{}".format(next(self._ids))
+        job = dict(job)
+        job["name"] = job_id
+        if "output" not in job:
+            ext = ".zip" if job.get("large_model") else ".onnx"
+            job["output"] = os.path.join(self._output_dir, job_id + ext)
+        job["output"] = os.path.realpath(os.path.join(self._output_dir, job["output"]))
+        utils.make_sure(self._allow_any_output or
+                        os.path.commonpath([self._output_dir, job["output"]]) == self._output_dir,
+                        "output %s is outside of the output directory %s", job["output"], self._output_dir)
+        position = len(self._listeners)
+        self._listeners[job_id] = listener
+        listener.put_nowait({"id": job_id, "event": "queued", "position": position, "output": job["output"]})
+        self._pool.submit(job)
+
+    async def _handle_client(self, reader, writer):
+        events = asyncio.Queue()
+        pending = 0
+
+        async def read_jobs():
+            nonlocal pending
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                pending += 1
+                try:
+                    self._submit(json.loads(line), events)
+                except Exception as ex:
+                    events.put_nowait({"event": "error", "error": "{}: {}".format(type(ex).__name__, ex)})
+
+        reader_task = asyncio.ensure_future(read_jobs())
+        try:
+            while not (reader_task.done() and pending == 0):
+                get_task = asyncio.ensure_future(events.get())
+                if not reader_task.done():
+                    await asyncio.wait([get_task, reader_task], return_when=asyncio.FIRST_COMPLETED)
+                    if not get_task.done():
+                        get_task.cancel()
+                        continue
+                # once the client stopped sending jobs only the events of its pending jobs are left
+                msg = await get_task
+                if msg["event"] in _FINAL_EVENTS:
+                    pending -= 1
+                writer.write((json.dumps(msg) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            logger.info("client disconnected")
+        finally:
+            reader_task.cancel()
+            writer.close()
+
+
+class ConversionClient:
+    """asyncio client for ConversionServer.
+
+    Example:
+        client = ConversionClient(socket_path="/tmp/tf2onnx.sock")
+        result = await client.convert("frozen.pb", inputs=["X:0"], outputs=["pred:0"], output="model.onnx")
+    """
+
+    def __init__(self, socket_path=None, host="127.0.0.1", port=None):
+        utils.make_sure(bool(socket_path) != bool(port), "exactly one of socket_path and port is required")
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+
+    async def _connect(self):
+        if self.socket_path:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def stream(self, model, **options):
+        """Submit a job and yield its events as dicts until the job has finished."""
+        job = dict(options, model=model)
+        reader, writer = await self._connect()
+        try:
+            writer.write((json.dumps(job) + "\n").encode())
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("server closed the connection")
+                msg = json.loads(line)
+                yield msg
+                if msg["event"] in _FINAL_EVENTS:
+                    break
+        finally:
+            writer.close()
+
+    async def convert(self, model, **options):
+        """Submit a job and return the result of run_job for it. Raises RuntimeError if the job was not run."""
+        async for msg in self.stream(model, **options):
+            if msg["event"] == "done":
+                return msg["result"]
+            if msg["event"] in _FINAL_EVENTS:
+                raise RuntimeError("conversion {}: {}".format(msg["event"], msg.get("reason") or msg.get("error")))
+        raise RuntimeError("conversion did not finish")
+
+
+async def _serve(args):
+    server = ConversionServer(args.jobs, args.max_queue, args.output_dir, args.max_worker_memory, args.timeout,
+                              args.allow_any_output)
+    await server.start(args.socket, args.host, args.port)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.get_verbosity_level(args.verbose))
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
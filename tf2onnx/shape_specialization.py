@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.shape_specialization - specialize a converted graph to fixed input shapes
+"""
+
+import copy
+
+from tf2onnx import logging, utils
+from tf2onnx.optimizer.shape_fold_optimizer import ShapeFoldOptimizer
+
+logger = logging.getLogger(__name__)
+
+
+def specialize_graph(g, input_shapes):
+    """Return a copy of the converted graph g for the static input shapes given by input_shapes, a dict mapping
+    graph inputs to their shape. The shapes are propagated through the graph, the Shape and Size nodes they
+    determine are replaced by consts and the shape computations that depend on them are folded."""
+    g = copy.deepcopy(g)
+    with g.conversion_context.activate():
+        for name, shape in input_shapes.items():
+            shape = [-1 if d is None else d for d in shape]
+            utils.make_sure(name in g.input_names, "%s is not an input of the graph, inputs are %s", name,
+                            g.input_names)
+            model_shape = g.get_shape(name)
+            utils.make_sure(utils.are_shapes_compatible(model_shape, shape),
+                            "shape %s of input %s doesn't fit its shape %s in the model", shape, name, model_shape)
+            g.set_shape(name, shape)
+        g = ShapeFoldOptimizer(refine_shapes=True).optimize(g, 0)
+    return g
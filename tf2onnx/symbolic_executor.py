@@ -34,6 +34,31 @@ class SymbolicTensorElement:
     def __rmul__(self, other):
         return self.__mul__(other)
 
+    def __eq__(self, other):
+        if not isinstance(other, SymbolicTensorElement):
+            if not isinstance(other, (int, np.integer)):
+                return NotImplemented
+            other = SymbolicTensorElement.from_const(other)
+        return self.constant == other.constant and sorted(self.terms, key=str) == sorted(other.terms, key=str)
+
+    def __hash__(self):
+        return hash((self.constant, tuple(sorted(self.terms, key=str))))
+
+    def __repr__(self):
+        return "*".join([str(self.constant)] + [str(t) for t in self.terms])
+
+    def exact_div(self, other):
+        """Divides by a SymbolicTensorElement or int, None if the result isn't a SymbolicTensorElement"""
+        other = SymbolicTensorElement.from_value(other)
+        if other.constant == 0 or self.constant % other.constant != 0:
+            return None
+        terms = list(self.terms)
+        for term in other.terms:
+            if term not in terms:
+                return None
+            terms.remove(term)
+        return SymbolicTensorElement(terms, self.constant // other.constant)
+
     def is_const(self):
         return len(self.terms) == 0
 
@@ -86,7 +111,9 @@ class SymbolicExecutor:
             "Slice": self.compute_slice,
             "Cast": self.compute_cast,
             "Concat": self.compute_concat,
-            "Const": self.compute_const
+            "Const": self.compute_const,
+            "Identity": self.compute_identity,
+            "Div": self.compute_div,
         }
 
     def compute_outputs(self, outputs, feed_dict):
@@ -128,7 +155,7 @@ class SymbolicExecutor:
         if self.graph.opset < 13:
             axes = node.get_attr_value("axes")
         else:
-            axes = feed_dict[node.input[1]].tolist()
+            axes = feed_dict[node.input[1]].tolist() if len(node.input) > 1 and node.input[1] else None
         shape = inp1.shape
         handler = self.compute_unsqueeze_shape if node.type == "Unsqueeze" else self.compute_squeeze_shape
         new_shape = handler(shape, axes)
@@ -141,14 +168,37 @@ class SymbolicExecutor:
         np_dtype = utils.ONNX_TO_NUMPY_DTYPE[node.get_attr("to").i]
         return [inp.astype(np_dtype)]
 
+    def compute_identity(self, node, feed_dict):
+        return [feed_dict[node.input[0]]]
+
     def compute_mul(self, node, feed_dict):
         return [feed_dict[node.input[0]] * feed_dict[node.input[1]]]
 
+    def compute_div(self, node, feed_dict):
+        inp1 = feed_dict[node.input[0]]
+        inp2 = feed_dict[node.input[1]]
+        if inp1.dtype != object and inp2.dtype != object:
+            if inp1.dtype.kind not in "iu" or (inp2 == 0).any():
+                raise SymbolicExecutionException("Div requires integer inputs")
+            # integer Div truncates towards zero
+            return [(np.sign(inp1) * np.sign(inp2) * (np.abs(inp1) // np.abs(inp2))).astype(inp1.dtype)]
+
+        def div(a, b):
+            res = SymbolicTensorElement.from_value(a).exact_div(b)
+            if res is None:
+                raise SymbolicExecutionException("%s is not a multiple of %s" % (a, b))
+            return res
+        return [np.vectorize(div, otypes=[object])(inp1, inp2)]
+
     def compute_reduceprod(self, node, feed_dict):
         inp = feed_dict[node.input[0]]
-        axes = node.get_attr_value("axes")
+        if self.graph.opset < 18:
+            axes = node.get_attr_value("axes")
+        else:
+            axes = feed_dict[node.input[1]].tolist() if len(node.input) > 1 and node.input[1] else None
         keepdims = node.get_attr_value("keepdims", 1)
-        return [np.prod(inp, axis=tuple(axes), keepdims=keepdims)]
+        axes = tuple(axes) if axes else None
+        return [np.prod(inp, axis=axes, keepdims=bool(keepdims))]
 
     def compute_slice(self, node, feed_dict):
         inps = [feed_dict[inp] if inp != '' else None for inp in node.input]
@@ -199,9 +249,433 @@ class SymbolicExecutor:
         return shape_out
 
     def compute_squeeze_shape(self, shape_in, axes):
-        axes = [i if i >= 0 else i + len(axes) for i in axes]
+        if axes is None:
+            return [val for val in shape_in if val != 1]
+        axes = [i if i >= 0 else i + len(shape_in) for i in axes]
         shape_out = []
         for ind, val in enumerate(shape_in):
             if ind not in axes:
                 shape_out.append(val)
         return shape_out
+
+
+# integer tensors up to this size are tracked as values, they are typically shapes
+_MAX_VALUE_SIZE = 1024
+
+_UNARY_OPS = [
+    "Abs", "Acos", "Acosh", "Asin", "Asinh", "Atan", "Atanh", "BatchNormalization", "Cast", "Ceil", "Celu", "Clip",
+    "Cos", "Cosh", "CumSum", "DequantizeLinear", "Dropout", "Elu", "Erf", "Exp", "Floor", "HardSigmoid", "HardSwish",
+    "Hardmax", "Identity", "InstanceNormalization", "IsInf", "IsNaN", "LayerNormalization", "LeakyRelu", "Log",
+    "LogSoftmax", "LpNormalization", "LRN", "MeanVarianceNormalization", "Neg", "Not", "QuantizeLinear",
+    "Reciprocal", "Relu", "ReverseSequence", "Round", "Selu", "Shrink", "Sigmoid", "Sign", "Sin", "Sinh", "Softmax",
+    "Softplus", "Softsign", "Sqrt", "Tan", "Tanh", "ThresholdedRelu", "Trilu",
+]
+
+_BROADCAST_OPS = [
+    "Add", "And", "BitShift", "Div", "Equal", "Greater", "GreaterOrEqual", "Less", "LessOrEqual", "Max", "Mean",
+    "Min", "Mod", "Mul", "Or", "Pow", "PRelu", "Sub", "Sum", "Where", "Xor",
+]
+
+_REDUCE_OPS = [
+    "ReduceL1", "ReduceL2", "ReduceLogSum", "ReduceLogSumExp", "ReduceMax", "ReduceMean", "ReduceMin", "ReduceProd",
+    "ReduceSum", "ReduceSumSquare",
+]
+
+
+class SymbolicShapeInference:
+    """
+    Propagates the shapes of a graph with named dims, like the dim_params of onnx. Each unknown dim of a graph input
+    is a variable, named after its dim_param if the graph has one. Ops that keep a dim pass its variable on and ops
+    that compute dims combine them, so the output of Flatten on [batch, seq, 8] is [batch, seq*8]. Small integer
+    tensors computed from shapes are tracked as values, which resolves Reshape and Expand targets built with Shape.
+    Dims that can't be derived become new variables named after the tensor, shapes known to the graph always win.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.executor = SymbolicExecutor(graph)
+        # the variables that are dim_params of the graph inputs
+        self.dim_params = set()
+        self._shapes = {}
+        self._values = {}
+        self._shape_funcs = {
+            "Concat": self._concat_shape,
+            "ConstantOfShape": self._constant_of_shape_shape,
+            "Expand": self._expand_shape,
+            "Flatten": self._flatten_shape,
+            "Gather": self._gather_shape,
+            "Gemm": self._gemm_shape,
+            "MatMul": self._matmul_shape,
+            "Reshape": self._reshape_shape,
+            "Shape": self._shape_shape,
+            "Size": lambda node: [[]],
+            "Slice": self._slice_shape,
+            "Split": self._split_shape,
+            "Squeeze": self._squeeze_shape,
+            "Tile": self._tile_shape,
+            "Transpose": self._transpose_shape,
+            "Unsqueeze": self._unsqueeze_shape,
+        }
+        for op in _UNARY_OPS:
+            self._shape_funcs[op] = lambda node: [self.get_shape(node.input[0])]
+        for op in _BROADCAST_OPS:
+            self._shape_funcs[op] = lambda node: [self._broadcast(*[self.get_shape(inp) for inp in node.input])]
+        for op in _REDUCE_OPS:
+            self._shape_funcs[op] = self._reduce_shape
+        for op in ["ArgMax", "ArgMin"]:
+            self._shape_funcs[op] = self._arg_shape
+        for op in ["Conv", "ConvInteger", "QLinearConv", "AveragePool", "MaxPool", "LpPool"]:
+            self._shape_funcs[op] = self._conv_pool_shape
+        for op in ["GlobalAveragePool", "GlobalMaxPool", "GlobalLpPool"]:
+            self._shape_funcs[op] = self._global_pool_shape
+        self._infer()
+
+    def get_shape(self, name):
+        """The shape of the tensor name as a list of SymbolicTensorElements, None if the rank is unknown."""
+        if name not in self._shapes:
+            self._shapes[name] = self._merge_shape(name, None)
+        return self._shapes[name]
+
+    def get_value(self, name):
+        """The value of the tensor name as np array, of SymbolicTensorElements if it depends on unknown dims. None
+        if it isn't known."""
+        return self._values.get(name)
+
+    def get_dim_params(self, name):
+        """The shape of the tensor name with the dims that are single variables replaced by their names."""
+        shape = self.get_shape(name)
+        if shape is None:
+            return None
+        return [int(d.constant) if d.is_const() else d.terms[0] if d.is_single_var() else None for d in shape]
+
+    def _variable(self, name, i):
+        return SymbolicTensorElement.from_variable("%s[%d]" % (name, i))
+
+    def _merge_shape(self, name, shape):
+        """Merge the inferred shape of tensor name with its shape in the graph. Unknown dims become variables."""
+        graph_shape = self.graph.get_shape(name) if name else None
+        if graph_shape is None:
+            if shape is None:
+                return None
+            graph_shape = [-1] * len(shape)
+        if shape is None or len(shape) != len(graph_shape):
+            shape = [None] * len(graph_shape)
+        res = []
+        for i, (d, s) in enumerate(zip(graph_shape, shape)):
+            if d != -1:
+                res.append(SymbolicTensorElement.from_const(d))
+            elif s is not None:
+                res.append(SymbolicTensorElement.from_value(s))
+            else:
+                res.append(self._variable(name, i))
+        return res
+
+    def _sorted_nodes(self):
+        """The nodes of the graph in topological order, the graph itself isn't reordered."""
+        order = []
+        visited = set()
+        for start in self.graph.get_nodes():
+            stack = [(start, False)]
+            while stack:
+                node, inputs_done = stack.pop()
+                if inputs_done:
+                    order.append(node)
+                    continue
+                if node.name in visited:
+                    continue
+                visited.add(node.name)
+                stack.append((node, True))
+                for inp in node.inputs:
+                    if inp is not None and inp.graph is self.graph and inp.name not in visited:
+                        stack.append((inp, False))
+        return order
+
+    def _infer(self):
+        for node in self._sorted_nodes():
+            if node.is_graph_input():
+                self._infer_graph_input(node)
+                continue
+            shapes = None
+            if node.is_const():
+                shapes = [list(node.get_tensor_value(as_list=False).shape)]
+            elif utils.is_onnx_domain(node.domain) and node.type in self._shape_funcs:
+                try:
+                    shapes = self._shape_funcs[node.type](node)
+                except Exception:  # pylint: disable=broad-except
+                    shapes = None
+            for i, out in enumerate(node.output):
+                if out:
+                    self._shapes[out] = self._merge_shape(out, shapes[i] if shapes and i < len(shapes) else None)
+            self._infer_values(node)
+
+    def _infer_graph_input(self, node):
+        name = node.output[0]
+        shape = self.graph.get_shape(name)
+        if shape is None:
+            self._shapes[name] = None
+            return
+        dim_params = self.graph.get_dim_params(name) or [None] * len(shape)
+        res = []
+        for i, d in enumerate(shape):
+            if d != -1:
+                res.append(SymbolicTensorElement.from_const(d))
+            elif i < len(dim_params) and dim_params[i]:
+                self.dim_params.add(dim_params[i])
+                res.append(SymbolicTensorElement.from_variable(dim_params[i]))
+            else:
+                res.append(self._variable(name, i))
+        self._shapes[name] = res
+
+    def _infer_values(self, node):
+        if node.is_const():
+            value = node.get_tensor_value(as_list=False)
+            if value.dtype.kind in "iu" and value.size <= _MAX_VALUE_SIZE:
+                self._values[node.output[0]] = value
+            return
+        if node.type == "Shape":
+            shape = self.get_shape(node.input[0])
+            if shape is not None:
+                start = node.get_attr_value("start", 0)
+                end = node.get_attr_value("end", len(shape))
+                self._values[node.output[0]] = np.array(shape[start:end], object)
+            return
+        if node.type == "Size":
+            shape = self.get_shape(node.input[0])
+            if shape is not None:
+                self._values[node.output[0]] = np.array(np.prod(shape + [1]), object)
+            return
+        if node.type not in self.executor.op_map or not utils.is_onnx_domain(node.domain):
+            return
+        if any(inp and inp not in self._values for inp in node.input):
+            return
+        try:
+            results = self.executor.compute_node(node, self._values)
+        except Exception:  # pylint: disable=broad-except
+            return
+        for out, value in results.items():
+            if value.size <= _MAX_VALUE_SIZE:
+                self._values[out] = value
+
+    def _value_as_list(self, name):
+        value = self.get_value(name)
+        if value is None:
+            return None
+        return [SymbolicTensorElement.from_value(v) for v in value.flatten().tolist()]
+
+    def _const_list(self, name):
+        """The value of the tensor name as list of ints, None if it isn't known or depends on unknown dims"""
+        value = self.get_value(name)
+        if value is None or value.dtype == object:
+            return None
+        return value.flatten().tolist()
+
+    def _axes(self, node, index, opset_version):
+        """The axes of node, an attribute before opset_version and the input at index from then on."""
+        if self.graph.opset < opset_version:
+            return node.get_attr_value("axes")
+        if len(node.input) > index and node.input[index]:
+            return self._const_list(node.input[index])
+        return None
+
+    @staticmethod
+    def _broadcast_dim(a, b):
+        if a.is_one():
+            return b
+        if b.is_one() or a == b:
+            return a
+        # a dim that isn't 1 decides, the other one must match it
+        if a.is_const() and not b.is_const():
+            return a
+        if b.is_const() and not a.is_const():
+            return b
+        return None
+
+    def _broadcast(self, *shapes):
+        if any(shape is None for shape in shapes):
+            return None
+        rank = max(len(shape) for shape in shapes)
+        res = [SymbolicTensorElement.from_const(1)] * rank
+        for shape in shapes:
+            shape = [SymbolicTensorElement.from_const(1)] * (rank - len(shape)) + list(shape)
+            res = [None if r is None or d is None else self._broadcast_dim(r, d) for r, d in zip(res, shape)]
+        return res
+
+    def _concat_shape(self, node):
+        shapes = [self.get_shape(inp) for inp in node.input]
+        if any(shape is None for shape in shapes):
+            return None
+        axis = node.get_attr_value("axis")
+        res = list(shapes[0])
+        axis = axis + len(res) if axis < 0 else axis
+        for shape in shapes[1:]:
+            for i, d in enumerate(shape):
+                if i != axis and not res[i].is_const():
+                    res[i] = d
+        dims = [shape[axis] for shape in shapes]
+        res[axis] = sum(d.constant for d in dims) if all(d.is_const() for d in dims) else None
+        return [res]
+
+    def _constant_of_shape_shape(self, node):
+        return [self._value_as_list(node.input[0])]
+
+    def _expand_shape(self, node):
+        return [self._broadcast(self.get_shape(node.input[0]), self._value_as_list(node.input[1]))]
+
+    def _flatten_shape(self, node):
+        shape = self.get_shape(node.input[0])
+        axis = node.get_attr_value("axis", 1)
+        axis = axis + len(shape) if axis < 0 else axis
+        return [[np.prod(shape[:axis] + [1]), np.prod(shape[axis:] + [1])]]
+
+    def _gather_shape(self, node):
+        data = self.get_shape(node.input[0])
+        indices = self.get_shape(node.input[1])
+        axis = node.get_attr_value("axis", 0)
+        axis = axis + len(data) if axis < 0 else axis
+        return [data[:axis] + indices + data[axis + 1:]]
+
+    def _gemm_shape(self, node):
+        a = self.get_shape(node.input[0])
+        b = self.get_shape(node.input[1])
+        m = a[1] if node.get_attr_value("transA", 0) else a[0]
+        n = b[0] if node.get_attr_value("transB", 0) else b[1]
+        return [[m, n]]
+
+    def _matmul_shape(self, node):
+        a = self.get_shape(node.input[0])
+        b = self.get_shape(node.input[1])
+        one = SymbolicTensorElement.from_const(1)
+        a_vector, b_vector = len(a) == 1, len(b) == 1
+        a = [one] + a if a_vector else a
+        b = b + [one] if b_vector else b
+        res = self._broadcast(a[:-2], b[:-2]) + [a[-2], b[-1]]
+        if b_vector:
+            res = res[:-1]
+        if a_vector:
+            res = res[:-2] + res[-1:] if not b_vector else res[:-1]
+        return [res]
+
+    def _reshape_shape(self, node):
+        data = self.get_shape(node.input[0])
+        target = self._value_as_list(node.input[1])
+        if target is None:
+            return None
+        allowzero = node.get_attr_value("allowzero", 0)
+        res = []
+        unknown_dim = None
+        for i, d in enumerate(target):
+            if d == 0 and not allowzero:
+                res.append(data[i] if data is not None else None)
+            elif d == -1:
+                unknown_dim = i
+                res.append(None)
+            else:
+                res.append(d)
+        if unknown_dim is not None and data is not None and all(d is not None for d in res[:unknown_dim]) \
+                and all(d is not None for d in res[unknown_dim + 1:]):
+            others = res[:unknown_dim] + res[unknown_dim + 1:]
+            res[unknown_dim] = SymbolicTensorElement.from_value(np.prod(data + [1])).exact_div(np.prod(others + [1]))
+        return [res]
+
+    def _shape_shape(self, node):
+        shape = self.get_shape(node.input[0])
+        start = node.get_attr_value("start", 0)
+        end = node.get_attr_value("end", len(shape))
+        return [[len(shape[start:end])]]
+
+    def _slice_shape(self, node):
+        data = self.get_shape(node.input[0])
+        if self.graph.opset >= 10:
+            inputs = (node.input[1:] + [""] * 4)[:4]
+            starts, ends, axes, steps = [self._const_list(inp) if inp else None for inp in inputs]
+            if starts is None or ends is None or (len(node.input) > 3 and node.input[3] and axes is None) \
+                    or (len(node.input) > 4 and node.input[4] and steps is None):
+                return None
+        else:
+            starts, ends = node.get_attr_value("starts"), node.get_attr_value("ends")
+            axes, steps = node.get_attr_value("axes"), None
+        axes = axes if axes is not None else list(range(len(starts)))
+        steps = steps if steps is not None else [1] * len(starts)
+        res = list(data)
+        for axis, start, end, step in zip(axes, starts, ends, steps):
+            d = res[axis]
+            if d.is_const():
+                res[axis] = len(range(*slice(start, end, step).indices(d.constant)))
+            elif not (start == 0 and step == 1 and end >= np.iinfo(np.int32).max):
+                res[axis] = None
+        return [res]
+
+    def _split_shape(self, node):
+        data = self.get_shape(node.input[0])
+        axis = node.get_attr_value("axis", 0)
+        axis = axis + len(data) if axis < 0 else axis
+        split = node.get_attr_value("split")
+        if len(node.input) > 1 and node.input[1]:
+            split = self._const_list(node.input[1])
+        if split is None and data[axis].is_const():
+            split = [data[axis].constant // len(node.output)] * len(node.output)
+        res = []
+        for i in range(len(node.output)):
+            res.append(data[:axis] + [split[i] if split else None] + data[axis + 1:])
+        return res
+
+    def _squeeze_shape(self, node):
+        data = self.get_shape(node.input[0])
+        axes = self._axes(node, 1, 13)
+        if axes is None:
+            # without axes the dims that are 1 are removed, which unknown dims might be
+            if not all(d.is_const() for d in data):
+                return None
+            return [[d for d in data if not d.is_one()]]
+        return [self.executor.compute_squeeze_shape(data, axes)]
+
+    def _tile_shape(self, node):
+        data = self.get_shape(node.input[0])
+        repeats = self._value_as_list(node.input[1])
+        return [[d * r for d, r in zip(data, repeats)]]
+
+    def _transpose_shape(self, node):
+        data = self.get_shape(node.input[0])
+        perm = node.get_attr_value("perm", list(reversed(range(len(data)))))
+        return [[data[p] for p in perm]]
+
+    def _unsqueeze_shape(self, node):
+        data = self.get_shape(node.input[0])
+        axes = self._axes(node, 1, 13)
+        return [self.executor.compute_unsqueeze_shape(data, axes)]
+
+    def _reduce_shape(self, node):
+        data = self.get_shape(node.input[0])
+        axes = self._axes(node, 1, 13 if node.type == "ReduceSum" else 18)
+        if not axes:
+            if node.get_attr_value("noop_with_empty_axes", 0):
+                return [data]
+            axes = list(range(len(data)))
+        axes = [a + len(data) if a < 0 else a for a in axes]
+        if node.get_attr_value("keepdims", 1):
+            return [[1 if i in axes else d for i, d in enumerate(data)]]
+        return [[d for i, d in enumerate(data) if i not in axes]]
+
+    def _arg_shape(self, node):
+        data = self.get_shape(node.input[0])
+        axis = node.get_attr_value("axis", 0)
+        axis = axis + len(data) if axis < 0 else axis
+        if node.get_attr_value("keepdims", 1):
+            return [data[:axis] + [1] + data[axis + 1:]]
+        return [data[:axis] + data[axis + 1:]]
+
+    def _conv_pool_shape(self, node):
+        # the batch dim is kept and convolutions output a channel for each filter, spatial dims come from the graph
+        data = self.get_shape(node.input[0])
+        if node.type in ["Conv", "ConvInteger"]:
+            channels = self.get_shape(node.input[1])[0]
+        elif node.type == "QLinearConv":
+            channels = self.get_shape(node.input[3])[0]
+        else:
+            channels = data[1]
+        shape = [data[0], channels] + [None] * (len(data) - 2)
+        return [shape] * len(node.output)
+
+    def _global_pool_shape(self, node):
+        data = self.get_shape(node.input[0])
+        return [data[:2] + [1] * (len(data) - 2)]
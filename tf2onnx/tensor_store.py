@@ -0,0 +1,167 @@
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""
+tf2onnx.tensor_store - keep large constants in a memory-mapped file during conversion
+"""
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+from onnx import numpy_helper, TensorProto
+
+from tf2onnx import logging, utils
+from tf2onnx.conversion_context import get_context
+
+logger = logging.getLogger(__name__)
+
+# constants of at least this many bytes are moved to the store
+DEFAULT_THRESHOLD = 2**20
+
+# external_data key marking tensors whose data lives in a TensorStore
+_STORE_KEY = "tf2onnx_tensor_store"
+
+
+class TensorStore(object):
+    """Append-only file holding the data of large constants while a model is converted.
+
+    Activated by setting it as tensor_store of the ConversionContext. make_tensor then moves arrays of at least
+    threshold bytes into the store and returns a TensorProto that references the data by handle: its external_data
+    holds the path of the store, the offset and the length. tensor_to_array reads such tensors as read-only
+    numpy.memmap views, so only the constants in use occupy memory and copies of a graph share their data.
+    The data is little endian and every tensor starts at a multiple of alignment.
+    """
+
+    def __init__(self, directory=None, threshold=DEFAULT_THRESHOLD, alignment=4096):
+        fd, self.path = tempfile.mkstemp(prefix="tf2onnx_tensors_", suffix=".bin", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self.threshold = threshold
+        self.alignment = alignment
+        self.bytes_stored = 0
+
+    def should_store(self, np_val):
+        return self._file is not None and np_val.dtype != np.object and np_val.nbytes >= self.threshold
+
+    def put(self, np_val, name=""):
+        """Append np_val to the store. Returns a TensorProto referencing it."""
+        np_val = np.ascontiguousarray(np_val, dtype=np_val.dtype.newbyteorder("<"))
+        offset = self._file.tell()
+        padding = -offset % self.alignment
+        if padding:
+            self._file.write(b"\0" * padding)
+            offset += padding
+        self._file.write(np_val.data)
+        # make the data visible to readers mapping the file
+        self._file.flush()
+        self.bytes_stored += np_val.nbytes
+
+        tensor = TensorProto()
+        tensor.name = name
+        tensor.data_type = utils.map_numpy_to_onnx_dtype(np_val.dtype)
+        tensor.dims.extend(np_val.shape)
+        tensor.data_location = TensorProto.EXTERNAL
+        for key, value in [("location", self.path), ("offset", offset), ("length", np_val.nbytes), (_STORE_KEY, 1)]:
+            entry = tensor.external_data.add()
+            entry.key = key
+            entry.value = str(value)
+        return tensor
+
+    def close(self):
+        """Delete the store. Tensors referencing it can't be read afterwards."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.path)
+            logger.debug("removed tensor store %s with %d bytes", self.path, self.bytes_stored)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def is_stored(tensor):
+    """True if the data of the onnx tensor lives in a TensorStore."""
+    return tensor.data_location == TensorProto.EXTERNAL and any(e.key == _STORE_KEY for e in tensor.external_data)
+
+
+def _handle(tensor):
+    info = {e.key: e.value for e in tensor.external_data}
+    return info["location"], int(info["offset"]), int(info["length"])
+
+
+def make_tensor(np_val, name=""):
+    """numpy_helper.from_array, but large arrays go to the tensor store of the active conversion if it has one."""
+    store = get_context().tensor_store
+    if store is not None and store.should_store(np_val):
+        return store.put(np_val, name)
+    return numpy_helper.from_array(np_val, name)
+
+
+def make_raw_tensor(data, np_dtype, shape, name="", tensor=None):
+    """make_tensor for a buffer holding the data of a tensor in native byte order. The buffer goes to the tensor
+    store or into raw_data without being converted to a numpy array first.
+    If tensor is given it is filled in and returned, which saves copying the result into a NodeProto."""
+    if tensor is None:
+        tensor = TensorProto()
+    np_val = np.frombuffer(data, dtype=np_dtype).reshape(shape)
+    store = get_context().tensor_store
+    if store is not None and store.should_store(np_val):
+        tensor.CopyFrom(store.put(np_val, name))
+    elif sys.byteorder != "little":
+        tensor.CopyFrom(numpy_helper.from_array(np_val, name))
+    else:
+        tensor.name = name
+        tensor.data_type = utils.map_numpy_to_onnx_dtype(np_val.dtype)
+        tensor.dims.extend(shape)
+        tensor.raw_data = data if isinstance(data, bytes) else np_val.tobytes()
+    return tensor
+
+
+def spill(np_val):
+    """Move a large array to the tensor store of the active conversion, if it has one, and return a read-only
+    view of it. Lets callers that hold on to many arrays keep them out of memory."""
+    store = get_context().tensor_store
+    if store is None or not store.should_store(np_val):
+        return np_val
+    return tensor_to_array(store.put(np_val))
+
+
+def spill_bytes(data):
+    """spill for the raw bytes of a tensor. Returns data or a read-only uint8 view of it in the store."""
+    store = get_context().tensor_store
+    if store is None or len(data) < store.threshold:
+        return data
+    return spill(np.frombuffer(data, np.uint8))
+
+
+def tensor_to_array(tensor):
+    """numpy_helper.to_array that returns a read-only memmap for stored tensors."""
+    if not is_stored(tensor):
+        return numpy_helper.to_array(tensor)
+    path, offset, length = _handle(tensor)
+    dtype = np.dtype(utils.map_onnx_to_numpy_type(tensor.data_type)).newbyteorder("<")
+    shape = tuple(tensor.dims)
+    if length == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def tensor_data(tensor):
+    """Return the raw data of the tensor as a bytes-like object without copying stored tensors."""
+    if not is_stored(tensor):
+        return tensor.raw_data
+    return memoryview(tensor_to_array(tensor)).cast("B")
+
+
+def materialize(tensor):
+    """Return a copy of the stored tensor with its data in raw_data."""
+    result = TensorProto()
+    result.CopyFrom(tensor)
+    result.ClearField("external_data")
+    result.data_location = TensorProto.DEFAULT
+    result.raw_data = bytes(tensor_data(tensor))
+    return result
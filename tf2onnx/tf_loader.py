@@ -3,7 +3,9 @@
 
 """Methods to load tensorflow graph from graphdef, checkpoint or saved_model."""
 
+import collections
 import logging
+import os
 from distutils.version import LooseVersion
 
 import tensorflow as tf
@@ -15,6 +17,7 @@ from tensorflow.python.ops import lookup_ops
 from tensorflow.python.util import compat
 
 from tf2onnx import utils
+from tf2onnx.conversion_context import get_context
 from tf2onnx.tf_utils import get_tf_version, tflist_to_onnx, get_hash_table_info, replace_placeholders_with_tables
 
 logger = logging.getLogger(__name__)
@@ -166,6 +169,99 @@ def convert_variables_to_constants_large_model(func):
     return frozen_graph_def
 
 
+def can_stream_variables():
+    """True if this version of tensorflow lets CheckpointVariables freeze saved models."""
+    try:
+        from tensorflow.python.checkpoint import graph_view, util  # pylint: disable=unused-import
+        from tensorflow.python.framework.convert_to_constants import \
+            _FunctionConverterData, _replace_variables_by_constants # pylint: disable=protected-access
+    except ImportError:
+        return False
+    return hasattr(tf.saved_model.LoadOptions(), "experimental_skip_checkpoint")
+
+
+class CheckpointVariables(object):
+    """Freezes functions of a saved model loaded without its variables and reads the values of the variables from
+    the checkpoint of the saved model later on, one at a time, so they never have to be in memory all at once.
+
+    freeze replaces each variable larger than VALUE_LIMIT bytes by a Const holding only its dtype and shape, the way
+    compress_graph_def leaves them. read_values then returns their values in the form of compress_graph_def.
+    """
+
+    # smaller variables are frozen into the graph, they may hold shapes needed to import it
+    VALUE_LIMIT = 1000
+
+    def __init__(self, trackable, checkpoint_prefix):
+        from tensorflow.python.checkpoint import graph_view, util
+        self.checkpoint_prefix = checkpoint_prefix
+        self.reader = tf.train.load_checkpoint(checkpoint_prefix)
+        self.shapes = self.reader.get_variable_to_shape_map()
+        self.dtypes = self.reader.get_variable_to_dtype_map()
+        object_names = util.objects_ids_and_slot_variables_and_paths(graph_view.ObjectGraphView(trackable))[-1]
+        self.variable_keys = {id(obj): name + "/.ATTRIBUTES/VARIABLE_VALUE"
+                              for obj, name in object_names.items() if isinstance(obj, tf.Variable)}
+        # names of the Consts left without value to their checkpoint keys
+        self.node_to_key = {}
+
+    def freeze(self, func):
+        """Like convert_variables_to_constants_large_model, but large variables are taken from the checkpoint."""
+        from tensorflow.python.framework import tensor_util, tensor_shape
+        from tensorflow.python.framework.convert_to_constants import \
+            _FunctionConverterData, _replace_variables_by_constants # pylint: disable=protected-access
+
+        # the arrays standing in for large variables by id, they take no memory
+        stand_ins = {}
+
+        def read_variable(variable):
+            key = self.variable_keys.get(id(variable))
+            utils.make_sure(key in self.shapes, "Variable %s is not in checkpoint %s", variable.name,
+                            self.checkpoint_prefix)
+            dtype = self.dtypes[key]
+            if dtype.is_numpy_compatible and dtype != tf.string:
+                stand_in = np.broadcast_to(np.zeros((), dtype.as_numpy_dtype), self.shapes[key])
+                if stand_in.nbytes > self.VALUE_LIMIT:
+                    stand_ins[id(stand_in)] = (stand_in, key)
+                    return stand_in
+            return self.reader.get_tensor(key)
+
+        class ConverterData(_FunctionConverterData):
+            def _eval(self, tensor):
+                if isinstance(tensor, tf.Variable):
+                    return read_variable(tensor)
+                return tensor.numpy()
+
+        make_tensor_proto_original = tensor_util.make_tensor_proto
+        def make_tensor_proto_wrapped(values, dtype=None, shape=None, verify_shape=False, allow_broadcast=False):
+            if id(values) not in stand_ins:
+                return make_tensor_proto_original(values, dtype, shape, verify_shape, allow_broadcast)
+            return tensor_pb2.TensorProto(dtype=tf.dtypes.as_dtype(values.dtype).as_datatype_enum,
+                                          tensor_shape=tensor_shape.as_shape(values.shape).as_proto())
+        tensor_util.make_tensor_proto = make_tensor_proto_wrapped
+
+        try:
+            converter_data = ConverterData(func=func, lower_control_flow=False, aggressive_inlining=True)
+            frozen_graph_def, _ = _replace_variables_by_constants(converter_data=converter_data)
+        finally:
+            tensor_util.make_tensor_proto = make_tensor_proto_original
+        for name, data in converter_data.tensor_data.items():
+            if id(data.numpy) in stand_ins:
+                self.node_to_key[name] = stand_ins[id(data.numpy)][1]
+        logger.info("Froze %d variables without reading them from the checkpoint", len(self.node_to_key))
+        return frozen_graph_def
+
+    def read_values(self):
+        """Read the values of the Consts left by freeze from the checkpoint. Returns a dict mapping their names to
+        the tensor_content of their value, like compress_graph_def. If the active conversion has a tensor store each
+        value goes there as soon as it is read and the dict holds read-only views."""
+        from tf2onnx.tensor_store import spill
+        const_node_values = {}
+        for name, key in self.node_to_key.items():
+            value = np.ascontiguousarray(self.reader.get_tensor(key))
+            const_node_values[name] = spill(value.reshape(-1).view(np.uint8))
+            del value
+        return const_node_values
+
+
 def fix_freezing_errors(graph_def):
     assign_var_ops = []
     for i in reversed(range(len(graph_def.node))):
@@ -180,7 +276,7 @@ def fix_freezing_errors(graph_def):
     return graph_def
 
 
-def from_trackable(trackable, concrete_func, inputs, outputs, large_model):
+def from_trackable(trackable, concrete_func, inputs, outputs, large_model, checkpoint_variables=None):
     err_large_model = "model exceeds maximum protobuf size of 2GB. Try setting large_model."
 
     # Avoid errors due to bug in TF freezing
@@ -188,7 +284,7 @@ def from_trackable(trackable, concrete_func, inputs, outputs, large_model):
         _remove_non_variable_resources_from_captures(concrete_func)
 
     try:
-        frozen_graph = from_function(concrete_func, inputs, outputs, large_model)
+        frozen_graph = from_function(concrete_func, inputs, outputs, large_model, checkpoint_variables)
     except ValueError as e:
         if any(msg in str(e) for msg in ["exceeds maximum protobuf size of 2GB", "string too long"]):
             raise ValueError(err_large_model)
@@ -220,7 +316,9 @@ def from_trackable(trackable, concrete_func, inputs, outputs, large_model):
     return frozen_graph, initialized_tables
 
 
-def from_function(func, input_names, output_names, large_model=False):
+def from_function(func, input_names, output_names, large_model=False, checkpoint_variables=None):
+    if checkpoint_variables is not None:
+        return checkpoint_variables.freeze(func)
     if large_model:
         return convert_variables_to_constants_large_model(func)
 
@@ -483,18 +581,10 @@ def _restore_captured_resources(concrete_func, graph_captures_copy, func_capture
         concrete_func._captured_inputs = func_captures_copy
 
 
-def _from_saved_model_v2(model_path, input_names, output_names, tag, signature_def,
-                         concrete_function_index, large_model, use_graph_names):
-    """Load tensorflow graph from saved_model."""
-
+def _load_saved_model_v2(model_path, tag, stream_variables):
+    """Load a tf2 saved_model, without its variables if stream_variables. Returns it and its signatures."""
     wrn_no_tag = "'--tag' not specified for saved_model. Using --tag serve"
     wrn_empty_tag = "'--tag' value is empty string. Using tag =[[]]"
-    wrn_sig_1 = "'--signature_def' not specified, using first signature: %s"
-    err_many_sig = "Cannot load multiple signature defs in TF2.x: %s"
-    err_no_call = "Model doesn't contain usable concrete functions under  __call__. Try --signature-def instead."
-    err_index = "Invalid concrete_function value: %i. Valid values are [0 to %i]"
-    err_no_sig = "No signatures found in model. Try --concrete_function instead."
-    err_sig_nomatch = "Specified signature not in model %s"
 
     if tag is None:
         tag = ['serve']
@@ -504,33 +594,25 @@ def _from_saved_model_v2(model_path, input_names, output_names, tag, signature_d
         tag = [[]]
         logger.warning(wrn_empty_tag)
 
-    utils.make_sure(len(signature_def) < 2, err_many_sig, str(signature_def))
-    imported = tf.saved_model.load(model_path, tags=tag)  # pylint: disable=no-value-for-parameter
+    if stream_variables:
+        options = tf.saved_model.LoadOptions(experimental_skip_checkpoint=True)
+        imported = tf.saved_model.load(model_path, tags=tag, options=options)  # pylint: disable=no-value-for-parameter
+    else:
+        imported = tf.saved_model.load(model_path, tags=tag)  # pylint: disable=no-value-for-parameter
 
     all_sigs = imported.signatures.keys()
     valid_sigs = [s for s in all_sigs if not s.startswith("_")]
     logger.info("Signatures found in model: %s", "[" + ",".join(valid_sigs) + "].")
+    return imported, valid_sigs
 
-    concrete_func = None
-    if concrete_function_index is not None:
-        utils.make_sure(hasattr(imported, "__call__"), err_no_call)
-        utils.make_sure(concrete_function_index < len(imported.__call__.concrete_functions),
-                        err_index, concrete_function_index, len(imported.__call__.concrete_functions) - 1)
-        args, kwargs = imported.__call__.concrete_functions[concrete_function_index].structured_input_signature
-        concrete_func = imported.__call__.get_concrete_function(*args, **kwargs)
-    elif signature_def:
-        utils.make_sure(signature_def[0] in valid_sigs, err_sig_nomatch, signature_def[0])
-        concrete_func = imported.signatures[signature_def[0]]
-    else:
-        utils.make_sure(len(valid_sigs) > 0, err_no_sig)
-        logger.warning(wrn_sig_1, valid_sigs[0])
-        concrete_func = imported.signatures[valid_sigs[0]]
 
+def _freeze_saved_model_function_v2(model_path, imported, concrete_func, input_names, output_names, large_model,
+                                    use_graph_names, stream_variables):
+    """Freeze a concrete function of a saved_model loaded by _load_saved_model_v2."""
     tensors_to_rename = {}
     if input_names is None:
         inputs = [tensor.name for tensor in concrete_func.inputs if tensor.dtype != tf.dtypes.resource]
-        graph_captures = concrete_func.graph._captures  # pylint: disable=protected-access
-        captured_inputs = [t_name.name for _, t_name in graph_captures.values()]
+        captured_inputs = [t_name.name for _, t_name in concrete_func.graph.captures]
         inputs = [inp for inp in inputs if inp not in captured_inputs]
         if concrete_func.structured_input_signature is not None and not use_graph_names:
             flat_structured_inp = tf.nest.flatten(concrete_func.structured_input_signature)
@@ -551,24 +633,92 @@ def _from_saved_model_v2(model_path, input_names, output_names, tag, signature_d
     else:
         outputs = output_names
 
-    frozen_graph, initialized_tables = from_trackable(imported, concrete_func, inputs, outputs, large_model)
+    checkpoint_variables = None
+    if stream_variables:
+        checkpoint_variables = CheckpointVariables(imported, os.path.join(model_path, "variables", "variables"))
+    frozen_graph, initialized_tables = from_trackable(imported, concrete_func, inputs, outputs, large_model,
+                                                      checkpoint_variables)
 
-    return frozen_graph, inputs, outputs, concrete_func, imported, initialized_tables, tensors_to_rename
+    return frozen_graph, inputs, outputs, initialized_tables, tensors_to_rename, checkpoint_variables
+
+
+def _from_saved_model_v2(model_path, input_names, output_names, tag, signature_def,
+                         concrete_function_index, large_model, use_graph_names, stream_variables=False):
+    """Load tensorflow graph from saved_model.
+    With stream_variables the variables aren't loaded and large ones are left out of the frozen graph, the
+    CheckpointVariables returned in their place read them when needed."""
+
+    wrn_sig_1 = "'--signature_def' not specified, using first signature: %s"
+    err_many_sig = "Cannot load multiple signature defs in TF2.x: %s, use from_saved_model_signatures"
+    err_no_call = "Model doesn't contain usable concrete functions under  __call__. Try --signature-def instead."
+    err_index = "Invalid concrete_function value: %i. Valid values are [0 to %i]"
+    err_no_sig = "No signatures found in model. Try --concrete_function instead."
+    err_sig_nomatch = "Specified signature not in model %s"
+
+    utils.make_sure(len(signature_def) < 2, err_many_sig, str(signature_def))
+    imported, valid_sigs = _load_saved_model_v2(model_path, tag, stream_variables)
+
+    concrete_func = None
+    if concrete_function_index is not None:
+        utils.make_sure(hasattr(imported, "__call__"), err_no_call)
+        utils.make_sure(concrete_function_index < len(imported.__call__.concrete_functions),
+                        err_index, concrete_function_index, len(imported.__call__.concrete_functions) - 1)
+        args, kwargs = imported.__call__.concrete_functions[concrete_function_index].structured_input_signature
+        concrete_func = imported.__call__.get_concrete_function(*args, **kwargs)
+    elif signature_def:
+        utils.make_sure(signature_def[0] in valid_sigs, err_sig_nomatch, signature_def[0])
+        concrete_func = imported.signatures[signature_def[0]]
+    else:
+        utils.make_sure(len(valid_sigs) > 0, err_no_sig)
+        logger.warning(wrn_sig_1, valid_sigs[0])
+        concrete_func = imported.signatures[valid_sigs[0]]
+
+    frozen_graph, inputs, outputs, initialized_tables, tensors_to_rename, checkpoint_variables = \
+        _freeze_saved_model_function_v2(model_path, imported, concrete_func, input_names, output_names, large_model,
+                                        use_graph_names, stream_variables)
+
+    return frozen_graph, inputs, outputs, concrete_func, imported, initialized_tables, tensors_to_rename, \
+        checkpoint_variables
+
+
+def from_saved_model_signatures(model_path, signatures, tag=None, large_model=False, use_graph_names=False,
+                                stream_variables=False):
+    """Load a tf2 saved_model once and freeze each of the given signatures, all of them if signatures is None.
+    Returns an OrderedDict mapping the signatures to [frozen_graph, input_names, output_names, initialized_tables,
+    tensors_to_rename, checkpoint_variables] like from_saved_model returns them for a single signature, with
+    checkpoint_variables None unless stream_variables."""
+    utils.make_sure(is_tf2(), "Converting several signatures at once requires tf2")
+    result = collections.OrderedDict()
+    tf_reset_default_graph()
+    with tf.device("/cpu:0"):
+        imported, valid_sigs = _load_saved_model_v2(model_path, tag, stream_variables)
+        for signature in signatures or valid_sigs:
+            utils.make_sure(signature in valid_sigs, "Specified signature not in model %s", signature)
+            logger.info("Freezing signature %s", signature)
+            result[signature] = list(_freeze_saved_model_function_v2(
+                model_path, imported, imported.signatures[signature], None, None, large_model, use_graph_names,
+                stream_variables))
+    tf_reset_default_graph()
+    return result
 
 
 def from_saved_model(model_path, input_names, output_names, tag=None,
                      signatures=None, concrete_function=None, large_model=False,
                      return_concrete_func=False, return_initialized_tables=False,
-                     return_tensors_to_rename=False, use_graph_names=False):
-    """Load tensorflow graph from saved_model."""
+                     return_tensors_to_rename=False, use_graph_names=False, stream_variables=False):
+    """Load tensorflow graph from saved_model.
+    stream_variables (tf2 only, see can_stream_variables) doesn't load the variables, large ones are left in the
+    checkpoint and the last item of the result is a CheckpointVariables that reads them. Pass it to the conversion
+    as checkpoint_variables. The concrete function returned with return_concrete_func can't be run in that case."""
     if signatures is None:
         signatures = []
     tf_reset_default_graph()
     with tf.device("/cpu:0"):
         if is_tf2():
-            frozen_graph, input_names, output_names, concrete_func, imported, initialized_tables, tensors_to_rename = \
-                _from_saved_model_v2(model_path, input_names, output_names,
-                                     tag, signatures, concrete_function, large_model, use_graph_names)
+            frozen_graph, input_names, output_names, concrete_func, imported, initialized_tables, tensors_to_rename, \
+                checkpoint_variables = _from_saved_model_v2(model_path, input_names, output_names, tag, signatures,
+                                                            concrete_function, large_model, use_graph_names,
+                                                            stream_variables)
             result = [frozen_graph, input_names, output_names]
             if return_concrete_func:
                 result += [concrete_func, imported]
@@ -576,6 +726,8 @@ def from_saved_model(model_path, input_names, output_names, tag=None,
                 result += [initialized_tables]
             if return_tensors_to_rename:
                 result += [tensors_to_rename]
+            if stream_variables:
+                result += [checkpoint_variables]
         else:
             with tf_session() as sess:
                 frozen_graph, input_names, output_names, initialized_tables, tensors_to_rename = \
@@ -585,6 +737,8 @@ def from_saved_model(model_path, input_names, output_names, tag=None,
                     result += [initialized_tables]
                 if return_tensors_to_rename:
                     result += [tensors_to_rename]
+                if stream_variables:
+                    result += [None]
     tf_reset_default_graph()
     return result
 
@@ -700,49 +854,62 @@ def is_function(g):
     return False
 
 
-_FUNCTIONS = {}
-
+def function_to_graph(fdef, input_shapes=None):
+    """Make a tf graph for the FunctionDef fdef, using the input shapes of the caller if they match."""
+    if input_shapes and len(fdef.signature.input_arg) < len(input_shapes):
+        input_shapes = input_shapes[:len(fdef.signature.input_arg)]
+    try:
+        return function_def_to_graph(fdef, input_shapes=input_shapes)
+    except:  # pylint: disable=bare-except
+        # if there is a missmatch between caller and function use the functions shape
+        logger.warning("shape missmatch between caller and function: %s", fdef.signature.name)
+        return function_def_to_graph(fdef)
 
-def resolve_functions(tf_graph):
-    def toposort(data):
-        while True:
-            ordered = set(item for item, dep in data.items() if not dep)
-            if not ordered:
-                break
-            yield ordered
-            data = {item: (dep - ordered) for item, dep in data.items() if item not in ordered}
 
+def resolve_function_dependencies(tf_graph):
+    """Make tf graphs for all functions of tf_graph and register them with set_function.
+    Returns a dict mapping each function name to the names of the functions it calls and a dict
+    mapping each function name to the input shapes it was resolved with."""
     _, _, _, _, _, functions = tflist_to_onnx(tf_graph, {})
-    data = {}
+    registry = get_context().functions
+    dependencies = {}
+    input_shapes = {}
     for k, fdef in tf_graph._functions.items():  # pylint: disable=protected-access
-        input_shapes = functions.get(k)
-        fdef = fdef.definition
-        if input_shapes and len(fdef.signature.input_arg) < len(input_shapes):
-            input_shapes = input_shapes[:len(fdef.signature.input_arg)]
-        try:
-            func = function_def_to_graph(fdef, input_shapes=input_shapes)
-        except:  # pylint: disable=bare-except
-            # if there is a missmatch between caller and function use the functions shape
-            logger.warning("shape missmatch between caller and function: %s", k)
-            func = function_def_to_graph(fdef)
-        _FUNCTIONS[k] = func
+        input_shapes[k] = functions.get(k)
+        func = function_to_graph(fdef.definition, input_shapes[k])
+        registry[k] = func
         _, _, _, _, _, tfunctions = tflist_to_onnx(func, {})
         functions.update(tfunctions)
-        data[k] = set(tfunctions.keys())
+        dependencies[k] = set(tfunctions.keys())
+    return dependencies, input_shapes
+
+
+def toposort_functions(dependencies):
+    """Yield sorted lists of function names. Functions in a list only call functions of earlier lists."""
+    while True:
+        ordered = set(item for item, dep in dependencies.items() if not dep)
+        if not ordered:
+            break
+        yield sorted(ordered)
+        dependencies = {item: (dep - ordered) for item, dep in dependencies.items() if item not in ordered}
 
+
+def resolve_functions(tf_graph):
+    dependencies, _ = resolve_function_dependencies(tf_graph)
+    registry = get_context().functions
     result = []
-    for d in toposort(data):
-        result.extend(list(d))
-    return [_FUNCTIONS[k] for k in result]
+    for names in toposort_functions(dependencies):
+        result.extend(names)
+    return [registry[k] for k in result]
 
 
 def set_function(name, func):
-    _FUNCTIONS[name] = func
+    get_context().functions[name] = func
 
 
 def find_function(name):
-    return _FUNCTIONS.get(name)
+    return get_context().functions.get(name)
 
 
 def clear_functions():
-    _FUNCTIONS.clear()
+    get_context().functions.clear()
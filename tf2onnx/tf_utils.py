@@ -11,12 +11,13 @@ from distutils.version import LooseVersion
 import numpy as np
 import tensorflow as tf
 
-from tensorflow.core.framework import types_pb2, tensor_pb2, graph_pb2
+from tensorflow.core.framework import types_pb2, tensor_pb2, tensor_shape_pb2, graph_pb2
 from tensorflow.python.framework import tensor_util
 
-from onnx import helper, onnx_pb, numpy_helper
+from onnx import helper, onnx_pb
 
 from tf2onnx.utils import make_sure, is_tf_const_op, port_name, map_onnx_to_numpy_type
+from tf2onnx.tensor_store import make_raw_tensor, make_tensor, spill, spill_bytes
 from . import logging
 
 logger = logging.getLogger(__name__)
@@ -45,8 +46,36 @@ TF_TO_ONNX_DTYPE = {
 }
 
 
-def tf_to_onnx_tensor(tensor, name=""):
-    """Convert tensorflow tensor to onnx tensor."""
+# tensorflow dtypes whose tensor_content holds the data of a numpy array of the given dtype
+TF_CONTENT_TO_NUMPY_DTYPE = {
+    types_pb2.DT_FLOAT: np.float32,
+    types_pb2.DT_HALF: np.float16,
+    types_pb2.DT_DOUBLE: np.float64,
+    types_pb2.DT_INT32: np.int32,
+    types_pb2.DT_INT16: np.int16,
+    types_pb2.DT_INT8: np.int8,
+    types_pb2.DT_UINT8: np.uint8,
+    types_pb2.DT_UINT16: np.uint16,
+    types_pb2.DT_INT64: np.int64,
+    types_pb2.DT_COMPLEX64: np.complex64,
+    types_pb2.DT_COMPLEX128: np.complex128,
+    types_pb2.DT_BOOL: np.bool,
+}
+
+
+def tf_to_onnx_tensor(tensor, name="", content=None, onnx_tensor=None):
+    """Convert tensorflow tensor to onnx tensor.
+    content replaces the tensor_content of tensor, for example a value returned by compress_graph_def.
+    Numeric tensors with tensor_content are made from it directly instead of going through numpy.
+    If onnx_tensor is given the result is written to it."""
+    if content is None:
+        content = tensor.tensor_content
+    np_dtype = TF_CONTENT_TO_NUMPY_DTYPE.get(tensor.dtype)
+    if np_dtype is not None and memoryview(content).nbytes > 0:
+        return make_raw_tensor(content, np_dtype, [d.size for d in tensor.tensor_shape.dim], name=name,
+                               tensor=onnx_tensor)
+    if len(content) > 0:
+        tensor.tensor_content = bytes(content)
     np_data = get_tf_tensor_data(tensor)
     if np_data.dtype == np.object:
         # assume np_data is string, numpy_helper.from_array accepts ndarray,
@@ -59,7 +88,10 @@ def tf_to_onnx_tensor(tensor, name=""):
             np_data = decode(np_data).astype(np.object)
         except:  # pylint: disable=bare-except
             raise RuntimeError("Not support type: {}".format(type(np_data.flat[0])))
-    return numpy_helper.from_array(np_data, name=name)
+    if onnx_tensor is None:
+        return make_tensor(np_data, name=name)
+    onnx_tensor.CopyFrom(make_tensor(np_data, name=name))
+    return onnx_tensor
 
 
 def get_tf_tensor_data(tensor):
@@ -70,6 +102,37 @@ def get_tf_tensor_data(tensor):
     return np_data
 
 
+def get_tf_tensor_view(tensor, content=None):
+    """Like get_tf_tensor_data, but numeric tensors with tensor_content are returned as a read-only view of it.
+    content replaces the tensor_content of tensor."""
+    if content is None:
+        content = tensor.tensor_content
+    np_dtype = TF_CONTENT_TO_NUMPY_DTYPE.get(tensor.dtype)
+    if np_dtype is not None and memoryview(content).nbytes > 0:
+        return np.frombuffer(content, dtype=np_dtype).reshape([d.size for d in tensor.tensor_shape.dim])
+    if len(content) > 0:
+        tensor.tensor_content = bytes(content)
+    return get_tf_tensor_data(tensor)
+
+
+def get_tf_attr_value(attr_value):
+    """Return the value of an AttrValue proto the way tf.Operation.get_attr returns it."""
+    field = attr_value.WhichOneof("value")
+    if field is None:
+        return []
+    if field == "list":
+        for list_field in ["s", "i", "f", "b", "type", "shape", "tensor", "func"]:
+            values = getattr(attr_value.list, list_field)
+            if values:
+                if list_field == "type":
+                    return [tf.as_dtype(t) for t in values]
+                return list(values)
+        return []
+    if field == "type":
+        return tf.as_dtype(attr_value.type)
+    return getattr(attr_value, field)
+
+
 def get_tf_const_value(op, as_list=True):
     """
     If as_list=True, return the array as a (possibly nested) list.
@@ -124,6 +187,7 @@ def get_tf_version():
 def compress_graph_def(graph_def):
     """
     Remove large const values from graph. This lets us import the graph and run shape inference without TF crashing.
+    If the active conversion has a tensor store the values are moved there and the dict holds read-only views.
     """
     node_defs = list(graph_def.node)
     const_node_values = {}
@@ -133,7 +197,7 @@ def compress_graph_def(graph_def):
             # Small constants are sometimes used to store shape information and must be maintained
             if len(tensor.tensor_content) > 1000:
                 make_sure(node_def.name not in const_node_values, "Two nodes in graph have same name %s", node_def.name)
-                const_node_values[node_def.name] = tensor.tensor_content
+                const_node_values[node_def.name] = spill_bytes(tensor.tensor_content)
                 tensor.tensor_content = b''
     return const_node_values
 
@@ -187,8 +251,10 @@ def compute_const_folding_using_tf(g, const_node_values, graph_outputs):
         if node.type in ["Const", "ConstV2"]:
             tensor = node.node_def.attr["value"].tensor
             if node.name in const_node_values:
-                tensor.tensor_content = const_node_values[node.name]
-            outputs_to_values[node.outputs[0].name] = get_tf_tensor_data(tensor)
+                # compress_graph_def already moved the value to the tensor store if there is one
+                outputs_to_values[node.outputs[0].name] = get_tf_tensor_view(tensor, const_node_values[node.name])
+            else:
+                outputs_to_values[node.outputs[0].name] = spill(get_tf_tensor_view(tensor))
             outputs_to_dtypes[node.outputs[0].name] = node.outputs[0].dtype
         for out in node.outputs:
             outputs_to_shapes[out.name] = get_tf_tensor_shape(out)
@@ -358,28 +424,32 @@ TF_SUBGRAPH_ATTRS = {
 }
 
 
+def _read_tf_attr(name, value, attr):
+    """Add tf attribute name with the given value to the onnx attributes attr, unless it is dropped.
+    Tensors and functions are left to the caller."""
+    if name in TF_IGNORED_NODE_ATTRS or name in TF_SUBGRAPH_ATTRS or isinstance(value, tensor_pb2.TensorProto):
+        pass
+    elif name == "shape":
+        if isinstance(value, tensor_shape_pb2.TensorShapeProto) and not value.unknown_rank:
+            attr[name] = [int(d.size) for d in value.dim]
+    elif name == "DstT":
+        attr["to"] = map_tf_dtype(value)
+    elif isinstance(value, tf.DType):
+        attr[name] = map_tf_dtype(value)
+    elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], tf.DType):
+        attr[name] = [map_tf_dtype(v) for v in value]
+    else:
+        attr[name] = value
+
+
 def read_tf_node_attrs(node):
     """Given a tf Node, returns a dict of attribute names to values"""
     attr = {}
     attr_cnt = collections.Counter()
 
-    for a in node.node_def.attr:
+    for a, attr_value in node.node_def.attr.items():
         attr_cnt[a] += 1
-        value = get_tf_node_attr(node, a)
-        if a in TF_IGNORED_NODE_ATTRS or a in TF_SUBGRAPH_ATTRS or isinstance(value, tensor_pb2.TensorProto):
-            pass
-        elif a == "shape":
-            shape = get_tf_shape_attr(node)
-            if shape is not None:
-                attr[a] = shape
-        elif a == "DstT":
-            attr["to"] = map_tf_dtype(value)
-        elif isinstance(value, tf.DType):
-            attr[a] = map_tf_dtype(value)
-        elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], tf.DType):
-            attr[a] = [map_tf_dtype(v) for v in value]
-        else:
-            attr[a] = get_tf_node_attr(node, a)
+        _read_tf_attr(a, get_tf_attr_value(attr_value), attr)
 
     return attr, attr_cnt
 
@@ -412,26 +482,25 @@ def tflist_to_onnx(g, shape_override, const_node_values=None, ignore_default=Non
             output_shapes[out.name] = shape
 
     for node in ops:
-        attr, new_attr_cnt = read_tf_node_attrs(node)
-        attr_cnt += new_attr_cnt
+        attr = {}
+        tensor_attrs = {}
         takeit = True
         op_cnt[node.type] += 1
-        for a in node.node_def.attr:
+        # node_def is serialized by tf on every access, read it and its attributes once
+        for a, attr_value in node.node_def.attr.items():
             attr_cnt[a] += 1
-            value = get_tf_node_attr(node, a)
+            value = get_tf_attr_value(attr_value)
             if a == "T":
                 if value and not isinstance(value, list):
                     dtypes[node.name] = map_tf_dtype(value)
             elif a in TF_SUBGRAPH_ATTRS:
                 input_shapes = [inp.get_shape() for inp in node.inputs]
-                nattr = get_tf_node_attr(node, a)
-                attr[a] = nattr.name
-                functions[nattr.name] = input_shapes
+                attr[a] = value.name
+                functions[value.name] = input_shapes
             elif isinstance(value, tensor_pb2.TensorProto):
-                if const_node_values and node.name in const_node_values:
-                    value.tensor_content = const_node_values[node.name]
-                onnx_tensor = tf_to_onnx_tensor(value, name=port_name(node.name))
-                attr[a] = onnx_tensor
+                tensor_attrs[a] = value
+            else:
+                _read_tf_attr(a, value, attr)
 
         node_type = node.type
         input_names = [i.name for i in node.inputs]
@@ -451,6 +520,13 @@ def tflist_to_onnx(g, shape_override, const_node_values=None, ignore_default=Non
         if takeit:
             try:
                 onnx_node = helper.make_node(node_type, input_names, output_names, name=node.name, **attr)
+                for a, value in sorted(tensor_attrs.items()):
+                    # build the onnx tensor in place, copying a large tensor into the node costs as much as making it
+                    onnx_attr = onnx_node.attribute.add()
+                    onnx_attr.name = a
+                    onnx_attr.type = onnx_pb.AttributeProto.TENSOR
+                    content = const_node_values.get(node.name) if const_node_values else None
+                    tf_to_onnx_tensor(value, name=port_name(node.name), content=content, onnx_tensor=onnx_attr.t)
                 onnx_nodes.append(onnx_node)
             except Exception as ex:
                 logger.error("pass1 convert failed for %s, ex=%s", node, ex)
@@ -10,11 +10,15 @@ Main functions of interest are graphs_from_tfjs and read_tfjs_graph
 import json
 import os
 import base64
+import bisect
+import collections
 import gzip
+import mmap
 import struct
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from onnx import numpy_helper, helper
+from onnx import helper, TensorProto
 import numpy as np
 from google.protobuf.json_format import ParseDict
 import tensorflow as tf
@@ -24,6 +28,7 @@ from tensorflow.core.framework import types_pb2, node_def_pb2
 from tf2onnx import utils
 from tf2onnx.graph import Graph
 from tf2onnx import tf_utils
+from tf2onnx.tensor_store import make_tensor
 
 logger = logging.getLogger(__name__)
 
@@ -206,31 +211,14 @@ def read_model_json(model_path):
     return model, zip_compressed
 
 
-def graphs_from_tfjs(model_path, input_names=None, output_names=None, ignore_default=None, use_default=None):
+def graphs_from_tfjs(model_path, input_names=None, output_names=None, ignore_default=None, use_default=None,
+                     compact_weights=False):
     """Given the path to a model.json file, parses the model into onnx graphs and returns the main graph and a
-    topologically sorted list of subgraphs."""
+    topologically sorted list of subgraphs.
+    If compact_weights is True, quantized weights keep their compact dtype, see read_tfjs_weights."""
     model, zip_compressed = read_model_json(model_path)
 
-    weights_manifest = model['weightsManifest'][0]
-
-    sharded_data = []
-    for path in weights_manifest["paths"]:
-        with open(os.path.join(os.path.dirname(model_path), path), "rb") as f:
-            shard_bytes = f.read()
-            if zip_compressed:
-                shard_bytes = gzip.decompress(shard_bytes)
-            sharded_data.append(shard_bytes)
-
-    weights_data = b''.join(sharded_data)
-    weights = {}
-
-    i = 0
-    for weight in weights_manifest['weights']:
-        weight_name, np_arr, num_bytes = read_tfjs_weight(weight, weights_data, offset=i)
-        weights[weight_name] = np_arr
-        i += num_bytes
-
-    utils.make_sure(len(weights_data) == i, "Total weight bytes %d doesn't match read bytes %d", len(weights_data), i)
+    weights = read_tfjs_weights(model, os.path.dirname(model_path), zip_compressed, compact_weights)
     topology = model['modelTopology']
 
     if output_names is None and 'signature' in model:
@@ -246,8 +234,93 @@ def graphs_from_tfjs(model_path, input_names=None, output_names=None, ignore_def
     return main_g, subgraphs
 
 
-def read_tfjs_weight(weight, weights_data, offset):
-    """Returns the name, numpy array, and number of bytes for a tfjs weight"""
+class ShardedBuffer(object):
+    """The weight data of a tfjs weight group, which is split over several shard files.
+
+    Bytes are addressed by their offset in the concatenation of the shards, but the shards are never concatenated:
+    read returns a view of the shard holding the bytes and only copies the few weights spanning two shards.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.starts = [0]
+        for shard in shards:
+            self.starts.append(self.starts[-1] + len(shard))
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def read(self, offset, num_bytes):
+        """Returns a bytes-like object with num_bytes bytes starting at offset."""
+        utils.make_sure(0 <= offset and offset + num_bytes <= len(self),
+                        "Weight data [%d, %d) is out of range, the shards have %d bytes",
+                        offset, offset + num_bytes, len(self))
+        if num_bytes == 0:
+            return b''
+        idx = bisect.bisect_right(self.starts, offset) - 1
+        start = offset - self.starts[idx]
+        shard = self.shards[idx]
+        if start + num_bytes <= len(shard):
+            return memoryview(shard)[start:start + num_bytes]
+        parts = []
+        while num_bytes > 0:
+            part = memoryview(self.shards[idx])[start:start + num_bytes]
+            parts.append(part)
+            num_bytes -= len(part)
+            idx += 1
+            start = 0
+        return b''.join(parts)
+
+    def __getitem__(self, key):
+        utils.make_sure(isinstance(key, slice) and key.step is None, "ShardedBuffer only supports slices")
+        start, stop, _ = key.indices(len(self))
+        return bytes(self.read(start, max(0, stop - start)))
+
+
+def read_tfjs_weight_shard(path, zip_compressed):
+    """Returns the contents of a weight shard. Uncompressed shards are memory-mapped rather than read."""
+    with open(path, "rb") as f:
+        if zip_compressed:
+            return gzip.decompress(f.read())
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_tfjs_weights(model, model_dir, zip_compressed, compact_weights=False):
+    """Returns a dict mapping the names of the weights of all weight groups of the model to numpy arrays.
+    The shards are loaded in a thread pool and the arrays are views of the shards where possible.
+    If compact_weights is True, weights quantized to uint8 or float16 are returned as CompactWeights where
+    possible instead of being expanded to their original dtype."""
+    groups = model.get('weightsManifest', [])
+    paths = [os.path.join(model_dir, path) for group in groups for path in group['paths']]
+    with ThreadPoolExecutor() as executor:
+        shards = list(executor.map(lambda path: read_tfjs_weight_shard(path, zip_compressed), paths))
+
+    weights = {}
+    for group in groups:
+        num_shards = len(group['paths'])
+        weights_data = ShardedBuffer(shards[:num_shards])
+        shards = shards[num_shards:]
+        i = 0
+        for weight in group['weights']:
+            weight_name, np_arr, num_bytes = read_tfjs_weight(weight, weights_data, offset=i, compact=compact_weights)
+            weights[weight_name] = np_arr
+            i += num_bytes
+        utils.make_sure(len(weights_data) == i, "Total weight bytes %d doesn't match read bytes %d",
+                        len(weights_data), i)
+    return weights
+
+
+# A weight kept in the dtype it is quantized to, read_tfjs_graph emits it as a Const followed by a DequantizeLinear
+# (uint8, data is dequantized as (data - zero_point) * scale) or a Cast (float16, scale and zero_point are None).
+CompactWeight = collections.namedtuple("CompactWeight", ["data", "scale", "zero_point", "dtype"])
+
+
+def read_tfjs_weight(weight, weights_data, offset, compact=False):
+    """Returns the name, numpy array, and number of bytes for a tfjs weight stored at offset in weights_data,
+    a ShardedBuffer. If compact is True quantized weights are returned as CompactWeight where possible."""
     name = weight['name']
     count = np.product(weight['shape'], dtype=np.int64)
     if weight['dtype'] == 'string':
@@ -259,16 +332,49 @@ def read_tfjs_weight(weight, weights_data, offset):
     if 'quantization' in weight:
         q_info = weight['quantization']
         q_dtype = np.dtype(q_info['dtype'])
-        np_arr = np.frombuffer(weights_data, dtype=q_dtype, count=count, offset=i)
-        num_bytes = np_arr.nbytes
-        np_arr = np_arr.astype(np_dtype) * q_info['scale'] + q_info['min']
+        num_bytes = int(count) * q_dtype.itemsize
+        np_arr = np.frombuffer(weights_data.read(offset, num_bytes), dtype=q_dtype).reshape(weight['shape'])
+        if compact:
+            compact_weight = make_compact_weight(np_arr, q_info, np_dtype)
+            if compact_weight is not None:
+                return name, compact_weight, num_bytes
+        np_arr = np_arr.astype(np_dtype)
+        if 'scale' in q_info:
+            # float16 weights are stored as is, integers with an affine quantization
+            np_arr = np_arr * q_info['scale'] + q_info['min']
     else:
-        np_arr = np.frombuffer(weights_data, dtype=np_dtype, count=count, offset=offset)
-        num_bytes = np_arr.nbytes
+        num_bytes = int(count) * np_dtype.itemsize
+        np_arr = np.frombuffer(weights_data.read(offset, num_bytes), dtype=np_dtype)
     np_arr = np_arr.reshape(weight['shape'])
     return name, np_arr, num_bytes
 
 
+def make_compact_weight(data, q_info, np_dtype):
+    """Returns a CompactWeight for the quantized data of a weight of np_dtype, None if onnx can't dequantize it."""
+    if np_dtype != np.float32:
+        return None
+    if data.dtype == np.float16:
+        return CompactWeight(data, None, None, np_dtype)
+    if data.dtype != np.uint8 or q_info['scale'] == 0:
+        # DequantizeLinear only supports 8 bit integers before opset 21
+        return None
+    # tfjs nudges min so that 0 is quantized exactly, min is a multiple of scale
+    scale = np.float32(q_info['scale'])
+    zero_point = np.round(-q_info['min'] / q_info['scale'])
+    if not 0 <= zero_point <= 255 or abs(zero_point * q_info['scale'] + q_info['min']) > abs(scale) * 1e-3:
+        logger.debug("Expanding weight with quantization %r, its zero point is not a uint8", q_info)
+        return None
+    return CompactWeight(data, scale, np.uint8(zero_point), np_dtype)
+
+
+def expand_compact_weight(weight):
+    """Returns the values of a CompactWeight in the dtype of the weight."""
+    np_arr = weight.data.astype(weight.dtype)
+    if weight.scale is not None:
+        np_arr = (np_arr - weight.zero_point) * weight.scale
+    return np_arr
+
+
 def read_string_weight(weights_data, offset, num_strings):
     """Decodes binary weight data for a tfjs string"""
     string_list = []
@@ -324,6 +430,8 @@ def read_tfjs_graph(nodes, weights, func=None, graph_inputs=None, graph_outputs=
         graph_inputs = [n['name'] + ':0' for n in nodes if n['op'] in placeholder_ops]
 
     unused_outputs = set()
+    # DequantizeLinear nodes of compact weights, they are onnx ops already
+    compact_nodes = []
 
     for node in nodes:
         op_type = node['op']
@@ -332,10 +440,17 @@ def read_tfjs_graph(nodes, weights, func=None, graph_inputs=None, graph_outputs=
             np_arr = weights[node_name]
             out_name = node_name + ':0'
             tf_dtype = read_tfjs_attr(node['attr']['dtype'], tf_dtypes=True)
+            if isinstance(np_arr, CompactWeight):
+                if tf_dtype == types_pb2.DT_FLOAT:
+                    onnx_nodes.extend(make_compact_weight_nodes(node_name, np_arr, output_shapes, tf_dtypes))
+                    compact_nodes.append(node_name)
+                    op_info[node_name] = (op_type, {'dtype': tf_dtype})
+                    continue
+                np_arr = expand_compact_weight(np_arr)
             onnx_dtype = tf_utils.map_tf_dtype(tf_dtype)
             # The dtype of a Const in tfjs can differ from that of the weight used to get its value
             np_dtype = utils.map_onnx_to_numpy_type(onnx_dtype)
-            onnx_tensor = numpy_helper.from_array(np_arr.astype(np_dtype), out_name)
+            onnx_tensor = make_tensor(np_arr.astype(np_dtype, copy=False), out_name)
             onnx_node = helper.make_node("Const", [], outputs=[out_name], name=node_name, value=onnx_tensor)
             onnx_nodes.append(onnx_node)
             output_shapes[out_name] = list(np_arr.shape)
@@ -360,6 +475,8 @@ def read_tfjs_graph(nodes, weights, func=None, graph_inputs=None, graph_outputs=
         inp_dtypes = [tf_dtypes[inp] for inp in input_names]
         inp_shapes = [output_shapes[inp] for inp in input_names]
         inp_consts = [weights.get(inp.split(':')[0]) for inp in input_names]
+        # shapes don't depend on the values of float weights
+        inp_consts = [None if isinstance(c, CompactWeight) else c for c in inp_consts]
         out_dtypes = get_output_dtypes(op_type, tf_attr)
         out_shapes = get_output_shapes(node_def, inp_dtypes, inp_shapes, inp_consts)
 
@@ -394,4 +511,36 @@ def read_tfjs_graph(nodes, weights, func=None, graph_inputs=None, graph_outputs=
     g = Graph(onnx_nodes, output_shapes, dtypes, input_names=graph_inputs, output_names=graph_outputs_mapped,
               is_subgraph=func is not None, graph_name=graph_name)
     g.rename_tensors(dict(zip(graph_outputs_mapped, graph_outputs)))
+    for node_name in compact_nodes:
+        node = g.get_node_by_name(node_name)
+        node.compact_weight = True
+        if node.type == "DequantizeLinear":
+            node.skip_conversion = True
     return g
+
+
+def make_compact_weight_nodes(node_name, weight, output_shapes, tf_dtypes):
+    """Returns the nodes computing the Const node_name from a CompactWeight. The data is stored in its compact
+    dtype and a DequantizeLinear or Cast node named node_name restores the dtype of the weight."""
+    out_name = node_name + ':0'
+    shape = list(weight.data.shape)
+    data_name = node_name + '/quantized:0'
+    nodes = [helper.make_node("Const", [], outputs=[data_name], name=node_name + '/quantized',
+                              value=make_tensor(weight.data, data_name))]
+    output_shapes[data_name] = shape
+    tf_dtypes[data_name] = tf.as_dtype(weight.data.dtype).as_datatype_enum
+    if weight.scale is None:
+        nodes.append(helper.make_node("Cast", [data_name], outputs=[out_name], name=node_name, to=TensorProto.FLOAT))
+    else:
+        dequantize_inputs = [data_name]
+        for suffix, value in [('/scale', weight.scale), ('/zero_point', weight.zero_point)]:
+            const_name = node_name + suffix + ':0'
+            nodes.append(helper.make_node("Const", [], outputs=[const_name], name=node_name + suffix,
+                                          value=make_tensor(np.array(value), const_name)))
+            output_shapes[const_name] = []
+            tf_dtypes[const_name] = tf.as_dtype(value.dtype).as_datatype_enum
+            dequantize_inputs.append(const_name)
+        nodes.append(helper.make_node("DequantizeLinear", dequantize_inputs, outputs=[out_name], name=node_name))
+    output_shapes[out_name] = shape
+    tf_dtypes[out_name] = tf.as_dtype(weight.dtype).as_datatype_enum
+    return nodes
@@ -6,20 +6,24 @@ tf2onnx.tflite_utils - utilities for parsing tflite files into onnx graph
 """
 
 import collections
+import hashlib
 import importlib
+import json
 import logging
+import mmap
+import os
 import struct
 
 from onnx import helper, onnx_pb, numpy_helper
-from tensorflow.core.framework import types_pb2, tensor_pb2, node_def_pb2
-from tensorflow.python.framework import tensor_util
+from tensorflow.core.framework import types_pb2, node_def_pb2
 import tensorflow as tf
 import numpy as np
 from tf2onnx.tflite.TensorType import TensorType as TFLiteTensorType
 from tf2onnx.tflite.Model import Model
-from tf2onnx.flexbuffers import read_flexbuffer
+from tf2onnx.flexbuffers import read_flexbuffer_cached
 from tf2onnx.tf_utils import read_tf_node_def_attrs
 from tf2onnx.graph import Graph
+from tf2onnx.tensor_store import make_raw_tensor
 from tf2onnx import utils
 
 logger = logging.getLogger(__name__)
@@ -64,6 +68,24 @@ TFLITE_TO_TF_DTYPE = {
 }
 
 
+# numpy dtypes for the data of tflite tensors, strings have their own encoding
+TFLITE_TO_NUMPY_DTYPE = {
+    TFLiteTensorType.FLOAT32: np.float32,
+    TFLiteTensorType.FLOAT16: np.float16,
+    TFLiteTensorType.INT32: np.int32,
+    TFLiteTensorType.UINT8: np.uint8,
+    TFLiteTensorType.INT64: np.int64,
+    TFLiteTensorType.BOOL: np.bool,
+    TFLiteTensorType.INT16: np.int16,
+    TFLiteTensorType.COMPLEX64: np.complex64,
+    TFLiteTensorType.INT8: np.int8,
+    TFLiteTensorType.FLOAT64: np.float64,
+    TFLiteTensorType.COMPLEX128: np.complex128,
+    TFLiteTensorType.UINT64: np.uint64,
+    TFLiteTensorType.UINT32: np.uint32,
+}
+
+
 def map_tflite_dtype_to_onnx(dtype):
     return TFLITE_TO_ONNX_DTYPE[dtype]
 
@@ -130,12 +152,65 @@ def get_options_class(name):
     return getattr(module, name)
 
 
-def graphs_from_tflite(tflite_path, input_names=None, output_names=None):
+# kinds of attributes of the options classes, see get_options_accessors
+OPTION_VALUE, OPTION_LIST, OPTION_ENUM, OPTION_FUNCTION = range(4)
+
+# BuiltinOptions index -> result of get_options_accessors
+_options_accessors_cache = {}
+
+
+def get_options_accessors(options_type):
+    """
+    Given the BuiltinOptionsType of an op, returns a tuple (options_class, accessors) with the flatbuffer Options class
+    of the op (None if it has none) and a tuple of (name, attr_name, getter, kind, enum_name) for each of its
+    attributes. name is the proper case name of the attribute, attr_name the snake case name, getter the unbound
+    method reading it, kind one of OPTION_* and enum_name the tflite enum of OPTION_ENUM attributes.
+    The classes are inspected once and the result is cached, parsing an op only calls the getters.
+    """
+    result = _options_accessors_cache.get(options_type)
+    if result is not None:
+        return result
+    options_type_name = lookup_enum(options_type, 'BuiltinOptions')
+    option_class = get_options_class(options_type_name)
+    accessors = []
+    if option_class is not None:
+        # All flatbuffer objects have these properties.
+        block_list = [options_type_name + 'BufferHasIdentifier', 'Init', 'GetRootAs' + options_type_name]
+        # The rest of the properties of the options class provide its attribute names
+        attr_names = {opt for opt in dir(option_class) if not opt.startswith('_') and opt not in block_list}
+        for a in list(attr_names):
+            # Flatbufffer list properties have 3 functions: *Length, *IsNone, and *AsNumpy
+            if a + 'Length' in attr_names:
+                attr_names.remove(a + 'Length')
+                attr_names.remove(a + 'IsNone')
+                attr_names.remove(a)
+        for a in sorted(attr_names):
+            getter = getattr(option_class, a)
+            enum_name = None
+            if a.endswith('AsNumpy'):
+                a = a[:-len('AsNumpy')]
+                kind = OPTION_LIST
+            elif a in NODE_ATTR_NAME_TO_ENUM_TYPE:
+                # For enums we use a string with the value name, not enum index
+                kind = OPTION_ENUM
+                enum_name = NODE_ATTR_NAME_TO_ENUM_TYPE[a]
+            elif a in FUNCTION_ATTRS:
+                kind = OPTION_FUNCTION
+            else:
+                kind = OPTION_VALUE
+            accessors.append((a, proper_to_snake_case(a), getter, kind, enum_name))
+    result = option_class, tuple(accessors)
+    _options_accessors_cache[options_type] = result
+    return result
+
+
+def graphs_from_tflite(tflite_path, input_names=None, output_names=None, probe_shapes=None):
     """
     Given the path to a tflite model, returns a tuple (main_graph, subgraphs) of graph.py Graph objects
     inputs/outputs will be taken from main graph in model if not overridden
+    probe_shapes is passed to read_tflite_model
     """
-    tflite_graphs, opcodes, model, tensor_shapes = read_tflite_model(tflite_path)
+    tflite_graphs, opcodes, model, tensor_shapes = read_tflite_model(tflite_path, probe_shapes)
     main_g = None
     subgraphs = []
     for i, tfl_graph in enumerate(tflite_graphs):
@@ -164,15 +239,18 @@ def graphs_from_tflite(tflite_path, input_names=None, output_names=None):
     return main_g, subgraphs
 
 
-def read_tflite_model(tflite_path):
+def read_tflite_model(tflite_path, probe_shapes=None):
     """
-    Given the path to a tflite model, returns tuple (tflite_graphs, opcodes_map, model)
+    Given the path to a tflite model, returns tuple (tflite_graphs, opcodes_map, model, tensor_shapes)
     Graphs are topologically sorted and the main graph is last
     Pass these to parse_tflite_graph
+    tensor_shapes maps tensor names of the first subgraph to the shapes the tflite interpreter infers for them.
+    The interpreter is only run if probe_shapes is True, or if it is None and the model lacks some shapes.
+    Otherwise tensor_shapes is empty and parse_tflite_graph uses the shapes stored in the model.
     """
     with open(tflite_path, 'rb') as f:
-        buf = f.read()
-    buf = bytearray(buf)
+        # the model is mapped rather than read, parse_tflite_graph copies constants only when it emits them
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     model = Model.GetRootAsModel(buf, 0)
     # To save space, each op in the model indicates its opcode as an index into the model's opcode map.
     opcodes_map = {}
@@ -186,23 +264,88 @@ def read_tflite_model(tflite_path):
         if code == 'CUSTOM':
             code = op_code.CustomCode().decode()
         opcodes_map[i] = code
-    # Shapes stored in tflite models are not always reliable so we get them from the interpreter if possible.
+    tensor_shapes = {}
+    if probe_shapes is None:
+        probe_shapes = not has_complete_shapes(model)
+    if probe_shapes:
+        tensor_shapes = get_interpreter_tensor_shapes(tflite_path, buf, model)
+    tflite_graphs = get_model_subgraphs(model)
+    return tflite_graphs, opcodes_map, model, tensor_shapes
+
+
+def has_complete_shapes(model):
+    """True if the model stores a shape for every tensor of its first subgraph.
+    The interpreter reports the shape signatures stored in the model, running it only adds the shapes it infers
+    for tensors that have none."""
+    graph = model.Subgraphs(0)
+    return all(not graph.Tensors(i).ShapeIsNone() for i in range(graph.TensorsLength()))
+
+
+# tensor shapes found by the tflite interpreter, keyed by the sha256 digest of the model
+_interpreter_shapes_cache = {}
+
+# bump when the layout of the on-disk shape cache changes
+_SHAPE_CACHE_FORMAT = 1
+
+
+def _shape_cache_path(digest):
+    """Path of the on-disk cache of the interpreter shapes of a model, None if caching is disabled."""
+    cache_dir = utils.get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "tflite_shapes", "{}_{}.json".format(digest, tf.__version__))
+
+
+def get_interpreter_tensor_shapes(tflite_path, buf, model):
+    """Return the shapes the tflite interpreter infers for the tensors of the first subgraph, by tensor name.
+    buf holds the contents of tflite_path. Allocating the tensors of a large model takes seconds, so the shapes are
+    cached in memory and on disk by the digest of the model."""
+    digest = hashlib.sha256(buf).hexdigest()
+    tensor_shapes = _interpreter_shapes_cache.get(digest)
+    if tensor_shapes is not None:
+        return tensor_shapes
+    path = _shape_cache_path(digest)
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cache = json.load(f)
+            if cache.get("format") == _SHAPE_CACHE_FORMAT:
+                tensor_shapes = cache["shapes"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            logger.debug("Ignoring unreadable shape cache %s", path, exc_info=1)
+    if tensor_shapes is None:
+        tensor_shapes = _probe_interpreter_tensor_shapes(tflite_path, model)
+        if tensor_shapes is None:
+            return {}
+        if path:
+            try:
+                utils.atomic_write_json(path, {"format": _SHAPE_CACHE_FORMAT, "shapes": tensor_shapes})
+            except OSError:
+                logger.debug("Unable to write shape cache %s", path, exc_info=1)
+    _interpreter_shapes_cache[digest] = tensor_shapes
+    return tensor_shapes
+
+
+def _probe_interpreter_tensor_shapes(tflite_path, model):
+    """Load the model into the tflite interpreter and read the shapes of the tensors of the first subgraph.
+    Returns None if the interpreter can't load the model."""
     tensor_shapes = {}
     try:
         interpreter = tf.lite.Interpreter(tflite_path)
+        # shapes are only inferred for tensors that have none when the tensors are allocated
         interpreter.allocate_tensors()
         tensor_cnt = model.Subgraphs(0).TensorsLength()
         for i in range(tensor_cnt):
             name = model.Subgraphs(0).Tensors(i).Name().decode()
-            details = interpreter._get_tensor_details(i)   # pylint: disable=protected-access
+            details = interpreter._get_tensor_details(i, 0)   # pylint: disable=protected-access
             if "shape_signature" in details:
                 tensor_shapes[name] = details["shape_signature"].tolist()
             elif "shape" in details:
                 tensor_shapes[name] = details["shape"].tolist()
     except Exception as e:    # pylint: disable=broad-except
         logger.warning("Error loading model into tflite interpreter: %s", e)
-    tflite_graphs = get_model_subgraphs(model)
-    return tflite_graphs, opcodes_map, model, tensor_shapes
+        return None
+    return tensor_shapes
 
 
 def get_subgraph_dependencies(model, graph_idx):
@@ -211,15 +354,14 @@ def get_subgraph_dependencies(model, graph_idx):
     g = model.Subgraphs(graph_idx)
     for i in range(g.OperatorsLength()):
         op = g.Operators(i)
-        options_type_name = lookup_enum(op.BuiltinOptionsType(), 'BuiltinOptions')
-        option_class = get_options_class(options_type_name)
+        option_class, accessors = get_options_accessors(op.BuiltinOptionsType())
         if option_class is not None:
             options = option_class()
-            options.Init(op.BuiltinOptions().Bytes, op.BuiltinOptions().Pos)
-            for attr in FUNCTION_ATTRS:
-                if hasattr(options, attr):
-                    value = getattr(options, attr)()
-                    dependencies.append(value)
+            table = op.BuiltinOptions()
+            options.Init(table.Bytes, table.Pos)
+            for _, _, getter, kind, _ in accessors:
+                if kind == OPTION_FUNCTION:
+                    dependencies.append(getter(options))
     return dependencies
 
 
@@ -265,7 +407,7 @@ def parse_tflite_string_tensor(buffer_bytes, shape):
     offset_list.append(len(buffer_bytes))
     string_list = []
     for i in range(count):
-        string_list.append(buffer_bytes[offset_list[i]:offset_list[i+1]].decode("utf-8"))
+        string_list.append(bytes(buffer_bytes[offset_list[i]:offset_list[i+1]]).decode("utf-8"))
     return numpy_helper.from_array(np.array(string_list, dtype=np.object).reshape(shape))
 
 
@@ -335,20 +477,21 @@ def parse_tflite_graph(tflite_g, opcodes_map, model, input_prefix='', tensor_sha
         buf = model.Buffers(tensor.Buffer())
         dtypes[name] = map_tflite_dtype_to_onnx(tensor.Type())
         if not buf.DataIsNone() and tensor.Buffer() > 0:
-            # For const values we use TF to decode the binary data from the buffer
-            t = tensor_pb2.TensorProto()
-            t.tensor_content = buf.DataAsNumpy().tobytes()
+            # a view of the mapped model, the data is copied once into the onnx tensor made in place in the node
+            data = buf.DataAsNumpy()
             if output_shapes[name] is None:
                 output_shapes[name] = []
-            for d in output_shapes[name]:
-                t.tensor_shape.dim.add().size = d
-            t.dtype = map_tflite_dtype_to_tf(tensor.Type())
-            if t.dtype == tf.string:
-                onnx_tensor = parse_tflite_string_tensor(t.tensor_content, output_shapes[name])
+            onnx_node = helper.make_node("Const", [], outputs=[name], name=name)
+            value = onnx_node.attribute.add()
+            value.name = "value"
+            value.type = onnx_pb.AttributeProto.TENSOR
+            if tensor.Type() == TFLiteTensorType.STRING:
+                value.t.CopyFrom(parse_tflite_string_tensor(data, output_shapes[name]))
             else:
-                np_data = tensor_util.MakeNdarray(t)
-                onnx_tensor = numpy_helper.from_array(np_data, name=name)
-            onnx_node = helper.make_node("Const", [], outputs=[name], name=name, value=onnx_tensor)
+                utils.make_sure(tensor.Type() in TFLITE_TO_NUMPY_DTYPE, "Unsupported tflite type %s of constant %s",
+                                tensor.Type(), name)
+                make_raw_tensor(data, TFLITE_TO_NUMPY_DTYPE[tensor.Type()], output_shapes[name], name=name,
+                                tensor=value.t)
             onnx_nodes.append(onnx_node)
             op_cnt["Const"] += 1
 
@@ -391,8 +534,7 @@ def parse_tflite_graph(tflite_g, opcodes_map, model, input_prefix='', tensor_sha
         optype = 'TFL_' + opcodes_map[op.OpcodeIndex()]
         op_cnt[optype] += 1
         attr = {}
-        options_type_name = lookup_enum(op.BuiltinOptionsType(), 'BuiltinOptions')
-        option_class = get_options_class(options_type_name)
+        option_class, accessors = get_options_accessors(op.BuiltinOptionsType())
         wants_dequantized_input = True
         has_prequantized_output = True
         if optype == 'TFL_QUANTIZE':
@@ -410,7 +552,7 @@ def parse_tflite_graph(tflite_g, opcodes_map, model, input_prefix='', tensor_sha
         input_names = [tensor_names[op.Inputs(i)] for i in range(op.InputsLength()) if op.Inputs(i) != -1]
         output_names = [tensor_names[op.Outputs(i)] for i in range(op.OutputsLength()) if op.Outputs(i) != -1]
         if optype.startswith("TFL_Flex"):
-            data = read_flexbuffer(op.CustomOptionsAsNumpy().tobytes(), decode_strings=False)
+            data = read_flexbuffer_cached(op.CustomOptionsAsNumpy().tobytes(), decode_strings=False)
             utils.make_sure(isinstance(data, list), "Flex ops are expected to store data as a flexbuffer list")
             tf_op = data[0].decode("utf-8")
             tf_node_def = node_def_pb2.NodeDef()
@@ -427,37 +569,25 @@ def parse_tflite_graph(tflite_g, opcodes_map, model, input_prefix='', tensor_sha
             if custom_ops_format == 'FLEXBUFFERS':
                 data = None
                 try:
-                    data = read_flexbuffer(op.CustomOptionsAsNumpy().tobytes())
+                    data = read_flexbuffer_cached(op.CustomOptionsAsNumpy().tobytes())
                 except Exception as e:    # pylint: disable=broad-except
                     logger.warning("Could not parse attributes for custom op '%s': %s", optype, e)
                 if isinstance(data, dict):
                     attr.update(data)
         if option_class is not None:
             options = option_class()
-            options.Init(op.BuiltinOptions().Bytes, op.BuiltinOptions().Pos)
-            # All flatbuffer objects have these properties.
-            block_list = [options_type_name + 'BufferHasIdentifier', 'Init', 'GetRootAs' + options_type_name]
-            # The rest of the properties of the options class provide its attribute names
-            attr_names = {opt for opt in dir(options) if not opt.startswith('_') and opt not in block_list}
-            for a in list(attr_names):
-                # Flatbufffer list properties have 3 functions: *Length, *IsNone, and *AsNumpy
-                if a + 'Length' in attr_names:
-                    attr_names.remove(a + 'Length')
-                    attr_names.remove(a + 'IsNone')
-                    attr_names.remove(a)
-            for a in attr_names:
-                if a.endswith('AsNumpy'):
-                    value = getattr(options, a)().tolist()
-                    a = a[:-len('AsNumpy')]
-                else:
-                    # For enums we use a string with the value name, not enum index
-                    value = getattr(options, a)()
-                    if a in NODE_ATTR_NAME_TO_ENUM_TYPE:
-                        value = lookup_enum(value, NODE_ATTR_NAME_TO_ENUM_TYPE[a])
-                    elif a in FUNCTION_ATTRS:
-                        value = model.Subgraphs(value).Name().decode()
+            table = op.BuiltinOptions()
+            options.Init(table.Bytes, table.Pos)
+            for a, attr_name, getter, kind, enum_name in accessors:
+                value = getter(options)
+                if kind == OPTION_LIST:
+                    value = value.tolist()
+                elif kind == OPTION_ENUM:
+                    value = lookup_enum(value, enum_name)
+                elif kind == OPTION_FUNCTION:
+                    value = model.Subgraphs(value).Name().decode()
                 attr_cnt[a] += 1
-                attr[proper_to_snake_case(a)] = value
+                attr[attr_name] = value
         if wants_dequantized_input:
             input_names = [get_dequant(inp) for inp in input_names]
         if optype == "TFL_TFLite_Detection_PostProcess":
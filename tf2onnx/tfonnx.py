@@ -16,6 +16,7 @@ import tf2onnx
 import tf2onnx.onnx_opset  # pylint: disable=unused-import
 import tf2onnx.tflite_handlers  # pylint: disable=unused-import
 import tf2onnx.custom_opsets  # pylint: disable=unused-import
+from tf2onnx.conversion_context import ConversionContext, get_context, in_conversion
 from tf2onnx.graph import Graph
 from tf2onnx.rewriter import *  # pylint: disable=wildcard-import
 from tf2onnx.tflite_rewriters import *  # pylint: disable=wildcard-import
@@ -94,6 +95,8 @@ def rewrite_constant_fold(g, ops):
             func = func_map.get(op.type)
             if func is None: continue
             if set(op.output) & set(g.outputs): continue
+            # a Cast expanding a float16 weight of a tfjs model, see Node.compact_weight
+            if op.compact_weight: continue
             try:
                 inputs = []
                 for node in op.inputs:
@@ -269,7 +272,9 @@ def tensorflow_onnx_mapping(g, ops_mapping, initialized_tables=None, is_tflite=F
             # if there is a tf_op/onnx_op key we'll map the old type to a new type
             converted_op = kwargs.get("tf_op" if is_tflite else "onnx_op")
             if converted_op:
-                # sometimes the handler wants to know what the old op name was
+                # sometimes the handler wants to know what the old op name was.
+                # kwargs belong to the shared handler registry so copy before adding to it.
+                kwargs = dict(kwargs)
                 kwargs["tfl_op" if is_tflite else "tf_op"] = op
                 node.type = converted_op
         body_graphs = node.get_body_graphs()
@@ -379,7 +384,8 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
                      extra_opset=None, shape_override=None, inputs_as_nchw=None,
                      input_names=None, output_names=None, ignore_default=None, use_default=None,
                      is_subgraph=False, const_node_values=None, tensors_to_rename=None,
-                     initialized_tables=None, tflite_path=None, dequantize=False, tfjs_path=None):
+                     initialized_tables=None, tflite_path=None, dequantize=False, tfjs_path=None,
+                     conversion_context=None, jobs=1, tflite_probe_shapes=None, tfjs_compact_weights=False):
     """Convert tensorflow graph to onnx graph.
         Args:
             tf_graph: tensorflow graph
@@ -400,6 +406,14 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
             tensors_to_rename: an optional dict (string->string) mapping tensor names to new names
             initialized_tables: mapping from table shared_names to tuple of keys and values of table
             tflite_path: Path to a tflite file to convert. If used, pass None to tf_graph
+            conversion_context: ConversionContext the graph belongs to. Optional, defaults to the active context
+                or a new one.
+            jobs: number of worker processes used to convert the functions of tf_graph. The result is the same
+                for any number, see parallel.convert_functions.
+            tflite_probe_shapes: run the tflite interpreter to find the tensor shapes of the tflite model. None
+                runs it only if the model doesn't store all shapes, see tflite_utils.read_tflite_model.
+            tfjs_compact_weights: keep the weights of tfjs models quantized to uint8 or float16 in that form and
+                dequantize them in the model. Needs opset 10 or later.
         Return:
             onnx graph
     """
@@ -418,46 +432,58 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
                        "please upgrade onnx package to avoid potential conversion issue.",
                        utils.get_onnx_version(), opset)
 
-    clear_functions()
-    if inputs_as_nchw is None:
-        inputs_as_nchw = []
-
-    is_tflite = False
-    if tflite_path is not None:
-        main_g, subgraphs = graphs_from_tflite(tflite_path, input_names, output_names)
-        is_tflite = True
-    elif tfjs_path is not None:
-        main_g, subgraphs = graphs_from_tfjs(tfjs_path, input_names, output_names, ignore_default, use_default)
-    else:
-        main_g, subgraphs = graphs_from_tf(tf_graph, input_names, output_names, shape_override, const_node_values,
-                                           ignore_default, use_default)
-
-    for g in [main_g] + subgraphs:
-        g.set_config(target, opset, extra_opset)
-    g = process_graphs(main_g, subgraphs, custom_op_handlers, inputs_as_nchw, continue_on_error, custom_rewriter,
-                       initialized_tables, tensors_to_rename, is_tflite, dequantize)
-    return g
+    if conversion_context is None:
+        conversion_context = get_context() if in_conversion() else ConversionContext()
+    with conversion_context.activate():
+        clear_functions()
+        if inputs_as_nchw is None:
+            inputs_as_nchw = []
+
+        is_tflite = False
+        if tflite_path is not None:
+            main_g, subgraphs = graphs_from_tflite(tflite_path, input_names, output_names, tflite_probe_shapes)
+            is_tflite = True
+        elif tfjs_path is not None:
+            if tfjs_compact_weights and opset < 10:
+                logger.warning("Compact tfjs weights need opset 10 or later, expanding them for opset %d", opset)
+                tfjs_compact_weights = False
+            main_g, subgraphs = graphs_from_tfjs(tfjs_path, input_names, output_names, ignore_default, use_default,
+                                                 tfjs_compact_weights)
+        else:
+            ordered_func = None
+            converted_functions = None
+            if jobs > 1:
+                from tf2onnx.parallel import convert_functions  # pylint: disable=import-outside-toplevel
+                nchw = inputs_as_nchw
+                if tensors_to_rename is not None:
+                    nchw = [tensors_to_rename.get(t, t) for t in inputs_as_nchw]
+                ordered_func, converted_functions = convert_functions(
+                    tf_graph, jobs, output_names, shape_override, const_node_values, ignore_default, use_default,
+                    target, opset, extra_opset, custom_op_handlers, nchw, continue_on_error, custom_rewriter,
+                    initialized_tables, dequantize)
+            main_g, subgraphs = graphs_from_tf(tf_graph, input_names, output_names, shape_override,
+                                               const_node_values, ignore_default, use_default, ordered_func)
+            if converted_functions is not None:
+                converted_functions.register()
+
+        for g in [main_g] + subgraphs:
+            g.set_config(target, opset, extra_opset)
+        g = process_graphs(main_g, subgraphs, custom_op_handlers, inputs_as_nchw, continue_on_error, custom_rewriter,
+                           initialized_tables, tensors_to_rename, is_tflite, dequantize)
+        return g
 
 
 def graphs_from_tf(tf_graph, input_names, output_names, shape_override=None, const_node_values=None,
-                   ignore_default=None, use_default=None):
+                   ignore_default=None, use_default=None, ordered_func=None):
     """make tf2onnx internal subgraphs from the tensorflow subgraphs"""
     if shape_override is None:
         shape_override = {}
-    ordered_func = resolve_functions(tf_graph)
+    if ordered_func is None:
+        ordered_func = resolve_functions(tf_graph)
     subgraphs = []
     for func in ordered_func:
-        f_inputs_names = [t.name for t in func.inputs]
-        f_output_names = [t.name for t in func.outputs]
-
-        outputs_to_values, _ = compute_const_folding_using_tf(func, const_node_values, output_names)
-
-        onnx_nodes, _, _, output_shapes, dtypes, _ = \
-            tensorflow_to_onnx(func, shape_override, const_node_values, ignore_default, use_default)
-
-        fg = Graph(onnx_nodes, output_shapes, dtypes, input_names=f_inputs_names, output_names=f_output_names,
-                   is_subgraph=True, graph_name=func.name)
-        fold_constants_using_tf(fg, outputs_to_values)
+        fg = graph_from_tf_function(func, output_names, shape_override, const_node_values, ignore_default,
+                                    use_default)
         subgraphs.append(fg)
 
     is_func = is_function(tf_graph)
@@ -475,6 +501,23 @@ def graphs_from_tf(tf_graph, input_names, output_names, shape_override=None, con
     return main_g, subgraphs
 
 
+def graph_from_tf_function(func, output_names, shape_override, const_node_values=None, ignore_default=None,
+                           use_default=None):
+    """make a tf2onnx internal subgraph from a tensorflow function graph"""
+    f_inputs_names = [t.name for t in func.inputs]
+    f_output_names = [t.name for t in func.outputs]
+
+    outputs_to_values, _ = compute_const_folding_using_tf(func, const_node_values, output_names)
+
+    onnx_nodes, _, _, output_shapes, dtypes, _ = \
+        tensorflow_to_onnx(func, shape_override, const_node_values, ignore_default, use_default)
+
+    fg = Graph(onnx_nodes, output_shapes, dtypes, input_names=f_inputs_names, output_names=f_output_names,
+               is_subgraph=True, graph_name=func.name)
+    fold_constants_using_tf(fg, outputs_to_values)
+    return fg
+
+
 def process_graphs(main_g, subgraphs, custom_op_handlers, inputs_as_nchw, continue_on_error, custom_rewriter,
                    initialized_tables, tensors_to_rename, is_tflite=False, dequantize=False):
 
@@ -538,12 +581,10 @@ def process_parsed_graph(g, custom_op_handlers, inputs_as_nchw, continue_on_erro
                 kwargs["onnx_op"] = onnx_op
                 args = args[1:]
             kwargs["args"] = args
-            new_handler = handler.tf_op(k,
-                                        domain=constants.TENSORFLOW_OPSET.domain,
-                                        kwargs=kwargs)
-            new_handler.register_compat_handler(compat_handler, 1)
+            # only this conversion uses the handler, it isn't registered with handler.tf_op
             custom_opset[k] = (compat_handler, kwargs)
-        ops_mapping.update(custom_opset)
+        ops_mapping = ops_mapping.updated(custom_opset)
+    g.conversion_context.ops_mapping = ops_mapping
 
     if inputs_as_nchw:
         transpose_inputs(g, inputs_as_nchw)
@@ -5,9 +5,11 @@
 tf2onnx.utils - misc utilities for tf2onnx
 """
 
+import json
 import os
 import re
 import shutil
+import sys
 import tempfile
 import types
 import zipfile
@@ -21,6 +23,7 @@ from google.protobuf import text_format
 from onnx import helper, onnx_pb, defs, numpy_helper, ModelProto, __version__
 
 from . import constants
+from .conversion_context import get_context
 
 
 logger = logging.getLogger(__file__)
@@ -77,18 +80,13 @@ class TensorValueInfo(object):
 ONNX_UNKNOWN_DIMENSION = -1
 ONNX_EMPTY_INPUT = ""
 
-# index for internally generated names
-INTERNAL_NAME = 1
-
 # Fake onnx op type which is used for Graph input.
 GRAPH_INPUT_TYPE = "NON_EXISTENT_ONNX_TYPE"
 
 
 def make_name(name):
-    """Make op name for inserted ops."""
-    global INTERNAL_NAME
-    INTERNAL_NAME += 1
-    return "{}__{}".format(name, INTERNAL_NAME)
+    """Make op name for inserted ops. Names are unique within the active ConversionContext."""
+    return get_context().make_name(name)
 
 
 def split_nodename_and_shape(name):
@@ -201,11 +199,11 @@ def get_subgraphs_from_onnx(model_proto):
 def initialize_name_counter(model_proto):
     """Avoid name conflicts by initializing the counter used by make_name based on the provided model"""
     suffix_regex = re.compile(r"__(\d+)(:\d+)?$")
+    context = get_context()
     def avoid_name(name):
-        global INTERNAL_NAME
         suffix = suffix_regex.search(name)
         if suffix:
-            INTERNAL_NAME = max(INTERNAL_NAME, int(suffix.group(1)) + 1)
+            context.reserve_names(int(suffix.group(1)) + 1)
     for g in get_subgraphs_from_onnx(model_proto):
         for n in g.node:
             avoid_name(n.name)
@@ -489,6 +487,61 @@ def set_debug_mode(enabled):
     _is_debug_mode = enabled
 
 
+def get_cache_dir():
+    """Directory for tf2onnx's on-disk caches, None if they are disabled with TF2ONNX_CACHE_DIR=''."""
+    cache_dir = os.environ.get(constants.ENV_TF2ONNX_CACHE_DIR)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "tf2onnx")
+    return cache_dir or None
+
+
+def atomic_write_json(path, obj):
+    """Write obj to path as json. Readers never see a partial file, even with concurrent writers."""
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_current_rss():
+    """Return the resident set size of this process in bytes (0 if it can't be determined)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes (0 if it can't be determined)."""
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """Make get_peak_rss report the peak from now on. Returns False if that isn't supported on this platform."""
+    try:
+        # resets the high water mark of the resident set size, linux only
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
 def get_max_value(np_dtype):
     return np.iinfo(np_dtype).max
 
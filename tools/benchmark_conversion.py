@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# coding: utf-8
+"""
+Benchmarks the conversion of a fixed set of local models, phase by phase, and compares the results to a baseline
+to catch performance regressions of the converter. The models are made by make_regression_test_models.py and from
+keras applications without their weights, nothing is downloaded.
+
+python tools/benchmark_conversion.py --output results.json
+python tools/benchmark_conversion.py --baseline results.json --time-tolerance 0.2
+
+The results have the time of each phase (the median over --repeat conversions), the node counts and the size of
+the model for each model. With --baseline the exit code is 1 if a model got slower, bigger or has more nodes than
+the tolerances allow.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import onnx
+import tensorflow as tf
+
+import tf2onnx
+from tf2onnx import constants, optimizer, tf_loader
+from tf2onnx.tfonnx import process_tf_graph
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from make_regression_test_models import train  # pylint: disable=wrong-import-position
+
+# pylint: disable=missing-docstring
+
+PHASES = ["load", "import", "process", "optimize", "make_model", "serialize"]
+
+# keras applications made without weights, name -> (constructor, input shape)
+KERAS_MODELS = collections.OrderedDict([
+    ("MobileNet", (tf.keras.applications.MobileNet, [1, 224, 224, 3])),
+    ("MobileNetV2", (tf.keras.applications.MobileNetV2, [1, 224, 224, 3])),
+    ("ResNet50", (tf.keras.applications.ResNet50, [1, 224, 224, 3])),
+    ("EfficientNetB0", (tf.keras.applications.EfficientNetB0, [1, 224, 224, 3])),
+])
+
+REGRESSION_MODELS = ["regression_graphdef", "regression_checkpoint", "regression_saved_model"]
+
+MODELS = REGRESSION_MODELS + list(KERAS_MODELS)
+
+
+def make_models(names, model_dir):
+    """Make the models in model_dir. Returns a dict mapping their names to a function loading each of them as a
+    frozen graph_def, its inputs and outputs."""
+    loaders = {}
+    if any(name in REGRESSION_MODELS for name in names):
+        train(os.path.join(model_dir, "regression"))
+        path = os.path.join(model_dir, "regression", "{}")
+        loaders["regression_graphdef"] = lambda: tf_loader.from_graphdef(
+            path.format("graphdef/frozen.pb"), ["X:0"], ["pred:0"])
+        loaders["regression_checkpoint"] = lambda: tf_loader.from_checkpoint(
+            path.format("checkpoint/model.meta"), ["X:0"], ["pred:0"])
+        loaders["regression_saved_model"] = lambda: tf_loader.from_saved_model(
+            path.format("saved_model"), None, None, tag="serve")
+    for name in names:
+        if name in KERAS_MODELS:
+            loaders[name] = _make_keras_model(name, model_dir)
+    return {name: loaders[name] for name in names}
+
+
+def _make_keras_model(name, model_dir):
+    constructor, shape = KERAS_MODELS[name]
+    tf.keras.utils.set_random_seed(0)
+    model = constructor(weights=None, input_shape=shape[1:])
+    path = os.path.join(model_dir, name)
+    spec = tf.TensorSpec(shape, tf.float32, name="input")
+    tf.saved_model.save(model, path, signatures=tf.function(model).get_concrete_function(spec))
+    tf.keras.backend.clear_session()
+    return lambda: tf_loader.from_saved_model(path, None, None)
+
+
+def convert(load, opset):
+    """Convert the model load returns. Returns the seconds each phase took and the stats of the model."""
+    times = collections.OrderedDict()
+    start = time.perf_counter()
+
+    def end(phase):
+        nonlocal start
+        now = time.perf_counter()
+        times[phase] = now - start
+        start = now
+
+    graph_def, inputs, outputs = load()
+    end("load")
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name="")
+        end("import")
+        g = process_tf_graph(tf_graph, opset=opset, input_names=inputs, output_names=outputs)
+    end("process")
+    process_nodes = len(g.get_nodes())
+    g = optimizer.optimize_graph(g)
+    end("optimize")
+    model_proto = g.make_model("benchmark")
+    end("make_model")
+    model_size = len(model_proto.SerializeToString())
+    end("serialize")
+    stats = collections.OrderedDict([
+        ("tf_nodes", len(graph_def.node)),
+        ("process_nodes", process_nodes),
+        ("onnx_nodes", len(model_proto.graph.node)),
+        ("model_size", model_size),
+    ])
+    return times, stats
+
+
+def benchmark(names, opset, repeat, model_dir):
+    loaders = make_models(names, model_dir)
+    results = collections.OrderedDict()
+    for name, load in loaders.items():
+        runs = []
+        for _ in range(repeat):
+            times, stats = convert(load, opset)
+            runs.append(times)
+        phases = collections.OrderedDict((p, float(np.median([r[p] for r in runs]))) for p in PHASES)
+        results[name] = collections.OrderedDict([("phases", phases), ("total", sum(phases.values()))])
+        results[name].update(stats)
+        print("{}: {:.3f}s, {}".format(name, results[name]["total"],
+                                       ", ".join("{} {:.3f}s".format(p, t) for p, t in phases.items())))
+    return results
+
+
+def environment(opset, repeat):
+    return collections.OrderedDict([
+        ("tf2onnx", tf2onnx.__version__),
+        ("tensorflow", tf.__version__),
+        ("onnx", onnx.__version__),
+        ("python", platform.python_version()),
+        ("machine", platform.machine()),
+        ("processor", platform.processor()),
+        ("opset", opset),
+        ("repeat", repeat),
+    ])
+
+
+def _exceeds(current, base, tolerance, min_delta=0):
+    return current > base * (1 + tolerance) and current - base > min_delta
+
+
+def compare(results, baseline, time_tolerance, min_time_delta, size_tolerance, node_tolerance):
+    """Compare results to the results in baseline. Times are regressions if they are more than time_tolerance
+    (relative) and min_time_delta seconds slower, sizes and node counts if they grow by more than size_tolerance and
+    node_tolerance (relative). Returns the list of regressions."""
+    regressions = []
+    for name, current in results.items():
+        base = baseline["models"].get(name)
+        if base is None:
+            print("{}: not in the baseline".format(name))
+            continue
+        checks = [("total", current["total"], base["total"], time_tolerance, min_time_delta)]
+        checks += [(p, current["phases"][p], base["phases"][p], time_tolerance, min_time_delta)
+                   for p in PHASES if p in base["phases"]]
+        checks += [(key, current[key], base[key], node_tolerance, 0)
+                   for key in ["process_nodes", "onnx_nodes"] if key in base]
+        if "model_size" in base:
+            checks.append(("model_size", current["model_size"], base["model_size"], size_tolerance, 0))
+        for key, value, base_value, tolerance, min_delta in checks:
+            change = (value - base_value) / base_value if base_value else 0
+            regressed = _exceeds(value, base_value, tolerance, min_delta)
+            print("{}: {} {:.6g} -> {:.6g} ({:+.1%}){}".format(name, key, base_value, value, change,
+                                                                " REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append("{} {}: {:.6g} -> {:.6g}".format(name, key, base_value, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default=",".join(MODELS),
+                        help="comma-separated models to convert, from " + ", ".join(MODELS))
+    parser.add_argument("--opset", type=int, default=constants.PREFERRED_OPSET, help="opset to convert to")
+    parser.add_argument("--repeat", type=int, default=3, help="number of conversions of each model")
+    parser.add_argument("--model-dir", help="directory the models are made in, a temporary one by default")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare the results to the results in this json file")
+    parser.add_argument("--time-tolerance", type=float, default=0.2,
+                        help="relative slowdown of a phase or the total that is a regression")
+    parser.add_argument("--min-time-delta", type=float, default=0.05,
+                        help="slowdowns of fewer seconds are never regressions")
+    parser.add_argument("--size-tolerance", type=float, default=0.01,
+                        help="relative growth of the model size that is a regression")
+    parser.add_argument("--node-tolerance", type=float, default=0.0,
+                        help="relative growth of the node counts that is a regression")
+    args = parser.parse_args()
+
+    names = args.models.split(",")
+    unknown = [name for name in names if name not in MODELS]
+    if unknown:
+        parser.error("unknown models {}, choose from {}".format(unknown, MODELS))
+    if args.model_dir:
+        results = benchmark(names, args.opset, args.repeat, args.model_dir)
+    else:
+        with tempfile.TemporaryDirectory() as model_dir:
+            results = benchmark(names, args.opset, args.repeat, model_dir)
+    report = collections.OrderedDict([("environment", environment(args.opset, args.repeat)), ("models", results)])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["environment"] != report["environment"]:
+            print("the baseline was made in a different environment: {}".format(baseline["environment"]))
+        regressions = compare(results, baseline, args.time_tolerance, args.min_time_delta, args.size_tolerance,
+                              args.node_tolerance)
+        if regressions:
+            print("{} regressions:\n  {}".format(len(regressions), "\n  ".join(regressions)))
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == '__main__':
+    main()
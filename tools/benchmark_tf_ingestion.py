@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# coding: utf-8
+"""
+Benchmarks tf_utils.tflist_to_onnx, the pass turning the nodes of a tensorflow graph into onnx nodes,
+on a synthetic frozen graph made of MatMuls with large constant weights.
+
+python tools/benchmark_tf_ingestion.py --size 1024
+"""
+import argparse
+import ctypes
+import gc
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tf2onnx import utils
+from tf2onnx.tf_utils import compress_graph_def, tflist_to_onnx
+
+
+def make_graph_def(size_mb, tensor_mb):
+    """Return a frozen graph_def with size_mb MB of float weights in tensors of tensor_mb MB."""
+    dim = int(np.sqrt(tensor_mb * 2**20 / 4))
+    with tf.Graph().as_default() as graph:
+        y = tf.compat.v1.placeholder(tf.float32, [1, dim], name="input")
+        # a small tensor, the graph only needs its shape and dtype
+        weight = tf.constant(np.zeros((2, 2), np.float32))
+    graph_def = graph.as_graph_def()
+    template = tf.compat.v1.NodeDef()
+    template.CopyFrom([n for n in graph_def.node if n.name == weight.op.name][0])
+    del graph_def.node[1:]
+    rng = np.random.RandomState(0)
+    for i in range(max(1, size_mb // tensor_mb)):
+        const = graph_def.node.add()
+        const.CopyFrom(template)
+        const.name = "weight{}".format(i)
+        tensor = const.attr["value"].tensor
+        tensor.tensor_shape.dim[0].size = dim
+        tensor.tensor_shape.dim[1].size = dim
+        tensor.tensor_content = rng.uniform(-1, 1, (dim, dim)).astype(np.float32).tobytes()
+        matmul = graph_def.node.add()
+        matmul.op = "MatMul"
+        matmul.name = "matmul{}".format(i)
+        matmul.input.extend([y if isinstance(y, str) else y.op.name, const.name])
+        matmul.attr["T"].type = tensor.dtype
+        y = matmul.name
+    return graph_def
+
+
+def release_free_memory():
+    """Return the memory freed so far to the system, so it doesn't hide the memory used by the next run."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def benchmark(size_mb, tensor_mb, compress, repeat):
+    graph_def = make_graph_def(size_mb, tensor_mb)
+    const_node_values = compress_graph_def(graph_def) if compress else None
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name="")
+    del graph_def
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        release_free_memory()
+        start_rss = utils.get_current_rss()
+        utils.reset_peak_rss()
+        start = time.perf_counter()
+        onnx_nodes = tflist_to_onnx(tf_graph, {}, const_node_values)[0]
+        times.append(time.perf_counter() - start)
+        peaks.append(utils.get_peak_rss() - start_rss)
+        del onnx_nodes
+    print("weights: {} MB, compress_graph_def: {}".format(size_mb, compress))
+    print("tflist_to_onnx: best {:.2f}s, mean {:.2f}s over {} runs".format(min(times), np.mean(times), repeat))
+    print("peak memory above the loaded graph: {} MB".format(max(peaks) // 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024, help="size of the weights in MB")
+    parser.add_argument("--tensor-size", type=int, default=16, help="size of each weight in MB")
+    parser.add_argument("--compress", action="store_true",
+                        help="move the weights out of the graph first like --large_model does")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs")
+    args = parser.parse_args()
+    benchmark(args.size, args.tensor_size, args.compress, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ import re
 
 from collections import OrderedDict
 
+import tf2onnx.tfonnx  # pylint: disable=unused-import
 from tf2onnx.handler import tf_op
 
 parser = argparse.ArgumentParser()
@@ -7,10 +7,12 @@ import os
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.python.framework.graph_util import convert_variables_to_constants
 
 # pylint: disable=missing-docstring
 
+# the model is built as a tf-1.x graph
+tf = tf.compat.v1
+
 # Parameters
 learning_rate = 0.02
 training_epochs = 100
@@ -36,12 +38,17 @@ def freeze_session(sess, keep_var_names=None, output_names=None, clear_devices=T
         if clear_devices:
             for node in input_graph_def.node:
                 node.device = ""
-        frozen_graph = convert_variables_to_constants(sess, input_graph_def,
-                                                      output_names, freeze_var_names)
+        frozen_graph = tf.graph_util.convert_variables_to_constants(sess, input_graph_def,
+                                                                    output_names, freeze_var_names)
         return frozen_graph
 
 
 def train(model_path):
+    with tf.Graph().as_default():
+        _train(model_path)
+
+
+def _train(model_path):
     n_samples = _train_x.shape[0]
 
     # tf Graph Input
@@ -84,4 +91,5 @@ def train(model_path):
         tf.saved_model.simple_save(sess, p, inputs={"X": x}, outputs={"pred": pred})
 
 
-train("models/regression")
+if __name__ == "__main__":
+    train("models/regression")